@@ -0,0 +1 @@
+../reporting-diff/diffstore.py
\ No newline at end of file
@@ -0,0 +1,196 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from diffstore import empty_index, index_blob, merge, partition_blob, row_hashes, write_index
+from epimargin.etl.covid19india import (columns_v3, columns_v4, data_path,
+                                        state_code_lookup)
+
+# districts reported by the covid19india API; scale 1 reproduces this count
+base_districts = 740
+
+# states in the API today (the retired codes and the national/unassigned rows are left out)
+state_codes = [code for code in state_code_lookup if code not in ("TT", "UN", "DD", "DN")]
+
+statuses = ["Hospitalized", "Recovered", "Deceased"]
+linelist_columns = ["patient_number", "date_announced", "detected_district", "detected_state", "current_status", "status_change_date", "num_cases"]
+raw_file_count   = 20 # raw_data1 and 2 are in the v3 layout, the rest in v4
+
+# shape of the synthetic epidemic
+mean_daily_cases = 40    # typical district's daily cases
+growth_noise     = 0.03  # daily drift in each district's log growth rate
+recovery_lag     = 14
+death_lag        = 10
+mortality        = 0.015
+vertices         = 400   # outline points per district on the synthetic maps; real district outlines have hundreds to thousands
+
+def normalize(state: str) -> str:
+    return state.replace(" and ", " And ").replace(" & ", " And ")
+
+def district_counts(rng, scale: float, codes) -> Dict[str, int]:
+    """ districts per state, unevenly sized like the real ones, adding up to about `scale` × `base_districts` across all states """
+    weights = rng.lognormal(0, 0.6, len(state_codes))
+    counts  = np.maximum(1, np.round(scale * base_districts * weights / weights.sum())).astype(int)
+    return {code: count for (code, count) in zip(state_codes, counts) if code in codes}
+
+def daily_cases(rng, n: int, days: int) -> np.ndarray:
+    """ (district × day) daily confirmed cases; each district's log growth rate drifts as a mean-reverting walk """
+    growth = np.zeros((n, days))
+    for t in range(1, days):
+        growth[:, t] = 0.95 * growth[:, t-1] + rng.normal(0, growth_noise, n)
+    intensity = np.log(rng.lognormal(np.log(mean_daily_cases), 1, (n, 1))) + np.cumsum(growth, axis = 1)
+    return rng.poisson(np.exp(np.clip(intensity, -2, np.log(50000))))
+
+def lag(values: np.ndarray, days: int) -> np.ndarray:
+    return np.hstack([np.zeros((values.shape[0], days), dtype = values.dtype), values[:, :-days]])
+
+def outline(rng, center, radius: float) -> list:
+    """ closed, jagged district outline; star-shaped around its center, so it never self-intersects """
+    theta = np.linspace(0, 2 * np.pi, vertices, endpoint = False)
+    r = radius * (0.85 + 0.1 * np.sin(theta * rng.integers(3, 9)) + rng.uniform(-0.04, 0.04, vertices))
+    ring = np.column_stack([center[0] + r * np.cos(theta), center[1] + r * np.sin(theta)]).round(6).tolist()
+    return ring + ring[:1]
+
+def district_map(rng, districts, origin) -> Dict:
+    """ GeoJSON for one state: districts laid out on a grid of 0.2° cells """
+    columns = int(np.ceil(np.sqrt(len(districts))))
+    return {
+        "type": "FeatureCollection",
+        "features": [{
+            "type": "Feature",
+            "properties": {"district": district},
+            "geometry": {"type": "Polygon", "coordinates": [outline(rng, (origin[0] + 0.2 * (i % columns), origin[1] + 0.2 * (i // columns)), 0.1)]}
+        } for (i, district) in enumerate(districts)]
+    }
+
+def raw_rows(linelist: pd.DataFrame, columns) -> pd.DataFrame:
+    """ line-list rows in a raw file's layout, with dates written day first """
+    dates = pd.to_datetime(linelist.status_change_date).dt.strftime("%d/%m/%Y").values
+    values = {
+        "Patient Number":     linelist.patient_number.values,
+        "Date Announced":     dates,
+        "Status Change Date": dates,
+        "Detected District":  linelist.detected_district.values,
+        "Detected State":     linelist.detected_state.values,
+        "Current Status":     linelist.current_status.values,
+        "Num Cases":          linelist.num_cases.values
+    }
+    return pd.DataFrame({column: values.get(column, "") for column in columns})
+
+def append_csv(df: pd.DataFrame, filename: Path):
+    df.to_csv(filename, mode = "a", header = not filename.exists(), index = False)
+
+def generate(root, scale: float = 1, days: int = 120, states: Optional[Iterable[str]] = None, seed: int = 0) -> Dict:
+    """ writes a synthetic national dataset into local buckets under `root` (one directory per bucket):
+    raw case time series, vaccinations, reference tables and maps, plus the raw line-list files for the reporting diff
+    (outside the buckets, in `root/raw`, to be served over HTTP); returns the sizes the benchmark measures throughput in """
+    root = Path(root)
+    rng  = np.random.default_rng(seed)
+    codes = [code for code in state_codes if not states or code in states]
+    (pipeline, reporting) = (root/"daily_pipeline", root/"adaptive-control-daily-pipeline")
+    for directory in (root/"raw", pipeline/"pipeline/raw", pipeline/"pipeline/commons/refs", pipeline/"pipeline/commons/maps", (reporting/partition_blob("")).parent, (reporting/index_blob).parent):
+        directory.mkdir(parents = True, exist_ok = True)
+
+    dates = pd.date_range(end = pd.Timestamp.today().normalize() - pd.Timedelta(days = 1), periods = days)
+    date_strings = dates.strftime("%Y-%m-%d")
+    raw_file_of_date = dict(zip(date_strings, np.arange(days) * raw_file_count // days))
+    counts = district_counts(rng, scale, codes)
+    crosswalk, sero_pop, vax, reported = [], [], [], []
+    linelist_rows = 0
+    patients = 1
+    print(f"Generating {sum(counts.values())} districts in {len(codes)} states over {days} days.")
+    for (k, state_code) in enumerate(codes):
+        state = state_code_lookup[state_code]
+        n = counts[state_code]
+        districts = [f"{state_code} District {i:03d}" for i in range(n)]
+
+        dT = daily_cases(rng, n, days)
+        dR = np.round(lag(dT, recovery_lag) * 0.98).astype(int)
+        dD = rng.binomial(lag(dT, death_lag), mortality)
+        daily = {"Hospitalized": dT, "Recovered": dR, "Deceased": dD}
+
+        # covid19india API aggregates: cumulative counts per (district, date) and per (state, date)
+        cumulative = {status: values.cumsum(axis = 1) for (status, values) in daily.items()}
+        district_rows = pd.DataFrame({
+            "Date":      np.tile(date_strings, n),
+            "State":     state,
+            "District":  np.repeat(districts, days),
+            "Confirmed": cumulative["Hospitalized"].ravel(),
+            "Recovered": cumulative["Recovered"].ravel(),
+            "Deceased":  cumulative["Deceased"].ravel(),
+            "Other":     0,
+            "Tested":    20 * cumulative["Hospitalized"].ravel()
+        })
+        append_csv(district_rows, pipeline/"pipeline/raw/districts.csv")
+        append_csv(district_rows.drop(columns = ["District"]).groupby(["Date", "State"], sort = False).sum().reset_index(), pipeline/"pipeline/raw/states.csv")
+
+        # daily status changes, as aggregated from the line list
+        district_ts = pd.DataFrame({
+            "detected_state":     state,
+            "detected_district":  np.repeat(districts, days),
+            "status_change_date": np.tile(date_strings, n),
+            "date":               np.tile(date_strings, n),
+            "time":               0,
+            "delta":              0,
+            "logdelta":           0,
+            **{status: values.ravel() for (status, values) in daily.items()}
+        })
+        append_csv(district_ts, pipeline/"pipeline/raw/district_case_timeseries.csv")
+        append_csv(district_ts.drop(columns = ["detected_district"]).groupby(["detected_state", "status_change_date", "date"], sort = False).sum().reset_index(), pipeline/"pipeline/raw/state_case_timeseries.csv")
+
+        # the line list has one row per (district, date, status) with cases, split by date across the raw files;
+        # names are title-cased, as load_all_data leaves them
+        linelist = district_ts.melt(id_vars = ["detected_state", "detected_district", "status_change_date"], value_vars = statuses, var_name = "current_status", value_name = "num_cases")\
+            .query("num_cases > 0")\
+            .assign(
+                detected_state    = lambda _: _.detected_state.str.title(),
+                detected_district = lambda _: _.detected_district.str.title(),
+                date_announced    = lambda _: _.status_change_date,
+                raw_file          = lambda _: _.status_change_date.map(raw_file_of_date))
+        # only the v3 layout has patient numbers
+        linelist["patient_number"] = np.where(linelist.raw_file < 2, patients + np.arange(len(linelist)), np.nan)
+        patients += len(linelist)
+        for (i, rows) in linelist.groupby("raw_file"):
+            append_csv(raw_rows(rows, columns_v3 if i < 2 else columns_v4), root/"raw"/data_path(i + 1))
+        linelist = linelist[linelist_columns]
+        linelist_rows += len(linelist)
+
+        # the reporting diff store already holds everything up to a week ago
+        previous = linelist[linelist.status_change_date < date_strings[-7]]
+        previous = previous.assign(rowhash = row_hashes(previous), report_date = date_strings[-7])
+        append_csv(previous, reporting/partition_blob(date_strings[-7]))
+        reported.append(previous.rowhash.values)
+
+        population = rng.integers(200000, 4000000, n)
+        sero_pop.append(pd.DataFrame({
+            "state": state, "district": districts,
+            **{f"sero_{i}": rng.uniform(0.15, 0.35, n) for i in range(7)},
+            **{f"N_{i}": population // 7 for i in range(7)},
+            "N_tot": 7 * (population // 7)
+        }))
+        crosswalk.append(pd.DataFrame({
+            "state_api": normalize(state), "district_api": districts,
+            "lgd_state_name": state.lower(), "lgd_state_id": k + 1,
+            "lgd_district_name": [district.lower() for district in districts], "lgd_district_id": 1000 * (k + 1) + np.arange(n)
+        }))
+        vax.append(pd.Series(np.cumsum(rng.integers(0, 10 * n, days)), index = date_strings, name = state))
+
+        (pipeline/f"pipeline/commons/maps/{state_code}.json").write_text(json.dumps(district_map(rng, districts, (70 + 2 * (k % 6), 10 + 2 * (k // 6)))))
+
+    (reporting/index_blob).write_bytes(write_index(merge(empty_index(), np.concatenate(reported))).getvalue())
+    pd.concat(sero_pop).to_csv(pipeline/"pipeline/commons/refs/all_india_sero_pop.csv", index = False)
+    pd.concat(crosswalk).to_stata(pipeline/"pipeline/commons/refs/all_crosswalk.dta", write_index = False)
+    pd.DataFrame(vax).rename_axis("State").reset_index().to_csv(pipeline/"pipeline/raw/vaccine_doses_statewise.csv", index = False)
+
+    sizes = dict(
+        states        = len(codes),
+        state_codes   = codes,
+        districts     = int(sum(counts.values())),
+        days          = days,
+        district_days = int(sum(counts.values())) * days,
+        linelist_rows = linelist_rows
+    )
+    (root/"fixtures.json").write_text(json.dumps(sizes))
+    return sizes
@@ -0,0 +1,291 @@
+import argparse
+import functools
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from pathlib import Path
+from typing import Dict, List
+
+from instrumentation import invocation, read_records, span
+
+root = Path(__file__).resolve().parent
+repo = root.parent.parent
+
+# stage -> (function source directory, fixture size its throughput is measured in)
+stages = {
+    # every series is estimated in natl_estimates; the estimates stage publishes each state's share of them
+    "natl_estimates":     ("pipeline/est/natl_state_estimates",          "district_days"),
+    "estimates":          ("pipeline/est/state_district_estimates",      "district_days"),
+    "initial_conditions": ("pipeline/est/simulation_initial_conditions", "districts"),
+    "simplify_maps":      ("misc/simplify_maps",                         "districts"),
+    "render":             ("pipeline/rpt/get_twitter_images",            "states"),
+    "reporting_diff":     ("misc/reporting-diff",                        "linelist_rows"),
+    # second run against unchanged raw files: every download is a 304 and every frame comes from the Parquet cache
+    "reporting_diff_warm": ("misc/reporting-diff",                       "linelist_rows"),
+}
+
+# Cloud Function entry points measured by --cold-start: each main.py is imported in a fresh process, `import_repeats` times
+entry_points = [
+    "pipeline/raw/get_state_timeseries",
+    "pipeline/raw/get_vax_data",
+    "pipeline/raw/get_bmc_dashboard",
+    "pipeline/est/state_district_estimates",
+    "pipeline/est/natl_state_estimates",
+    "pipeline/est/simulation_initial_conditions",
+    "pipeline/sim/forward_simulation",
+    "pipeline/exp/tweet_reports",
+    "misc/reporting-diff",
+    "misc/sync_sheet",
+]
+import_repeats = 3
+
+# a stage regresses if it is slower (or larger) than its baseline by more than this fraction, and by more than the absolute slack
+tolerance = 0.25
+slack     = dict(wall_s = 0.5, peak_rss_mb = 50)
+cold_start_slack = dict(wall_s = 0.1, peak_rss_mb = 20)
+
+class Request:
+    """ the parts of a flask request the Cloud Function entry points read """
+
+    def __init__(self, **args):
+        self.args = args
+
+    def get_json(self):
+        return None
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve(directory: Path) -> str:
+    """ serves the raw line-list files over HTTP from a background thread, standing in for the covid19india API; returns the base URL """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory = str(directory)))
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+def load_main(directory: str):
+    spec = importlib.util.spec_from_file_location("main", repo/directory/"main.py")
+    main = importlib.util.module_from_spec(spec)
+    # registered before loading so batch workers can unpickle its functions
+    sys.modules["main"] = main
+    spec.loader.exec_module(main)
+    return main
+
+def import_entry_point(directory: str):
+    """ imports one function's main.py from its own directory, as a new instance would """
+    os.chdir(repo/directory)
+    sys.path.insert(0, str(repo/directory))
+    with invocation("benchmark", stage = directory):
+        with span("import"):
+            load_main(directory)
+
+def cold_start(workdir: Path) -> Dict:
+    """ import time and memory of each entry point, the fastest of `import_repeats` fresh processes """
+    workdir.mkdir(parents = True, exist_ok = True)
+    results = {}
+    for directory in entry_points:
+        name = Path(directory).name
+        metrics_path = workdir/f"cold_start_{name}.metrics.jsonl"
+        log_path     = workdir/f"cold_start_{name}.log"
+        if metrics_path.exists():
+            metrics_path.unlink()
+        print(f"  {name}...", flush = True)
+        with open(log_path, "w") as log:
+            for _ in range(import_repeats):
+                subprocess.run(
+                    [sys.executable, __file__, "--import-entry-point", directory],
+                    env = dict(os.environ, METRICS_PATH = str(metrics_path), STORAGE_BACKEND = "local", STORAGE_ROOT = str(workdir.resolve()), TWITTER_BACKEND = "local"),
+                    stdout = log, stderr = subprocess.STDOUT
+                )
+        records = read_records(metrics_path, step = "benchmark") if metrics_path.exists() else []
+        if not records or any(record["status"] != "ok" for record in records):
+            print(f"  {name} failed to import; see {log_path}")
+            results[name] = dict(status = "error", wall_s = None, cpu_s = None, peak_rss_mb = None, throughput = None, errors = sum(record["status"] != "ok" for record in records) or import_repeats, spans = {})
+            continue
+        fastest = min(records, key = lambda record: record["wall_s"])
+        results[name] = dict(
+            status      = "ok",
+            wall_s      = fastest["wall_s"],
+            cpu_s       = fastest["cpu_s"],
+            peak_rss_mb = fastest["peak_rss_mb"],
+            throughput  = None,
+            errors      = 0,
+            spans       = {}
+        )
+    return results
+
+def run_stage(stage: str, data: Path):
+    """ imports one function's main.py against the local buckets under `data`, and runs it on every fixture state """
+    (directory, _) = stages[stage]
+    sizes = json.loads((data/"fixtures.json").read_text())
+    state_codes = sizes["state_codes"]
+
+    sys.path.insert(0, str(repo/directory))
+    if stage.startswith("reporting_diff"):
+        os.environ["RAW_DATA_URL"] = serve(data/"raw")
+    with invocation("benchmark", stage = stage):
+        with span("import"):
+            main = load_main(directory)
+
+        with span("run"):
+            if stage == "estimates":
+                main.run_estimates(Request(state_codes = ",".join(state_codes), force = "true"))
+            elif stage == "natl_estimates":
+                main.run_estimates(Request(force = "true"))
+            elif stage == "initial_conditions":
+                main.assemble_data(Request(state_codes = ",".join(state_codes), force = "true"))
+            elif stage == "simplify_maps":
+                main.simplify_maps(state_codes)
+            elif stage == "render":
+                for state_code in state_codes:
+                    try:
+                        main.render_state(state_code, True)
+                    except Exception as e:
+                        print(f"ERROR when rendering {state_code}", e)
+                        traceback.print_exc()
+            elif stage.startswith("reporting_diff"):
+                main.reporting_diff(None)
+
+def summarize(records: List[Dict], units: int) -> Dict:
+    """ one stage's wall and CPU time, peak memory across the stage and its workers, throughput, and time per span """
+    top = [record for record in records if record["step"] == "benchmark"]
+    if not top:
+        return dict(status = "error", wall_s = None, cpu_s = None, peak_rss_mb = None, throughput = None, errors = None, spans = {})
+    top = top[-1]
+    spans = {}
+    for record in records:
+        for _ in (record["spans"] if record is not top else []):
+            spans[_["name"]] = round(spans.get(_["name"], 0) + _["wall_s"], 4)
+    run_s = sum(_["wall_s"] for _ in top["spans"] if _["name"] == "run")
+    return dict(
+        status      = top["status"],
+        wall_s      = run_s,
+        import_s    = sum(_["wall_s"] for _ in top["spans"] if _["name"] == "import"),
+        cpu_s       = top["cpu_s"],
+        peak_rss_mb = max(record["peak_rss_mb"] for record in records),
+        units       = units,
+        throughput  = round(units / run_s, 1) if run_s else None,
+        errors      = sum(record["status"] != "ok" for record in records if record is not top),
+        spans       = spans
+    )
+
+def benchmark(workdir: Path, scale: float, days: int, states: List[str], selected: List[str], seed: int) -> Dict:
+    # imported here, so cold-start measurements do not start with the fixtures' numpy and pandas already loaded
+    import fixtures
+
+    data = workdir/f"{scale:g}x-{days}d"
+    sizes = fixtures.generate(data, scale = scale, days = days, states = states, seed = seed)
+    results = {}
+    for stage in selected:
+        metrics_path = data/f"{stage}.metrics.jsonl"
+        log_path     = data/f"{stage}.log"
+        print(f"  {stage}...", flush = True)
+        # each stage runs in its own process, so peak memory is the stage's own; the fixture buckets are served by the local storage backend
+        with open(log_path, "w") as log:
+            subprocess.run(
+                [sys.executable, __file__, "--stage", stage, "--data", str(data)],
+                env = dict(os.environ, METRICS_PATH = str(metrics_path), STORAGE_BACKEND = "local", STORAGE_ROOT = str(data.resolve())),
+                stdout = log, stderr = subprocess.STDOUT
+            )
+        results[stage] = summarize(read_records(metrics_path) if metrics_path.exists() else [], sizes[stages[stage][1]])
+        if results[stage]["status"] != "ok" or results[stage]["errors"]:
+            print(f"  {stage} reported errors; see {log_path}")
+    return results
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    """ stages that got slower, used more memory, or failed more often than in the baseline """
+    regressions = []
+    for (config, stage_results) in results.items():
+        for (stage, result) in stage_results.items():
+            base = baseline.get(config, {}).get(stage)
+            if not base:
+                continue
+            if (result["status"] != "ok" and base["status"] == "ok") or (result["errors"] or 0) > (base["errors"] or 0):
+                regressions.append(f"{config} {stage}: status {result['status']} with {result['errors']} errors (baseline: {base['status']} with {base['errors']})")
+                continue
+            if result["wall_s"] is None:
+                continue
+            for (metric, allowance) in (cold_start_slack if config == "cold-start" else slack).items():
+                if base[metric] and result[metric] > base[metric] * (1 + tolerance) and result[metric] - base[metric] > allowance:
+                    regressions.append(f"{config} {stage}: {metric} {base[metric]} -> {result[metric]} ({result[metric]/base[metric] - 1:+.0%})")
+    return regressions
+
+def unmatched(results: Dict, baseline: Dict) -> List[str]:
+    """ measured stages that have nothing in the baseline to be compared with """
+    return [f"{config} {stage}" for (config, stage_results) in results.items() for stage in stage_results if not baseline.get(config, {}).get(stage)]
+
+def report(results: Dict, baseline: Dict):
+    print(f"{'config':<10} {'stage':<30} {'wall_s':>8} {'cpu_s':>8} {'rss_mb':>8} {'throughput':>22} {'vs baseline':>12}")
+    for (config, stage_results) in results.items():
+        for (stage, result) in stage_results.items():
+            if result["wall_s"] is None:
+                print(f"{config:<10} {stage:<30} {'failed':>8}")
+                continue
+            base = baseline.get(config, {}).get(stage)
+            change = f"{result['wall_s']/base['wall_s'] - 1:+.0%}" if base and base["wall_s"] else "-"
+            throughput = f"{result['throughput']:.0f} {stages[stage][1]}/s" if result["throughput"] else "-"
+            print(f"{config:<10} {stage:<30} {result['wall_s']:>8.2f} {result['cpu_s']:>8.2f} {result['peak_rss_mb']:>8.0f} {throughput:>22} {change:>12}")
+            if result["spans"]:
+                print(" " * 42 + ", ".join(f"{name} {seconds:.2f}s" for (name, seconds) in result["spans"].items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "benchmark pipeline stages on synthetic national data against local buckets")
+    parser.add_argument("--scale",     type = float, nargs = "+", default = [1],   help = "multiples of the current district count")
+    parser.add_argument("--days",      type = int,   nargs = "+", default = [120], help = "days of case history")
+    parser.add_argument("--states",    nargs = "*", default = None, help = "state codes to include (default: all)")
+    parser.add_argument("--stages",    nargs = "*", default = list(stages), choices = list(stages))
+    parser.add_argument("--seed",      type = int, default = 0)
+    parser.add_argument("--baseline",  type = Path, default = root/"baseline.json", help = "results to compare against (optional; not committed, since timings are machine-specific)")
+    parser.add_argument("--save",      action = "store_true", help = "record these results as the new baseline")
+    parser.add_argument("--ci",        action = "store_true", default = bool(os.environ.get("CI")), help = "fail if any stage has no baseline to compare with (on by default when CI is set)")
+    parser.add_argument("--workdir",   type = Path, default = None, help = "keep fixtures, logs and metrics here instead of a temporary directory")
+    parser.add_argument("--cold-start", action = "store_true", help = "measure each entry point's import time instead of running stages")
+    parser.add_argument("--stage",     help = argparse.SUPPRESS)
+    parser.add_argument("--import-entry-point", help = argparse.SUPPRESS)
+    parser.add_argument("--data",      type = Path, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args.stage, args.data)
+        sys.exit(0)
+    if args.import_entry_point:
+        import_entry_point(args.import_entry_point)
+        sys.exit(0)
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or Path(tmp)
+        results = {}
+        if args.cold_start:
+            print("Measuring cold-start imports.")
+            results["cold-start"] = cold_start(workdir)
+        for (scale, days) in ([] if args.cold_start else product(args.scale, args.days)):
+            print(f"Benchmarking {scale:g}x districts, {days} days.")
+            results[f"{scale:g}x-{days}d"] = benchmark(workdir, scale, days, args.states, args.stages, args.seed)
+
+    report(results, baseline)
+    if args.save:
+        for (config, stage_results) in results.items():
+            baseline.setdefault(config, {}).update(stage_results)
+        args.baseline.write_text(json.dumps(baseline, indent = 2))
+        print(f"Saved baseline to {args.baseline}.")
+        sys.exit(0)
+
+    # a missing baseline would otherwise pass every check
+    missing = unmatched(results, baseline)
+    for stage in missing:
+        print(f"{'MISSING BASELINE' if args.ci else 'No baseline for'} {stage} in {args.baseline}; not compared. Run with --save on this machine to record one.")
+    if missing and args.ci:
+        sys.exit(1)
+
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
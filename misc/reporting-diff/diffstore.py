@@ -0,0 +1,62 @@
+import io
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# the diff is stored as one CSV per report date, plus a sorted array of the 64-bit hashes of every row already reported
+index_blob  = "reporting-diff/index/rowhashes.npy"
+legacy_blob = "reporting-diff/daily_diff.csv"
+
+key_columns  = ["patient_number", "date_announced", "detected_district", "detected_state", "current_status", "status_change_date", "num_cases"]
+text_columns = ["patient_number", "detected_district", "detected_state", "current_status"]
+date_columns = ["date_announced", "status_change_date"]
+
+def partition_blob(report_date: str) -> str:
+    return f"reporting-diff/daily/{report_date}.csv"
+
+def text(column: pd.Series) -> np.ndarray:
+    """ values as strings, with whole numbers written without a decimal point whether they were read as ints, floats or text """
+    numbers = pd.to_numeric(column, errors = "coerce").values
+    whole   = ~np.isnan(numbers) & (numbers == np.round(numbers))
+    values  = column.fillna("").astype(str).values.copy()
+    values[whole] = numbers[whole].astype("int64").astype(str)
+    return values
+
+def day(column: pd.Series) -> np.ndarray:
+    """ dates at day resolution, in nanoseconds whatever unit they were parsed in """
+    return pd.to_datetime(column, errors = "coerce").dt.normalize().values.astype("datetime64[ns]")
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """ stable hash of each row's key columns: the same in every process, and the same whether the row was parsed
+    from the raw files or read back from a stored partition, whatever dtypes its columns were inferred as """
+    keys = pd.DataFrame({
+        **{column: text(df[column]) for column in text_columns},
+        **{column: day(df[column]) for column in date_columns},
+        "num_cases": pd.to_numeric(df["num_cases"], errors = "coerce").astype(float).values
+    })[key_columns]
+    return pd.util.hash_pandas_object(keys, index = False).values
+
+def empty_index() -> np.ndarray:
+    return np.array([], dtype = np.uint64)
+
+def read_index(buffer: Optional[io.BytesIO]) -> np.ndarray:
+    return empty_index() if buffer is None else np.load(buffer, allow_pickle = False)
+
+def write_index(index: np.ndarray) -> io.BytesIO:
+    buffer = io.BytesIO()
+    np.save(buffer, index, allow_pickle = False)
+    return buffer
+
+def unseen(index: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """ mask of the hashes that are not in the sorted index """
+    if not len(index):
+        return np.ones(len(hashes), dtype = bool)
+    positions = np.searchsorted(index, hashes)
+    return index[np.minimum(positions, len(index) - 1)] != hashes
+
+def merge(index: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """ sorted index with hashes not already in it added, in one pass over the index """
+    hashes = np.unique(hashes)
+    hashes = hashes[unseen(index, hashes)]
+    return np.insert(index, np.searchsorted(index, hashes), hashes)
@@ -1,58 +1,154 @@
+import io
+import json
+import os
 from pathlib import Path
+from typing import Dict, Optional, Tuple
+
 import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from adaptive.etl.covid19india import data_path, download_data, load_all_data
-from google.cloud import storage
+from adaptive.etl.covid19india import data_path, load_data_v3, load_data_v4
+from blobs import download_buffers, get_bucket, map_concurrently, upload_buffers
+from diffstore import (empty_index, index_blob, legacy_blob, merge,
+                       partition_blob, read_index, row_hashes, unseen,
+                       write_index)
+from instrumentation import add_bytes, instrumented, span
 
 bucket_name = "adaptive-control-daily-pipeline"
-blob_name   = "reporting-diff/daily_diff.csv"
-filename    = blob_name.replace("reporting-diff", "/tmp")
 
+# raw line-list files: v3 layout up to April 26, 2020 and v4 after; later v4 files may not exist yet
+base_url  = os.environ.get("RAW_DATA_URL", "https://api.covid19india.org/csv/latest/")
+raw_files = {
+    **{data_path(i): load_data_v3 for i in (1, 2)},
+    **{data_path(i): load_data_v4 for i in range(3, 21)}
+}
+
+# each raw file's parsed frame is cached as Parquet, with the validators it was downloaded with
+cache_root      = "reporting-diff/cache"
+validators_blob = f"{cache_root}/validators.json"
+
+# concurrent downloads, each retried with backoff on connection errors and server errors
+max_downloads = 6
+adapter = HTTPAdapter(pool_maxsize = max_downloads, max_retries = Retry(total = 3, backoff_factor = 1, status_forcelist = [429, 500, 502, 503, 504]))
+session = requests.Session()
+session.mount("http://",  adapter)
+session.mount("https://", adapter)
+
+def cache_blob(filename: str) -> str:
+    return f"{cache_root}/{Path(filename).stem}.parquet"
+
+def fetch(filename: str, validator: Dict) -> Tuple[int, Optional[bytes], Dict]:
+    """ conditional GET of one raw file; returns 304 without a body if it has not changed since `validator` was recorded """
+    headers = {}
+    if validator.get("etag"):
+        headers["If-None-Match"] = validator["etag"]
+    if validator.get("last_modified"):
+        headers["If-Modified-Since"] = validator["last_modified"]
+    response = session.get(base_url + filename, headers = headers, timeout = 60)
+    if response.status_code in (304, 404):
+        return (response.status_code, None, validator)
+    response.raise_for_status()
+    add_bytes(received = len(response.content))
+    return (response.status_code, response.content, {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")})
+
+def parse(filename: str, content: bytes) -> pd.DataFrame:
+    """ raw file parsed with its layout's loader; mixed-type text columns are made uniformly strings so the frame can be stored as Parquet """
+    path = Path("/tmp")/filename
+    path.write_bytes(content)
+    frame = raw_files[filename](path).reset_index(drop = True)
+    for column in frame.columns[frame.dtypes == object]:
+        frame[column] = frame[column].map(lambda value: value if pd.isna(value) or isinstance(value, str) else str(value))
+    return frame
+
+def load(bucket, filename: str, validator: Dict) -> Tuple[Optional[pd.DataFrame], Dict]:
+    """ parsed frame for one raw file, downloaded and parsed again only if it changed since it was cached;
+    if the download fails, the cached copy is used when there is one """
+    cached = cache_blob(filename)
+    has_cache = bucket.get_blob(cached) is not None
+    try:
+        (status, content, validator) = fetch(filename, validator if has_cache else {})
+    except requests.RequestException as e:
+        if not has_cache:
+            raise
+        print(f"could not download {filename} ({e}); using cached copy")
+        status = 304
+    if status == 404:
+        return (None, {})
+    if status == 304:
+        return (pd.read_parquet(download_buffers(bucket, [cached])[cached]), validator)
+    print(f"parsing {filename}")
+    frame = parse(filename, content)
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer, index = False)
+    upload_buffers(bucket, {cached: (buffer, "application/octet-stream")})
+    return (frame, validator)
+
+def combine(frames) -> pd.DataFrame:
+    """ the line list, assembled from the per-file frames as load_all_data does """
+    all_cases = pd.concat(frames, ignore_index = True)
+    all_cases["status_change_date"] = all_cases["status_change_date"].fillna(all_cases["date_announced"])
+    all_cases["detected_state"]     = all_cases["detected_state"].str.strip().str.title()
+    all_cases["detected_district"]  = all_cases["detected_district"].str.strip().str.title()
+    return all_cases.dropna(subset = ["detected_state"])
+
+def migrate(bucket):
+    """ one-off: splits the legacy daily_diff.csv into per-date partitions, and indexes its rows with stable hashes
+    (the rowhash column it was written with came from Python's per-process salted hash, so cannot be reused) """
+    legacy = download_buffers(bucket, [legacy_blob], missing_ok = True)[legacy_blob]
+    if legacy is None:
+        print("no previous diff; starting a new index")
+        return empty_index()
+    df = pd.read_csv(legacy)
+    df = df.drop(columns = [col for col in df.columns if col.startswith("Unnamed")])
+    df["rowhash"] = row_hashes(df)
+    df = df.drop_duplicates(subset = ["rowhash"], keep = "first")
+    print(f"migrating {len(df)} rows from {legacy_blob} into {df.report_date.nunique()} partitions")
+    upload_buffers(bucket, {partition_blob(report_date): (partition.to_csv(index = False), "text/csv") for (report_date, partition) in df.groupby("report_date")})
+    return merge(empty_index(), df.rowhash.values)
+
+@instrumented("reporting_diff")
 def reporting_diff(_):
-    tmp = Path("/tmp")
     run_date = str(pd.Timestamp.now()).split()[0]
     print(f"run date: {run_date}")
 
-    # download csv from cloud storage
-    print("downloading csv")
-    storage.Client()\
-        .bucket(bucket_name)\
-        .blob(blob_name)\
-        .download_to_filename(filename)
-    
-    print("loading csv")
-    df_old = pd.read_csv(filename)
-    df_old = df_old.drop(columns = [col for col in df_old.columns if col.startswith("Unnamed")])
-
-    print("downloading latest data")
-    paths = {
-        "v3": [data_path(i) for i in (1, 2)],
-        "v4": [data_path(i) for i in range(3, 21)]
-    }
-
-    for target in paths['v3'] + paths['v4']:
-        try:
-            download_data(tmp, target)
-        except:
-            pass 
-
-    df_new = load_all_data(
-        v3_paths = [tmp/filepath for filepath in paths['v3']], 
-        v4_paths = [tmp/filepath for filepath in paths['v4'] if (tmp/filepath).exists()]
-    )
+    # only the hash index and today's partition (if this is a rerun) are read, not the full history
+    print("downloading index")
+    bucket = get_bucket(bucket_name)
+    with span("download", blob = "index"):
+        stored = download_buffers(bucket, [index_blob, partition_blob(run_date), validators_blob], missing_ok = True)
+        index = read_index(stored[index_blob]) if stored[index_blob] is not None else migrate(bucket)
+        validators = json.load(stored[validators_blob]) if stored[validators_blob] is not None else {}
+    print(f"{len(index)} rows reported so far")
+
+    print(f"downloading latest data from {base_url}")
+    with span("download", blob = "raw"):
+        loaded = dict(zip(raw_files, map_concurrently(lambda filename: load(bucket, filename, validators.get(filename, {})), raw_files, max_downloads)))
+
+    with span("parse"):
+        df_new = combine([frame for (frame, _) in loaded.values() if frame is not None])
 
     print("calculating diff")
-    df_new["rowhash"] = df_new[["patient_number", "date_announced", "detected_district", "detected_state","current_status", "status_change_date", "num_cases"]].apply(lambda x: hash(tuple(x)), axis = 1)
-    df_new = df_new.drop_duplicates(subset=["rowhash"], keep="first")
-    df_new["report_date"] = run_date
-    diff = df_new[~df_new.rowhash.isin(df_old.rowhash)]
+    with span("diff"):
+        df_new["rowhash"] = row_hashes(df_new)
+        df_new = df_new.drop_duplicates(subset = ["rowhash"], keep = "first")
+        diff = df_new[unseen(index, df_new.rowhash.values)].assign(report_date = run_date)
     num_new_rows = len(diff)
 
+    # a rerun on the same day adds to that day's partition rather than replacing it
+    if stored[partition_blob(run_date)] is not None:
+        earlier = pd.read_csv(stored[partition_blob(run_date)])
+        earlier["rowhash"] = row_hashes(earlier)
+        diff = pd.concat([earlier, diff]).drop_duplicates(subset = ["rowhash"], keep = "first")
+
+    # the partition goes up before the index, so an interrupted run is picked up again by the next one
     print(f"uploading diff ({num_new_rows} new rows written)")
-    pd.concat([df_old, diff]).to_csv(filename)
-    storage.Client()\
-        .bucket(bucket_name)\
-        .blob(blob_name)\
-        .upload_from_filename(filename, content_type = "text/csv")
+    with span("upload"):
+        upload_buffers(bucket, {partition_blob(run_date): (diff.to_csv(index = False), "text/csv")})
+        upload_buffers(bucket, {
+            index_blob:      (write_index(merge(index, diff.rowhash.values)), "application/octet-stream"),
+            validators_blob: (json.dumps({filename: validator for (filename, (frame, validator)) in loaded.items() if frame is not None}), "application/json")
+        })
 
     print("done")
@@ -0,0 +1 @@
+../../pipeline/commons/blobs.py
\ No newline at end of file
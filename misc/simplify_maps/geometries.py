@@ -0,0 +1 @@
+../../pipeline/commons/geometries.py
\ No newline at end of file
@@ -0,0 +1,49 @@
+import sys
+import tempfile
+from pathlib import Path
+
+from blobs import get_bucket, upload_many
+from geometries import read_map, read_geometries, simplified_root, write_geometries
+
+# cloud details
+bucket_name = "daily_pipeline"
+maps_root   = "pipeline/commons/maps"
+
+# choropleths are saved at 3840 × 1986 px; detail finer than half a pixel cannot show up in the output
+output_width  = 3840
+output_height = 1986
+tolerance_px  = 0.5
+
+def tolerance(gdf) -> float:
+    """ half an output pixel in map units, if the whole state were drawn across the full image """
+    (xmin, ymin, xmax, ymax) = gdf.total_bounds
+    return tolerance_px * max((xmax - xmin) / output_width, (ymax - ymin) / output_height)
+
+def simplify(gdf):
+    """ simplifies each district outline without letting it self-intersect or collapse """
+    return gdf.assign(geometry = gdf.geometry.simplify(tolerance(gdf), preserve_topology = True))
+
+def simplify_maps(state_codes = None):
+    bucket = get_bucket(bucket_name)
+    blobs  = [blob for blob in bucket.list_blobs(prefix = f"{maps_root}/") if blob.name.endswith(".json") and "/simplified/" not in blob.name]
+    if state_codes:
+        blobs = [blob for blob in blobs if Path(blob.name).stem in state_codes]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs = {}
+        for blob in blobs:
+            state_code = Path(blob.name).stem
+            source = Path(tmp) / f"{state_code}.json"
+            blob.download_to_filename(str(source))
+            full = read_map(source)
+            simplified = simplify(full)
+            target = Path(tmp) / f"{state_code}.parquet"
+            write_geometries(simplified, target)
+            # sanity check: the simplified file must round-trip with the same district index
+            assert read_geometries(target).index.equals(full.index)
+            print(f"{state_code}: {len(full)} districts, {source.stat().st_size/1000:.0f} kb GeoJSON -> {target.stat().st_size/1000:.0f} kb")
+            outputs[f"{simplified_root}/{state_code}.parquet"] = (target, "application/octet-stream")
+        upload_many(bucket, outputs, verify = True)
+
+if __name__ == "__main__":
+    simplify_maps(sys.argv[1:])
@@ -0,0 +1 @@
+../../pipeline/commons/instrumentation.py
\ No newline at end of file
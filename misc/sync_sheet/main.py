@@ -1,43 +1,148 @@
-import os
-
 import pandas
 
-import google.auth
-from google.cloud import storage
-from googleapiclient.discovery import build
+from blobs import download_buffers, get_bucket, upload_buffers
+from instrumentation import instrumented, span
 
 # cloud details
-bucket_name = "adaptive-control-daily-pipeline"
-blob_name   = "estimates/Rt_timeseries_india.csv"
-filename    = blob_name.replace("estimates", "/tmp")
+bucket_name   = "adaptive-control-daily-pipeline"
+blob_name     = "estimates/Rt_timeseries_india.csv"
+snapshot_blob = "estimates/sheet_sync/Rt_timeseries_india.synced.csv" # the sheet's rows as of the last sync, in sheet order
 
 # sheet details
-sheet_id = "17sDFb2DwplJX8A7bRdYvlEJdhRgsVpE44nQpNKWR6jM"
+sheet_id   = "17sDFb2DwplJX8A7bRdYvlEJdhRgsVpE44nQpNKWR6jM"
+sheet_name = "Rt_timeseries_india"
+first_row  = 2 # below the header
+key        = ["state", "date"]
+columns    = ["state", "date", "Rt", "Rt_upper", "Rt_lower"]
+
+# rows sent per API call, keeping each request well under the Sheets payload limit
+batch_rows = 10000
+
+def sheets_service():
+    # only needed when no service is passed in
+    import google.auth
+    from googleapiclient.discovery import build
+
+    credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/spreadsheets'])
+    return build('sheets', 'v4', credentials=credentials, cache_discovery = False)
+
+def read_rows(buffer) -> pandas.DataFrame:
+    """ rows as text, exactly as written, so unchanged values compare equal and are sent as they are """
+    return pandas.read_csv(buffer, dtype = str, keep_default_na = False)[columns]
+
+def batches(rows: pandas.DataFrame):
+    for start in range(0, len(rows), batch_rows):
+        yield rows.iloc[start:start + batch_rows]
+
+def duplicated(rows: pandas.DataFrame) -> bool:
+    return rows.duplicated(key).any()
+
+def removed(synced: pandas.DataFrame, latest: pandas.DataFrame) -> pandas.Index:
+    """ positions of rows in the sheet whose keys are no longer in `latest`, e.g. the dates that slid out of the window """
+    merged = synced.merge(latest[key], on = key, how = "left", indicator = True)
+    return synced.index[(merged._merge == "left_only").values]
+
+def diff(synced: pandas.DataFrame, latest: pandas.DataFrame) -> pandas.DataFrame:
+    """ rows to write, indexed by their position in the sheet: those whose values changed since `synced`, then new rows
+    after the last one; every key in `synced` must still be in `latest` """
+    merged = synced.reset_index().rename(columns = {"index": "position"})\
+        .merge(latest, on = key, how = "outer", suffixes = ("_synced", ""), indicator = True)
+    both = merged[merged._merge == "both"]
+    values = [column for column in columns if column not in key]
+    changed = both[(both[[f"{column}_synced" for column in values]].values != both[values].values).any(axis = 1)]
+    changed = changed.assign(position = changed.position.astype(int)).sort_values("position").set_index("position")[columns]
+    appended = latest.merge(merged.loc[merged._merge == "right_only", key], on = key)[columns]
+    appended.index = len(synced) + pandas.RangeIndex(len(appended))
+    return pandas.concat([changed, appended])
 
-def sync_sheet(_):
-    # download csv from cloud storage
+def runs(positions):
+    """ (start, end) slices of sorted positions that are consecutive """
+    run_starts = [0] + [i for i in range(1, len(positions)) if positions[i] != positions[i - 1] + 1] + [len(positions)]
+    return list(zip(run_starts, run_starts[1:]))
+
+def contiguous_ranges(rows: pandas.DataFrame):
+    """ rows grouped into runs of consecutive sheet rows, one ValueRange per run """
+    positions = rows.index.values
+    for (start, end) in runs(positions):
+        top = first_row + positions[start]
+        yield {
+            "range":  f"{sheet_name}!A{top}:E{top + end - start - 1}",
+            "values": rows.iloc[start:end].values.tolist()
+        }
+
+def push_changes(service, rows: pandas.DataFrame):
+    """ writes rows at their positions, one batchUpdate per batch; new rows are written past the end of the sheet rather
+    than appended, so repeating a sync that failed part way does not duplicate them """
+    values = service.spreadsheets().values()
+    for batch in batches(rows):
+        response = values.batchUpdate(spreadsheetId = sheet_id, body = {"valueInputOption": "USER_ENTERED", "data": list(contiguous_ranges(batch))}).execute()
+        print("updated", response.get("totalUpdatedRows"), "rows")
+
+def delete_rows(service, positions: pandas.Index):
+    """ deletes the rows at `positions` in one batchUpdate, last run first so the rows above keep their numbers;
+    the rows below move up """
+    spreadsheets = service.spreadsheets()
+    properties = spreadsheets.get(spreadsheetId = sheet_id, fields = "sheets.properties").execute()
+    grid_id = next(sheet["properties"]["sheetId"] for sheet in properties["sheets"] if sheet["properties"]["title"] == sheet_name)
+    positions = positions.sort_values().values
+    requests = [
+        {"deleteDimension": {"range": {"sheetId": grid_id, "dimension": "ROWS", "startIndex": first_row - 1 + positions[start], "endIndex": first_row + positions[end - 1]}}}
+        for (start, end) in reversed(runs(positions))
+    ]
+    response = spreadsheets.batchUpdate(spreadsheetId = sheet_id, body = {"requests": requests}).execute()
+    print("deleted", len(positions), "rows in", len(response.get("replies", requests)), "ranges")
+
+def rewrite(service, latest: pandas.DataFrame):
+    """ replaces every row of the sheet, clearing whatever was below the new last row """
+    values = service.spreadsheets().values()
+    values.clear(spreadsheetId = sheet_id, range = f"{sheet_name}!A{first_row}:E").execute()
+    for (i, batch) in enumerate(batches(latest)):
+        top = first_row + i * batch_rows
+        response = values.update(spreadsheetId = sheet_id, range = f"{sheet_name}!A{top}:E{top + len(batch) - 1}", valueInputOption = "USER_ENTERED", body = {"values": batch.values.tolist()}).execute()
+        print("response from sheets client", response)
+
+def upload_snapshot(bucket, rows: pandas.DataFrame):
+    """ records the sheet's rows; only called once the sheet has been updated, so a sync that fails is repeated by the next one """
+    with span("upload"):
+        upload_buffers(bucket, {snapshot_blob: (rows.to_csv(index = False), "text/csv")})
+
+@instrumented("sync_sheet")
+def sync_sheet(_, service = None):
+    # download csv and the last-synced snapshot from cloud storage
     print("downloading csv")
-    storage.Client()\
-        .bucket(bucket_name)\
-        .blob(blob_name)\
-        .download_to_filename(filename)
-    
-    # load csv 
+    bucket = get_bucket(bucket_name)
+    with span("download"):
+        stored = download_buffers(bucket, [blob_name, snapshot_blob], missing_ok = True)
+
+    # load csv
     print("loading csv")
-    df = pandas.read_csv(filename)
+    latest = read_rows(stored[blob_name])
+    synced = read_rows(stored[snapshot_blob]) if stored[snapshot_blob] is not None else None
 
-    # write values to sheet 
-    print("writing values to sheet")
-    values = [list(a) for a in df[["state", "date", "Rt", "Rt_upper", "Rt_lower"]].values] 
-    range_ = "Rt_timeseries_india!A2:E"
+    # delete rows that left the time series, then write only changed and new rows; without a usable snapshot,
+    # rewrite the sheet in full
+    service = service or sheets_service()
+    if synced is None or duplicated(synced) or duplicated(latest):
+        print(f"writing all {len(latest)} rows to sheet")
+        with span("write"):
+            rewrite(service, latest)
+        upload_snapshot(bucket, latest)
+        print("done")
+        return
 
-    credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/spreadsheets'])
-    service  = build('sheets', 'v4', credentials=credentials, cache_discovery = False)
-    response = service.spreadsheets().values()\
-        .update(
-            spreadsheetId=sheet_id, 
-            range=range_, 
-            valueInputOption='USER_ENTERED', 
-            body={"values":values})\
-        .execute()
-    print("response from sheets client", response)
+    gone = removed(synced, latest)
+    if len(gone):
+        print(f"deleting {len(gone)} rows no longer in the time series")
+        with span("delete"):
+            delete_rows(service, gone)
+        # the rows below have moved up, so this is recorded before any write that could fail
+        synced = synced.drop(gone).reset_index(drop = True)
+        upload_snapshot(bucket, synced)
+
+    changes = diff(synced, latest)
+    if len(changes):
+        print(f"writing {(changes.index < len(synced)).sum()} changed and {(changes.index >= len(synced)).sum()} new rows to sheet")
+        with span("write"):
+            push_changes(service, changes)
+        upload_snapshot(bucket, changes.combine_first(synced)[columns])
+    print("done")
@@ -0,0 +1,5 @@
+import os
+
+# the DAG files read these at import; tests that talk to the metadata server start their own and pass its address in
+os.environ.setdefault("GCF_URL",  "https://cloud-functions.invalid")
+os.environ.setdefault("METADATA", "http://metadata.invalid/computeMetadata/v1/instance/service-accounts/default/identity?audience=")
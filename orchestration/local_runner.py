@@ -0,0 +1,165 @@
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from priorities import (critical_path, expected_durations, priorities, read_history,
+                        update, write_history)
+from topology import build, dags, report_service, states
+
+# runs the Rt pipeline DAG on one machine: the same task graph as get_dag in rt_pipeline_dag.py (both are built by
+# topology.build), with each task calling its function's entry point directly in a local process instead of over HTTP,
+# and storage served by the local backend
+
+repo = Path(__file__).resolve().parent.parent
+
+# endpoint -> (function source directory, entry point); the report service's routes are dispatched through its Flask app
+functions = {
+    "STEP_0_RAW-get-state-case-timeseries":       ("pipeline/raw/get_state_timeseries",          "run_download"),
+    "STEP_0_RAW-get-vax-data":                    ("pipeline/raw/get_vax_data",                  "run_download"),
+    "STEP_1_EST-get-national-Rt":                 ("pipeline/est/natl_state_estimates",          "run_estimates"),
+    "STEP_1_EST-get-state-Rt":                    ("pipeline/est/state_district_estimates",      "run_estimates"),
+    "STEP_2_SIM-assemble-initial-conditions":     ("pipeline/est/simulation_initial_conditions", "assemble_data"),
+    "STEP_2_SIM-forward-simulation":              ("pipeline/sim/forward_simulation",            "run"),
+    "STEP_3_EXP-tweet-Rt-report":                 ("pipeline/exp/tweet_reports",                 "tweet_report"),
+    report_service:                               ("pipeline/rpt/get_twitter_images",            None),
+}
+
+class Request:
+    """ the parts of a flask request the Cloud Function entry points read """
+
+    def __init__(self, data: Optional[Dict] = None):
+        self.args = {}
+        self.data = data
+
+    def get_json(self):
+        return self.data
+
+class Task:
+    def __init__(self, task_id: str, endpoint: Optional[str], data: Optional[Dict] = None, route: Optional[str] = None):
+        self.task_id  = task_id
+        self.endpoint = endpoint
+        self.data     = data
+        self.route    = route
+        self.upstream = set()
+        self.status   = None
+        self.duration = None
+
+    def __rshift__(self, other):
+        for task in (other if isinstance(other, list) else [other]):
+            task.upstream.add(self.task_id)
+        return other
+
+    def __rrshift__(self, other):
+        for task in other:
+            self.upstream.add(task.task_id)
+        return self
+
+def get_tasks(report: bool, tweet: bool, shards: int = 0, states: List[str] = states) -> Dict[str, Task]:
+    """ the task graph built by get_dag in rt_pipeline_dag.py, keyed by task id """
+    tasks = {}
+    def task(task_id, endpoint, data = None, route = None, retries = 0):
+        tasks[task_id] = Task(task_id, endpoint, data, None if route is None else f"/{route}")
+        return tasks[task_id]
+
+    build(task, report, tweet, shards, states)
+    return tasks
+
+def call(endpoint: str, data: Optional[Dict], route: Optional[str]):
+    """ imports the function for `endpoint` as `main` (as Cloud Functions and the report container do) and calls its entry point """
+    (directory, entry_point) = functions[endpoint]
+    os.chdir(repo/directory)
+    sys.path.insert(0, str(repo/directory))
+    main = importlib.import_module("main")
+    if entry_point:
+        return getattr(main, entry_point)(Request(data))
+    with main.app.test_request_context(route):
+        response = main.app.dispatch_request()
+    if isinstance(response, tuple):
+        raise RuntimeError(f"{route} returned {response[1]}: {response[0]}")
+    return response
+
+def execute(task: Task) -> int:
+    """ runs one task in its own process, like a function instance; returns the exit code """
+    if task.endpoint is None:
+        return 0
+    return subprocess.run([sys.executable, __file__, "--call", task.endpoint, "--data", json.dumps(task.data), "--route", str(task.route)]).returncode
+
+def downstream_ids(tasks: Dict[str, Task]) -> Dict[str, set]:
+    downstream = {task_id: set() for task_id in tasks}
+    for task in tasks.values():
+        for task_id in task.upstream:
+            downstream[task_id].add(task.task_id)
+    return downstream
+
+def run(tasks: Dict[str, Task], parallelism: int, skip: Optional[List[str]] = None, history: Optional[Dict[str, float]] = None) -> Dict[str, Task]:
+    """ runs tasks as soon as all their upstream tasks succeed, at most `parallelism` at a time, starting those with the
+    longest remaining critical path (from `history`) first; tasks downstream of a failure are marked upstream_failed, as in Airflow """
+    history = {} if history is None else history
+    skip    = [] if skip is None else skip
+    weights = priorities(downstream_ids(tasks), history)
+    for task_id in skip:
+        tasks[task_id].status = "skipped"
+    pending = {task_id for (task_id, task) in tasks.items() if task.status is None}
+    running = {}
+    with ThreadPoolExecutor(max_workers = parallelism) as pool:
+        while pending or running:
+            for task_id in sorted(pending, key = lambda task_id: (-weights[task_id], task_id)):
+                upstream = [tasks[_].status for _ in tasks[task_id].upstream]
+                if any(status in ("failed", "upstream_failed") for status in upstream):
+                    tasks[task_id].status = "upstream_failed"
+                    pending.remove(task_id)
+                elif all(status in ("success", "skipped") for status in upstream) and len(running) < parallelism:
+                    print(f"[local_runner] starting {task_id}", flush = True)
+                    running[pool.submit(execute, tasks[task_id])] = (task_id, time.perf_counter())
+                    pending.remove(task_id)
+            if not running:
+                continue
+            (done, _) = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                (task_id, started) = running.pop(future)
+                tasks[task_id].duration = time.perf_counter() - started
+                tasks[task_id].status = "success" if future.result() == 0 else "failed"
+                print(f"[local_runner] {task_id}: {tasks[task_id].status} in {tasks[task_id].duration:.1f}s", flush = True)
+    return tasks
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "run the Rt pipeline DAG locally against the local storage backend")
+    parser.add_argument("--dag",         default = "Rt_pipeline_no_tweet", choices = list(dags))
+    parser.add_argument("--states",      nargs = "*", default = states)
+    parser.add_argument("--parallelism", type = int, default = os.cpu_count() or 1)
+    parser.add_argument("--skip",        nargs = "*", default = [], help = "tasks to treat as done, e.g. the downloads when the bucket already has raw data")
+    parser.add_argument("--root",        default = None, help = "directory holding one subdirectory per bucket (STORAGE_ROOT)")
+    parser.add_argument("--durations",   type = Path, default = None, help = "JSON file of task durations from previous runs, used to prioritize tasks and updated after this one")
+    parser.add_argument("--call",        help = argparse.SUPPRESS)
+    parser.add_argument("--data",        help = argparse.SUPPRESS)
+    parser.add_argument("--route",       help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.call:
+        call(args.call, json.loads(args.data), None if args.route == "None" else args.route)
+        sys.exit(0)
+
+    # every task process inherits the storage backend, and tweets are written locally unless TWITTER_BACKEND says otherwise
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ.setdefault("TWITTER_BACKEND", "local")
+    if args.root:
+        os.environ["STORAGE_ROOT"] = str(Path(args.root).resolve())
+    started = time.perf_counter()
+    history = read_history(args.durations) if args.durations else {}
+    tasks = run(get_tasks(states = args.states, **dags[args.dag]), args.parallelism, args.skip, history)
+    print(f"{args.dag}: {time.perf_counter() - started:.1f}s")
+    if args.durations:
+        history = update(history, {task.task_id: task.duration for task in tasks.values() if task.status == "success"})
+        write_history(args.durations, history)
+        (path, seconds) = critical_path(downstream_ids(tasks), expected_durations(tasks, history))
+        print(f"critical path ({seconds:.1f}s from recorded durations): " + " >> ".join(path))
+    for task in sorted(tasks.values(), key = lambda task: -(task.duration or 0)):
+        print(f"{task.task_id:<45} {task.status:<16} {task.duration or 0:>8.1f}s")
+    sys.exit(0 if all(task.status in ("success", "skipped") for task in tasks.values()) else 1)
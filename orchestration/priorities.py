@@ -0,0 +1,87 @@
+import json
+import math
+import os
+import re
+from statistics import median
+from typing import Dict, Iterable, List, Set, Tuple
+
+# task durations from previous runs, used to start the tasks on the longest remaining path first
+
+default_duration = 60.0 # seconds, for steps with no recorded runs at all
+smoothing        = 0.3  # weight of the latest run in each task's moving average
+
+def valid(history) -> Dict[str, float]:
+    """ the well-formed entries (task id -> non-negative seconds) of a recorded history; anything else is dropped, so a
+    missing or corrupted record falls back to default durations instead of failing the DAG """
+    if not isinstance(history, dict):
+        print(f"ignoring task duration history of type {type(history).__name__}")
+        return {}
+    kept = {
+        task_id: float(duration) for (task_id, duration) in history.items()
+        if isinstance(task_id, str) and isinstance(duration, (int, float)) and not isinstance(duration, bool) and math.isfinite(duration) and duration >= 0
+    }
+    if len(kept) < len(history):
+        print(f"ignoring {len(history) - len(kept)} malformed task durations")
+    return kept
+
+def read_history(path) -> Dict[str, float]:
+    """ recorded durations from a JSON file; empty if there is no file or it cannot be read """
+    try:
+        with open(path) as f:
+            return valid(json.load(f))
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"ignoring task duration history at {path}: {e}")
+        return {}
+
+def write_history(path, history: Dict[str, float]):
+    """ replaces the file in one step, so a reader never sees it half written """
+    staging = f"{path}.{os.getpid()}.tmp"
+    with open(staging, "w") as f:
+        json.dump(history, f, indent = 2)
+    os.replace(staging, path)
+
+def step(task_id: str) -> str:
+    """ task id without its state or shard suffix, e.g. epi_step_KA -> epi_step """
+    return re.sub(r"_(batch_\d+|[A-Z]+)$", "", task_id)
+
+def expected_durations(task_ids: Iterable[str], history: Dict[str, float]) -> Dict[str, float]:
+    """ each task's recorded duration; tasks never run take the median of their step's recorded durations """
+    by_step = {}
+    for (task_id, duration) in history.items():
+        by_step.setdefault(step(task_id), []).append(duration)
+    return {task_id: history.get(task_id, median(by_step.get(step(task_id), [default_duration]))) for task_id in task_ids}
+
+def update(history: Dict[str, float], observed: Dict[str, float]) -> Dict[str, float]:
+    """ exponentially weighted moving average of each task's duration """
+    return {**history, **{
+        task_id: duration if task_id not in history else smoothing * duration + (1 - smoothing) * history[task_id]
+        for (task_id, duration) in observed.items()
+    }}
+
+def remaining(downstream: Dict[str, Set[str]], durations: Dict[str, float]) -> Dict[str, float]:
+    """ length of the longest path from each task to the end of the DAG, counting the task itself """
+    lengths = {}
+    def visit(task_id):
+        if task_id not in lengths:
+            lengths[task_id] = durations[task_id] + max((visit(_) for _ in downstream[task_id]), default = 0)
+        return lengths[task_id]
+    for task_id in downstream:
+        visit(task_id)
+    return lengths
+
+def critical_path(downstream: Dict[str, Set[str]], durations: Dict[str, float]) -> Tuple[List[str], float]:
+    """ the chain of tasks that bounds the DAG's run time, and its expected length in seconds """
+    lengths  = remaining(downstream, durations)
+    upstream = {task_id for children in downstream.values() for task_id in children}
+    if not lengths:
+        return ([], 0.0)
+    path = [max((task_id for task_id in downstream if task_id not in upstream), key = lengths.get)]
+    while downstream[path[-1]]:
+        path.append(max(downstream[path[-1]], key = lengths.get))
+    return (path, lengths[path[0]])
+
+def priorities(downstream: Dict[str, Set[str]], history: Dict[str, float]) -> Dict[str, int]:
+    """ priority weights, in seconds of remaining critical path, so the scheduler starts the longest chains first """
+    return {task_id: max(1, int(round(length))) for (task_id, length) in remaining(downstream, expected_durations(downstream, history)).items()}
@@ -1,55 +1,123 @@
+import base64
 import datetime
+import fcntl
 import json
 import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 
 import requests
+from requests.adapters import HTTPAdapter
 from airflow import models
+from airflow.models import Variable
 from airflow.models.connection import Connection
 from airflow.hooks.http_hook import HttpHook
 from airflow.operators.http_operator import SimpleHttpOperator
 from airflow.operators.dummy_operator import DummyOperator
+from airflow.operators.python_operator import PythonOperator
+from airflow.utils.weight_rule import WeightRule
+
+from priorities import (critical_path, expected_durations, priorities, read_history,
+                        update, valid, write_history)
+from topology import build, dags
 
 AUDIENCE_ROOT = os.environ["GCF_URL"]
 METADATA_ROOT = os.environ["METADATA"]
-
-states = [
-    'AN',
-    'AP',
-    'AR',
-    'AS',
-    'BR',
-    'CH',
-    'CT',
-    'DL',
-    'DNDD',
-    'GA',
-    'GJ',
-    'HP',
-    'HR',
-    'JH',
-    'JK',
-    'KA',
-    'KL',
-    'LA',
-    'LD',
-    'MH',
-    'ML',
-    'MN',
-    'MP',
-    'MZ',
-    'NL',
-    'OR',
-    'PB',
-    'PY',
-    'RJ',
-    'SK',
-    'TG',
-    'TN',
-    'TR',
-    'UP',
-    'UT',
-    'WB'
-]
+TOKEN_CACHE   = os.environ.get("TOKEN_CACHE", os.path.join(tempfile.gettempdir(), "pipeline_identity_tokens.json"))
+
+# per-state tasks draw from one pool, sized to the concurrency budget; within it, tasks heading the longest remaining
+# chain of recorded durations (kept in an Airflow Variable, updated at the end of each run) are started first. parsing
+# this file must not query the metadata database, so the scheduler reads a copy of the durations from DURATIONS_PATH,
+# which the final task of each run rewrites; it has to be shared by the workers and the scheduler (in Cloud Composer,
+# somewhere under /home/airflow/gcs/data)
+FANOUT_POOL        = os.environ.get("FANOUT_POOL", "default_pool")
+DURATIONS_VARIABLE = "Rt_pipeline_task_durations"
+DURATIONS_PATH     = os.environ.get("DURATIONS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "task_durations.json"))
+
+# one connection pool shared by every operator (and the token cache) in this process
+adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = 32)
+session = requests.Session()
+session.mount("http://",  adapter)
+session.mount("https://", adapter)
+
+def token_expiry(token: str, default_ttl: float) -> float:
+    """ expiry timestamp from the JWT `exp` claim, or `default_ttl` seconds from now if the token cannot be decoded """
+    try:
+        payload = token.split(".")[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_ttl
+
+class TokenCache:
+    """ identity tokens keyed by audience, shared between threads in memory and between task processes through a locked file """
+
+    def __init__(self, metadata_root: str, path: str, refresh_margin: float = 300, default_ttl: float = 600):
+        self.metadata_root  = metadata_root
+        self.path           = path
+        self.refresh_margin = refresh_margin
+        self.default_ttl    = default_ttl
+        self.tokens         = {}
+        self.locks          = {}
+        self.lock           = threading.Lock()
+
+    def fresh(self, entry) -> bool:
+        return entry is not None and entry[1] - self.refresh_margin > time.time()
+
+    def fetch(self, audience: str) -> str:
+        response = session.get(f"{self.metadata_root}{audience}", headers = {"Metadata-Flavor": "Google"}, timeout = 30)
+        response.raise_for_status()
+        return response.text
+
+    def audience_lock(self, audience: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(audience, threading.Lock())
+
+    @contextmanager
+    def shared(self):
+        """ the token file, locked against other task processes only while it is read or written """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(os.dup(fd), "r+") as cache:
+                try:
+                    tokens = {k: tuple(v) for (k, v) in json.load(cache).items()}
+                except ValueError:
+                    tokens = {}
+                yield (cache, tokens)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def get(self, audience: str) -> str:
+        # threads wanting the same audience wait for one fetch; other audiences are not held up by it
+        with self.audience_lock(audience):
+            if not self.fresh(self.tokens.get(audience)):
+                with self.shared() as (_, tokens):
+                    entry = tokens.get(audience)
+                if not self.fresh(entry):
+                    token = self.fetch(audience)
+                    entry = (token, token_expiry(token, self.default_ttl))
+                    with self.shared() as (cache, tokens):
+                        tokens = {k: v for (k, v) in tokens.items() if v[1] > time.time()}
+                        tokens[audience] = entry
+                        cache.seek(0)
+                        cache.truncate()
+                        json.dump(tokens, cache)
+                self.tokens[audience] = entry
+            return self.tokens[audience][0]
+
+tokens = TokenCache(METADATA_ROOT, TOKEN_CACHE)
+
+class PooledHttpHook(HttpHook):
+    """ HttpHook whose sessions send through the shared connection pool instead of opening new connections """
+    def get_conn(self, headers = None):
+        conn_session = super(PooledHttpHook, self).get_conn(headers)
+        conn_session.mount("http://",  adapter)
+        conn_session.mount("https://", adapter)
+        return conn_session
 
 # cloud compute operators; see references
 # 1) https://github.com/salrashid123/composer_gcf
@@ -59,12 +127,12 @@ class CloudFunction(SimpleHttpOperator):
     ui_color   = "#2B6CE6"
     ui_fgcolor = "#FFFFFF"
 
-    def get_metadata_url(self):
-        return f"{METADATA_ROOT}{AUDIENCE_ROOT}/{self.endpoint}"
+    def get_audience(self):
+        return f"{AUDIENCE_ROOT}/{self.endpoint}"
     
     def execute(self, context):
-        token = requests.get(self.get_metadata_url(), headers = {"Metadata-Flavor": "Google"}).text
-        HttpHook(self.method, http_conn_id = self.http_conn_id)\
+        token = tokens.get(self.get_audience())
+        PooledHttpHook(self.method, http_conn_id = self.http_conn_id)\
             .run(self.endpoint, self.data, {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}, self.extra_options)
 
 class CloudRun(CloudFunction):
@@ -81,98 +149,97 @@ class CloudRun(CloudFunction):
         super(CloudRun, self).__init__(*args, **kwargs)
         self.run_url = run_url
 
-    def get_metadata_url(self):
-        return f"{METADATA_ROOT}https://{self.run_url}"
-
-def epi_step(state):
+    def get_audience(self):
+        return f"https://{self.run_url}"
+
+def operator(task_id: str, endpoint, data = None, route = None, retries: int = 0):
+    """ a task in the topology.py task graph: the report service's routes run on Cloud Run, and every other step is a
+    Cloud Function called with its request body """
+    if endpoint is None:
+        return DummyOperator(task_id = task_id, start_date = datetime.datetime(2021, 4, 29))
+    if route is not None:
+        return CloudRun(
+            task_id      = task_id,
+            method       = "GET",
+            endpoint     = route,
+            start_date   = datetime.datetime(2021, 4, 29),
+            run_url      = "get-twitter-images-sipjq3uhla-uc.a.run.app",
+            conn_id      = "cloud_run_create_report",
+            retries      = retries
+        )
     return CloudFunction(
-        task_id      = f"epi_step_{state}",
+        task_id      = task_id,
         method       = "POST",
-        endpoint     = "STEP_1_EST-get-state-Rt",
+        endpoint     = endpoint,
         start_date   = datetime.datetime(2021, 4, 29),
         http_conn_id = "cloud_functions",
-        data         = json.dumps({"state_code": state})
-    )
-
-def create_Rt_report(state):
-    return CloudRun(
-        task_id      = f"create_report_{state}",
-        method       = "GET",
-        endpoint     = f"state/{state}",
-        start_date   = datetime.datetime(2021, 4, 29),
-        run_url      = "get-twitter-images-sipjq3uhla-uc.a.run.app",
-        conn_id      = "cloud_run_create_report",
-        retries      = 3
+        data         = json.dumps(data) if data is not None else None,
+        retries      = retries
     )
 
-def tweet_Rt_report(state):
-    return CloudFunction(
-        task_id      = f"tweet_report_{state}",
-        method       = "POST",
-        endpoint     = "STEP_3_EXP-tweet-Rt-report",
-        start_date   = datetime.datetime(2021, 4, 29),
-        http_conn_id = "cloud_functions",
-        data         = json.dumps({"state_code": state}),
-        retries      = 3
+def downstream_ids(dag: models.DAG):
+    return {task.task_id: set(task.downstream_task_ids) for task in dag.tasks}
+
+def describe(path, seconds: float) -> str:
+    return f"critical path ({seconds/60:.1f} min from recorded durations): " + " >> ".join(path)
+
+def record_durations(**context):
+    """ folds this run's task durations into the recorded history, and records the DAG's critical path under them """
+    dag = context["dag"]
+    observed = {
+        ti.task_id: ti.duration for ti in context["dag_run"].get_task_instances()
+        if ti.state == "success" and ti.duration is not None and ti.task_id != "record_durations"
+    }
+    try:
+        recorded = valid(Variable.get(DURATIONS_VARIABLE, default_var = {}, deserialize_json = True))
+    except ValueError as e:
+        print(f"ignoring unreadable {DURATIONS_VARIABLE}: {e}")
+        recorded = {}
+    history = update(recorded, observed)
+    Variable.set(DURATIONS_VARIABLE, history, serialize_json = True)
+    write_history(DURATIONS_PATH, history)
+
+    tasks = {task_id: children - {"record_durations"} for (task_id, children) in downstream_ids(dag).items() if task_id != "record_durations"}
+    (path, seconds) = critical_path(tasks, expected_durations(tasks, history))
+    Variable.set(f"{dag.dag_id}_critical_path", {"tasks": path, "seconds": seconds}, serialize_json = True)
+    print(f"recorded {len(observed)} task durations; {describe(path, seconds)}")
+
+def prioritize(dag: models.DAG, fanout: DummyOperator, history):
+    """ sets each task's priority to its remaining critical path, puts the per-state tasks in the fan-out pool,
+    and adds a final task that records this run's durations """
+    history = valid(history)
+    tasks   = downstream_ids(dag)
+    weights = priorities(tasks, history)
+    per_state = fanout.get_flat_relative_ids(upstream = False)
+    for task in dag.tasks:
+        task.priority_weight = weights[task.task_id]
+        task.weight_rule     = WeightRule.ABSOLUTE
+        if task.task_id in per_state:
+            task.pool = FANOUT_POOL
+    dag.doc_md = describe(*critical_path(tasks, expected_durations(tasks, history)))
+
+    last = [task for task in dag.tasks if not task.downstream_task_ids]
+    last >> PythonOperator(
+        task_id         = "record_durations",
+        python_callable = record_durations,
+        provide_context = True,
+        trigger_rule    = "all_done",
+        start_date      = datetime.datetime(2021, 4, 29)
     )
 
-def simulation_initial_conditions(state):
-    return CloudFunction(
-        task_id      = f"simulation_initial_conditions_{state}",
-        method       = "POST",
-        endpoint     = "STEP_2_SIM-assemble-initial-conditions",
-        start_date   = datetime.datetime(2021, 4, 29),
-        http_conn_id = "cloud_functions",
-        data         = json.dumps({"state_code": state}),
-        retries      = 3
-    )
-
-def simulation_step(state):
-    return DummyOperator(task_id = f"simulation_step_{state}",
-    start_date   = datetime.datetime(2021, 4, 29))
-    # return CloudFunction(
-    #     task_id      = f"simulation_step_{state}",
-    #     method       = "POST",
-    #     endpoint     = "STEP_3_EXP-tweet-Rt-report",
-    #     start_date   = datetime.datetime(2021, 4, 29),
-    #     http_conn_id = "cloud_functions",
-    #     data         = json.dumps({"state_code": state}),
-    #     retries      = 3
-    # )
-
-def get_dag(name: str, report: bool, tweet: bool) -> models.DAG:
+def get_dag(name: str, report: bool, tweet: bool, shards: int = 0, history = None) -> models.DAG:
+    history = {} if history is None else history
     with models.DAG(name, schedule_interval = "45 8 * * *" if tweet else None, catchup = False) as dag:
-        get_timeseries = CloudFunction(
-            task_id      = "get_timeseries",
-            method       = "POST",
-            endpoint     = "STEP_0_RAW-get-state-case-timeseries",
-            start_date   = datetime.datetime(2021, 4, 29),
-            http_conn_id = "cloud_functions"
-        )
-
-        get_vax_data = CloudFunction(
-            task_id      = "get_vax_data",
-            method       = "POST",
-            endpoint     = "STEP_0_RAW-get-vax-data",
-            start_date   = datetime.datetime(2021, 4, 29),
-            http_conn_id = "cloud_functions"
-        )
-
-        fanout = DummyOperator(task_id = "fanout", start_date = datetime.datetime(2021, 4, 29))
-
-        [get_timeseries, get_vax_data] >> fanout
-
-        for state in states:
-            epi_step_for_state = epi_step(state)
-            if report:
-                report_step_for_state = create_Rt_report(state)
-                epi_step_for_state >> report_step_for_state
-                if tweet:
-                    report_step_for_state >> tweet_Rt_report(state)
-            fanout >> epi_step_for_state >> simulation_initial_conditions(state) >> simulation_step(state)
-           
-        return dag 
-
-rt_pipeline          = get_dag("Rt_pipeline",           report = True,  tweet = True)
-rt_pipeline_no_tweet = get_dag("Rt_pipeline_no_tweet",  report = True,  tweet = False)
-rt_pipeline_no_rpt   = get_dag("Rt_pipeline_no_report", report = False, tweet = False)
\ No newline at end of file
+        fanout = build(operator, report, tweet, shards)
+        prioritize(dag, fanout, history)
+        return dag
+
+# read from the file once per parse, without touching the metadata database; tasks never run fall back to their
+# step's median duration, and every task to the default duration if there is no usable history
+durations = read_history(DURATIONS_PATH)
+
+# see topology.dags; the daily runs send one request per shard of states, and the per-state DAG is for reruns
+rt_pipeline           = get_dag("Rt_pipeline",           history = durations, **dags["Rt_pipeline"])
+rt_pipeline_no_tweet  = get_dag("Rt_pipeline_no_tweet",  history = durations, **dags["Rt_pipeline_no_tweet"])
+rt_pipeline_no_rpt    = get_dag("Rt_pipeline_no_report", history = durations, **dags["Rt_pipeline_no_report"])
+rt_pipeline_per_state = get_dag("Rt_pipeline_per_state", history = durations, **dags["Rt_pipeline_per_state"])
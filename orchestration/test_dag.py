@@ -1,5 +1,12 @@
+import base64
 import datetime
+import json
 import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
 import requests
 from airflow import models
@@ -26,3 +33,168 @@ with models.DAG("single_step", schedule_interval = datetime.timedelta(days = 1),
         start_date   = datetime.datetime(2021, 4, 29),
         http_conn_id = "cloud_functions"
     )
+
+
+# pytest checks for the helpers in rt_pipeline_dag.py
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    """ the metadata server's identity endpoint: a token expiring `ttl` seconds out, after `delays[audience]` seconds """
+    def do_GET(self):
+        audience = parse_qs(urlparse(self.path).query)["audience"][0]
+        with self.server.lock:
+            self.server.requests[audience] = self.server.requests.get(audience, 0) + 1
+        time.sleep(self.server.delays.get(audience, 0))
+        claims  = base64.urlsafe_b64encode(json.dumps({"aud": audience, "exp": time.time() + self.server.ttl}).encode()).decode().rstrip("=")
+        token   = f"header.{claims}.signature".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(token)))
+        self.end_headers()
+        self.wfile.write(token)
+
+    def log_message(self, *args):
+        pass
+
+@contextmanager
+def metadata_server(ttl: float = 3600, delays = {}):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MetadataHandler)
+    (server.ttl, server.delays, server.requests, server.lock) = (ttl, delays, {}, threading.Lock())
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    try:
+        yield (server, f"http://127.0.0.1:{server.server_address[1]}/identity?audience=")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_token_cache_fetches_once_per_audience(tmp_path):
+    from rt_pipeline_dag import TokenCache
+    audiences = ["https://functions/STEP_1_EST-get-state-Rt", "https://functions/STEP_2_SIM-forward-simulation"]
+    with metadata_server(delays = {audience: 0.2 for audience in audiences}) as (server, root):
+        cache = TokenCache(root, str(tmp_path/"tokens.json"))
+        threads = [threading.Thread(target = cache.get, args = (audience,)) for audience in audiences for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # another task process reads the tokens from the shared file
+        other = TokenCache(root, str(tmp_path/"tokens.json"))
+        assert [other.get(audience) for audience in audiences] == [cache.get(audience) for audience in audiences]
+        assert server.requests == {audience: 1 for audience in audiences}
+
+def test_token_cache_refetches_near_expiry(tmp_path, monkeypatch):
+    from rt_pipeline_dag import TokenCache
+    audience = "https://functions/STEP_1_EST-get-state-Rt"
+    with metadata_server(ttl = 3600) as (server, root):
+        cache = TokenCache(root, str(tmp_path/"tokens.json"), refresh_margin = 300)
+        first = cache.get(audience)
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 3000)
+        assert cache.get(audience) == first
+        assert server.requests[audience] == 1
+        monkeypatch.setattr(time, "time", lambda: now + 3400)
+        assert cache.get(audience) != first
+        assert server.requests[audience] == 2
+
+def test_token_cache_slow_fetch_does_not_block_other_audiences(tmp_path):
+    from rt_pipeline_dag import TokenCache
+    (slow, fast) = ("https://functions/slow", "https://functions/fast")
+    with metadata_server(delays = {slow: 1.0}) as (server, root):
+        cache = TokenCache(root, str(tmp_path/"tokens.json"))
+        thread = threading.Thread(target = cache.get, args = (slow,))
+        thread.start()
+        time.sleep(0.1)
+        start = time.time()
+        cache.get(fast)
+        assert time.time() - start < 0.5
+        thread.join()
+
+def load_dag_file(monkeypatch, durations_path):
+    """ a fresh parse of rt_pipeline_dag.py, failing if it reads an Airflow Variable """
+    import importlib.util
+    from airflow.models import Variable
+    def get(*args, **kwargs):
+        raise AssertionError("Variable read while parsing the DAG file")
+    monkeypatch.setattr(Variable, "get", get)
+    monkeypatch.setenv("DURATIONS_PATH", str(durations_path))
+    spec = importlib.util.spec_from_file_location("parsed_rt_pipeline_dag", os.path.join(os.path.dirname(__file__), "rt_pipeline_dag.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_dag_file_prioritizes_from_recorded_durations_without_variables(tmp_path, monkeypatch):
+    (tmp_path/"durations.json").write_text(json.dumps({"epi_step_batch_1": 1800, "epi_step_batch_3": 600}))
+    parsed = load_dag_file(monkeypatch, tmp_path/"durations.json")
+    weights = {task.task_id: task.priority_weight for task in parsed.rt_pipeline.tasks}
+    # shards never run take the median of the recorded epi_step durations
+    assert weights["epi_step_batch_1"] > weights["epi_step_batch_0"] > weights["epi_step_batch_3"]
+    assert parsed.rt_pipeline.doc_md.startswith("critical path")
+
+def test_dag_file_falls_back_on_missing_or_malformed_durations(tmp_path, monkeypatch):
+    for contents in [None, "{not json", json.dumps(["epi_step_MH", 1800]), json.dumps({"epi_step_MH": "slow", "epi_step_KA": None})]:
+        if contents is not None:
+            (tmp_path/"durations.json").write_text(contents)
+        parsed = load_dag_file(monkeypatch, tmp_path/"durations.json")
+        weights = {task.task_id: task.priority_weight for task in parsed.rt_pipeline.tasks if task.task_id.startswith("epi_step_")}
+        assert len(set(weights.values())) == 1
+
+def test_prioritize_keeps_well_formed_durations():
+    from rt_pipeline_dag import get_dag
+    dag = get_dag("malformed_history", report = False, tweet = False, history = {"epi_step_MH": "slow", "epi_step_KA": 600, "epi_step_UP": 1200, "epi_step_BR": -5})
+    weights = {task.task_id: task.priority_weight for task in dag.tasks}
+    assert weights["epi_step_UP"] > weights["epi_step_MH"] == weights["epi_step_BR"] > weights["epi_step_KA"]
+
+def test_record_durations_updates_variable_and_file(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from airflow.models import Variable
+    import rt_pipeline_dag
+    store = {rt_pipeline_dag.DURATIONS_VARIABLE: "{corrupted"}
+    def get(key, default_var = None, deserialize_json = False):
+        return json.loads(store[key]) if key in store else default_var
+    def set(key, value, serialize_json = False):
+        store[key] = json.dumps(value) if serialize_json else value
+    monkeypatch.setattr(Variable, "get", get)
+    monkeypatch.setattr(Variable, "set", set)
+    monkeypatch.setattr(rt_pipeline_dag, "DURATIONS_PATH", str(tmp_path/"durations.json"))
+
+    dag = rt_pipeline_dag.get_dag("record_durations_test", report = False, tweet = False)
+    instances = [SimpleNamespace(task_id = task_id, state = "success", duration = duration) for (task_id, duration) in [("epi_step_MH", 900.0), ("epi_step_KA", 300.0)]]
+    rt_pipeline_dag.record_durations(dag = dag, dag_run = SimpleNamespace(get_task_instances = lambda: instances))
+    assert json.loads(store[rt_pipeline_dag.DURATIONS_VARIABLE]) == {"epi_step_MH": 900.0, "epi_step_KA": 300.0}
+    assert json.loads((tmp_path/"durations.json").read_text()) == {"epi_step_MH": 900.0, "epi_step_KA": 300.0}
+    assert json.loads(store["record_durations_test_critical_path"])["tasks"][:3] == ["get_timeseries", "natl_estimates", "fanout"]
+
+def test_hierarchical_estimates_run_before_every_epi_step():
+    import local_runner
+    import rt_pipeline_dag
+    for dag in [rt_pipeline_dag.rt_pipeline, rt_pipeline_dag.rt_pipeline_per_state]:
+        natl_estimates = dag.task_dict["natl_estimates"]
+        assert natl_estimates.endpoint in local_runner.functions
+        assert natl_estimates.upstream_task_ids == {"get_timeseries"}
+        assert json.loads(natl_estimates.data) == {"incremental": True}
+        downstream = natl_estimates.get_flat_relative_ids(upstream = False)
+        assert {task.task_id for task in dag.tasks if task.task_id.startswith("epi_step")} <= downstream
+
+def test_scheduled_dag_sends_one_request_per_shard():
+    import rt_pipeline_dag
+    import topology
+    dag = rt_pipeline_dag.rt_pipeline
+    for step in ["epi_step", "simulation_initial_conditions", "simulation_step", "tweet_report"]:
+        tasks = [task for task in dag.tasks if task.task_id.startswith(f"{step}_")]
+        assert [task.task_id for task in tasks] == [f"{step}_batch_{i}" for i in range(topology.SHARDS)]
+        assert sorted(state for task in tasks for state in json.loads(task.data)["state_codes"]) == sorted(topology.states)
+    reports = [task for task in dag.tasks if task.task_id.startswith("create_report_")]
+    assert [task.task_id for task in reports] == [f"create_report_batch_{i}" for i in range(topology.SHARDS)]
+
+def test_local_runner_builds_the_same_task_graph():
+    import local_runner
+    import rt_pipeline_dag
+    from topology import dags
+    parsed = {dag.dag_id: dag for dag in [rt_pipeline_dag.rt_pipeline, rt_pipeline_dag.rt_pipeline_no_tweet, rt_pipeline_dag.rt_pipeline_no_rpt, rt_pipeline_dag.rt_pipeline_per_state]}
+    assert set(parsed) == set(dags)
+    for (name, arguments) in dags.items():
+        tasks = local_runner.get_tasks(**arguments)
+        assert {task.task_id: task.upstream_task_ids for task in parsed[name].tasks if task.task_id != "record_durations"} == {task_id: task.upstream for (task_id, task) in tasks.items()}
+        for task in parsed[name].tasks:
+            if isinstance(task, rt_pipeline_dag.CloudRun):
+                assert f"/{task.endpoint}" == tasks[task.task_id].route
+            elif isinstance(task, rt_pipeline_dag.CloudFunction):
+                assert (task.endpoint, json.loads(task.data) if task.data else None) == (tasks[task.task_id].endpoint, tasks[task.task_id].data)
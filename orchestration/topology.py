@@ -0,0 +1,106 @@
+import os
+from typing import Callable, List
+
+# the Rt pipeline's task graph, built once here for both the Airflow DAGs (rt_pipeline_dag.py) and local_runner.py; each
+# builds its own kind of task from the ids, endpoints and request bodies below, and both kinds are chained with >>
+
+states = [
+    'AN',
+    'AP',
+    'AR',
+    'AS',
+    'BR',
+    'CH',
+    'CT',
+    'DL',
+    'DNDD',
+    'GA',
+    'GJ',
+    'HP',
+    'HR',
+    'JH',
+    'JK',
+    'KA',
+    'KL',
+    'LA',
+    'LD',
+    'MH',
+    'ML',
+    'MN',
+    'MP',
+    'MZ',
+    'NL',
+    'OR',
+    'PB',
+    'PY',
+    'RJ',
+    'SK',
+    'TG',
+    'TN',
+    'TR',
+    'UP',
+    'UT',
+    'WB'
+]
+
+# requests per step in the daily DAGs; each carries a round-robin share of the states
+SHARDS = int(os.environ.get("SHARDS", 4))
+
+# DAG name -> get_dag arguments; the daily runs send one pooled request per shard of states at each step, and the
+# per-state DAG is kept for rerunning individual states
+dags = {
+    "Rt_pipeline":           dict(report = True,  tweet = True,  shards = SHARDS),
+    "Rt_pipeline_no_tweet":  dict(report = True,  tweet = False, shards = SHARDS),
+    "Rt_pipeline_no_report": dict(report = False, tweet = False, shards = SHARDS),
+    "Rt_pipeline_per_state": dict(report = True,  tweet = False),
+}
+
+# the report service is a Cloud Run container rather than a function; its tasks carry a route instead of a request body
+report_service = "get-twitter-images"
+
+def shard(states, n: int):
+    """ round-robin split, so the largest states are not all in the same shard """
+    return [states[i::n] for i in range(n)]
+
+def build(task: Callable, report: bool, tweet: bool, shards: int = 0, states: List[str] = states):
+    """ makes every task with `task(task_id, endpoint, data = None, route = None, retries = 0)` (endpoint None for the
+    no-op fan-out) and chains them; returns the fan-out task, upstream of every per-state task """
+    get_timeseries = task("get_timeseries", "STEP_0_RAW-get-state-case-timeseries")
+    get_vax_data   = task("get_vax_data",   "STEP_0_RAW-get-vax-data")
+
+    # every district, state and the country are estimated in one run, rolled forward from the last run's posteriors;
+    # the per-state epi steps publish its results
+    natl_estimates = task("natl_estimates", "STEP_1_EST-get-national-Rt", {"incremental": True})
+
+    fanout = task("fanout", None)
+
+    get_timeseries >> natl_estimates
+    [natl_estimates, get_vax_data] >> fanout
+
+    if shards:
+        # one pooled request per shard instead of one request per state; with fewer states than shards (e.g. a local
+        # run on a few states), empty shards are dropped
+        for (i, shard_states) in enumerate(shard(states, min(shards, len(states)))):
+            epi_step_for_shard = task(f"epi_step_batch_{i}", "STEP_1_EST-get-state-Rt", {"state_codes": shard_states})
+            initial_conditions_for_shard = task(f"simulation_initial_conditions_batch_{i}", "STEP_2_SIM-assemble-initial-conditions", {"state_codes": shard_states}, retries = 3)
+            fanout >> epi_step_for_shard >> initial_conditions_for_shard
+            if report:
+                # the report service renders a whole shard in one request across its render pool
+                report_step_for_shard = task(f"create_report_batch_{i}", report_service, route = f"batch?state_codes={','.join(shard_states)}", retries = 3)
+                epi_step_for_shard >> report_step_for_shard
+                if tweet:
+                    # one authenticated client posts the whole shard, spacing out the tweets
+                    report_step_for_shard >> task(f"tweet_report_batch_{i}", "STEP_3_EXP-tweet-Rt-report", {"state_codes": shard_states}, retries = 3)
+            initial_conditions_for_shard >> task(f"simulation_step_batch_{i}", "STEP_2_SIM-forward-simulation", {"state_codes": shard_states}, retries = 3)
+    else:
+        for state in states:
+            epi_step_for_state = task(f"epi_step_{state}", "STEP_1_EST-get-state-Rt", {"state_code": state})
+            if report:
+                report_step_for_state = task(f"create_report_{state}", report_service, route = f"state/{state}", retries = 3)
+                epi_step_for_state >> report_step_for_state
+                if tweet:
+                    report_step_for_state >> task(f"tweet_report_{state}", "STEP_3_EXP-tweet-Rt-report", {"state_code": state}, retries = 3)
+            fanout >> epi_step_for_state \
+                >> task(f"simulation_initial_conditions_{state}", "STEP_2_SIM-assemble-initial-conditions", {"state_code": state}, retries = 3) \
+                >> task(f"simulation_step_{state}", "STEP_2_SIM-forward-simulation", {"state_code": state}, retries = 3)
+    return fanout
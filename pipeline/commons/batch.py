@@ -0,0 +1,54 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+# inputs shared by every state in a batch; loaded once by the parent process and copied into each worker
+shared = {}
+
+def get(request, key):
+    request_json = request.get_json()
+    if request.args and key in request.args:
+        return request.args.get(key)
+    elif request_json and key in request_json:
+        return request_json[key]
+    else:
+        return None
+
+def get_state_codes(request) -> List[str]:
+    """ a batch of `state_codes` (a JSON list, or comma-separated in the query string), or a single `state_code` """
+    state_codes = get(request, 'state_codes') or [get(request, 'state_code')]
+    if isinstance(state_codes, str):
+        state_codes = state_codes.split(",")
+    return state_codes
+
+def init_worker(inputs: Dict):
+    shared.clear()
+    shared.update(inputs)
+
+def run_batch(process: Callable, jobs: Dict[str, tuple], inputs: Dict, max_workers: Optional[int] = None) -> List[str]:
+    """ runs process(state_code, *args) for each job, across a process pool if there is more than one; returns the states that failed """
+    init_worker(inputs)
+    failed = []
+    if len(jobs) <= 1:
+        for (state_code, args) in jobs.items():
+            try:
+                process(state_code, *args)
+            except Exception as e:
+                print(f"ERROR when processing {state_code}", e)
+                traceback.print_exc()
+                failed.append(state_code)
+        return failed
+
+    workers = min(len(jobs), max_workers or os.cpu_count() or 1)
+    print(f"Processing {len(jobs)} states across {workers} workers.")
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (inputs,)) as pool:
+        futures = {pool.submit(process, state_code, *args): state_code for (state_code, args) in jobs.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"ERROR when processing {futures[future]}", e)
+                traceback.print_exc()
+                failed.append(futures[future])
+    return failed
@@ -0,0 +1,184 @@
+import base64
+import datetime
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from instrumentation import add_bytes
+
+# concurrent transfers per call; blob I/O is network-bound, so threads are enough
+max_workers = 8
+
+# one storage client per process, since clients should not be shared across a fork
+clients = {}
+
+# STORAGE_BACKEND=local serves every bucket from a directory of the same name under STORAGE_ROOT, e.g. to run the pipeline on one machine
+storage_backend = os.environ.get("STORAGE_BACKEND", "gcs")
+storage_root    = os.environ.get("STORAGE_ROOT", os.path.join(tempfile.gettempdir(), "buckets"))
+
+def get_bucket(name: str):
+    """ bucket handle from the configured storage backend; Cloud Storage handles reuse this process's client """
+    if storage_backend == "local":
+        return LocalBucket(Path(storage_root) / name, name)
+    from google.cloud import storage
+    pid = os.getpid()
+    if pid not in clients:
+        clients[pid] = storage.Client()
+    return clients[pid].bucket(name)
+
+def md5_hash(data: bytes) -> str:
+    """ base64-encoded MD5, the format Cloud Storage reports as a blob's md5_hash """
+    return base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
+
+def map_concurrently(function: Callable, items: Iterable, workers: int = max_workers) -> List:
+    """ applies `function` to each item on a thread pool, preserving order; the first exception is re-raised """
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers = min(workers, len(items))) as pool:
+        return list(pool.map(function, items))
+
+def download_many(bucket, targets: Dict[str, Union[str, Path]], workers: int = max_workers) -> Dict[str, Union[str, Path]]:
+    """ downloads each blob name to its local filename concurrently """
+    def fetch(item):
+        (blob_name, filename) = item
+        bucket.blob(blob_name).download_to_filename(str(filename))
+        add_bytes(received = os.path.getsize(filename))
+    map_concurrently(fetch, targets.items(), workers)
+    return targets
+
+def download_buffers(bucket, blob_names: Iterable[str], missing_ok: bool = False, workers: int = max_workers) -> Dict[str, Optional[io.BytesIO]]:
+    """ downloads blobs concurrently into memory; with `missing_ok`, absent blobs map to None instead of raising """
+    def fetch(blob_name: str) -> Optional[io.BytesIO]:
+        blob = bucket.get_blob(blob_name) if missing_ok else bucket.blob(blob_name)
+        if blob is None:
+            return None
+        data = blob.download_as_string()
+        add_bytes(received = len(data))
+        return io.BytesIO(data)
+    blob_names = list(blob_names)
+    return dict(zip(blob_names, map_concurrently(fetch, blob_names, workers)))
+
+def upload_many(bucket, sources: Dict[str, Tuple[Union[str, Path], str]], workers: int = max_workers, verify: bool = False):
+    """ uploads (local filename, content type) pairs to their blob names concurrently; with `verify`, re-reads each blob's
+    metadata and raises IOError unless its size and MD5 match the local file """
+    def put(item):
+        (blob_name, (filename, content_type)) = item
+        blob = bucket.blob(blob_name)
+        blob.upload_from_filename(str(filename), content_type = content_type)
+        add_bytes(sent = os.path.getsize(filename))
+        if verify:
+            data = Path(filename).read_bytes()
+            blob.reload()
+            if int(blob.size) != len(data) or blob.md5_hash != md5_hash(data):
+                raise IOError(f"upload of {filename} to {blob_name} did not complete: expected {len(data)} bytes, found {blob.size}")
+    map_concurrently(put, sources.items(), workers)
+
+def upload_buffers(bucket, buffers: Dict[str, Tuple[Union[bytes, str, io.BytesIO], str]], workers: int = max_workers):
+    """ uploads in-memory (contents, content type) pairs to their blob names concurrently """
+    def put(item):
+        (blob_name, (contents, content_type)) = item
+        if isinstance(contents, io.BytesIO):
+            contents = contents.getvalue()
+        bucket.blob(blob_name).upload_from_string(contents, content_type = content_type)
+        add_bytes(sent = len(contents))
+    map_concurrently(put, buffers.items(), workers)
+
+class LocalBlob:
+    """ filesystem stand-in for google.cloud.storage.Blob, covering the calls the pipeline makes """
+
+    def __init__(self, bucket: "LocalBucket", name: str):
+        self.bucket       = bucket
+        self.name         = name
+        self.path         = bucket.root / name
+        self.content_type = None
+        self.md5_hash     = None
+        self.generation   = None
+        self.size         = None
+        self.updated      = None
+
+    def exists(self) -> bool:
+        return self.path.is_file()
+
+    def reload(self):
+        if not self.exists():
+            raise FileNotFoundError(f"{self.bucket.name}/{self.name}")
+        md5 = hashlib.md5()
+        with open(self.path, "rb") as src:
+            for chunk in iter(lambda: src.read(1 << 20), b""):
+                md5.update(chunk)
+        stat = self.path.stat()
+        self.md5_hash   = base64.b64encode(md5.digest()).decode("utf-8")
+        self.generation = stat.st_mtime_ns
+        self.size       = stat.st_size
+        self.updated    = datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc)
+        return self
+
+    def download_to_filename(self, filename):
+        if not self.exists():
+            raise FileNotFoundError(f"{self.bucket.name}/{self.name}")
+        shutil.copyfile(self.path, filename)
+
+    def download_to_file(self, file_obj):
+        file_obj.write(self.download_as_string())
+
+    def download_as_string(self) -> bytes:
+        if not self.exists():
+            raise FileNotFoundError(f"{self.bucket.name}/{self.name}")
+        return self.path.read_bytes()
+
+    def upload_from_string(self, data: Union[bytes, str], content_type: Optional[str] = None):
+        self.write(data.encode("utf-8") if isinstance(data, str) else data, content_type)
+
+    def upload_from_file(self, file_obj, content_type: Optional[str] = None):
+        self.write(file_obj.read(), content_type)
+
+    def upload_from_filename(self, filename, content_type: Optional[str] = None):
+        self.write(Path(filename).read_bytes(), content_type)
+
+    def delete(self):
+        self.path.unlink()
+
+    def write(self, data: bytes, content_type: Optional[str]):
+        # write-then-rename, so concurrent readers never see a partial object
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        (fd, staging) = tempfile.mkstemp(dir = str(self.path.parent), prefix = ".upload-")
+        with os.fdopen(fd, "wb") as dst:
+            dst.write(data)
+        # generations come from modification times, which can repeat within a clock tick; keep them increasing
+        previous = self.path.stat().st_mtime_ns if self.exists() else -1
+        if os.stat(staging).st_mtime_ns <= previous:
+            os.utime(staging, ns = (previous + 1, previous + 1))
+        os.replace(staging, self.path)
+        self.content_type = content_type
+        self.reload()
+
+class LocalBucket:
+    """ filesystem stand-in for google.cloud.storage.Bucket, rooted at a local directory """
+
+    def __init__(self, root: Union[str, Path], name: Optional[str] = None):
+        self.root = Path(root)
+        self.name = name or self.root.name
+        self.root.mkdir(parents = True, exist_ok = True)
+
+    def blob(self, blob_name: str) -> LocalBlob:
+        return LocalBlob(self, blob_name)
+
+    def get_blob(self, blob_name: str) -> Optional[LocalBlob]:
+        blob = LocalBlob(self, blob_name)
+        return blob.reload() if blob.exists() else None
+
+    def list_blobs(self, prefix: str = "") -> List[LocalBlob]:
+        return sorted((
+            self.get_blob(path.relative_to(self.root).as_posix())
+            for path in self.root.rglob("*")
+            if path.is_file() and not path.name.startswith(".upload-") and path.relative_to(self.root).as_posix().startswith(prefix)
+        ), key = lambda blob: blob.name)
+
+    def exists(self) -> bool:
+        return self.root.is_dir()
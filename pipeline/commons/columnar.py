@@ -0,0 +1,33 @@
+from typing import Optional, Sequence
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+# dates per row group: small enough that the latest date lives in the last group or two, large enough to compress well
+dates_per_group = 7
+
+def write_estimates(estimates: pd.DataFrame, filename):
+    """ Parquet copy of an *_Rt.csv file, with native dates; rows are sorted by date and grouped about a week to a row group, so readers can skip to the dates they need """
+    estimates = estimates.assign(dates = pd.to_datetime(estimates.dates)).sort_values("dates", kind = "mergesort")
+    rows_per_date = int(estimates.groupby("dates").size().max()) if len(estimates) else 1
+    estimates.to_parquet(filename, index = False, compression = "snappy", row_group_size = rows_per_date * dates_per_group)
+
+def read_estimates(source, columns: Optional[Sequence[str]] = None, latest: bool = False) -> pd.DataFrame:
+    """ reads only `columns` of an estimates file; with `latest`, only the rows for the most recent date, reading row groups from the end """
+    parquet = pq.ParquetFile(source)
+    if not latest or parquet.num_row_groups == 0:
+        return parquet.read(columns = columns).to_pandas()
+    read_columns = list(columns) + ["dates"] if columns is not None and "dates" not in columns else columns
+    groups = []
+    for i in reversed(range(parquet.num_row_groups)):
+        group = parquet.read_row_group(i, columns = read_columns).to_pandas()
+        if group.empty:
+            continue
+        groups.append(group)
+        if group.dates.iloc[0] < groups[0].dates.iloc[-1]:
+            break
+    if not groups:
+        return parquet.read(columns = columns).to_pandas()
+    rows = pd.concat(groups[::-1], ignore_index = True)
+    rows = rows[rows.dates == rows.dates.max()].reset_index(drop = True)
+    return rows[list(columns)] if columns is not None else rows
@@ -0,0 +1,41 @@
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from shapely import wkb
+
+# simplified maps, written offline by misc/simplify_maps from the GeoJSON in pipeline/commons/maps
+simplified_root = "pipeline/commons/maps/simplified"
+
+def index_districts(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """ one row per district, indexed and sorted by district name; districts split across several features are merged """
+    if gdf.district.duplicated().any():
+        gdf = gdf[["district", "geometry"]].dissolve(by = "district")
+    else:
+        gdf = gdf[["district", "geometry"]].set_index("district")
+    return gdf.sort_index()
+
+def read_map(filename) -> gpd.GeoDataFrame:
+    """ full-resolution GeoJSON map, indexed by district """
+    return index_districts(gpd.read_file(filename))
+
+def write_geometries(gdf: gpd.GeoDataFrame, filename):
+    """ district-indexed geometries as Parquet, with shapes stored as WKB and the CRS kept in the file metadata """
+    table = pa.Table.from_pandas(pd.DataFrame({
+        "district": gdf.index.values,
+        "geometry": [geometry.wkb for geometry in gdf.geometry]
+    }), preserve_index = False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"crs"] = gdf.crs.to_string().encode("utf-8") if gdf.crs is not None else b""
+    pq.write_table(table.replace_schema_metadata(metadata), filename, compression = "snappy")
+
+def read_geometries(source) -> gpd.GeoDataFrame:
+    """ district-indexed geometries written by `write_geometries` """
+    table = pq.read_table(source)
+    crs = (table.schema.metadata or {}).get(b"crs", b"").decode("utf-8") or None
+    frame = table.to_pandas()
+    return gpd.GeoDataFrame(
+        geometry = [wkb.loads(bytes(shape)) for shape in frame.geometry],
+        index    = pd.Index(frame.district, name = "district"),
+        crs      = crs
+    )
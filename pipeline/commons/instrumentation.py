@@ -0,0 +1,115 @@
+import datetime
+import fcntl
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# open invocations and spans in this process, innermost last; transfer threads add their bytes to all of them.
+# pipeline work runs one invocation at a time per process (batches use worker processes), so one stack per process suffices
+frames = []
+lock   = threading.Lock()
+
+def peak_rss_mb() -> float:
+    """ peak resident set size of this process so far (ru_maxrss is in KB on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def cpu_seconds() -> float:
+    """ CPU time of this process, plus any child processes that have finished (e.g. batch workers) """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+class Frame:
+    """ measurements for one span or invocation """
+
+    def __init__(self, name: str, labels: Dict):
+        self.name      = name
+        self.labels    = labels
+        self.spans     = []
+        self.bytes_in  = 0
+        self.bytes_out = 0
+        self.started   = datetime.datetime.utcnow().isoformat() + "Z"
+        self.wall      = time.perf_counter()
+        self.cpu       = cpu_seconds()
+
+    def measure(self) -> Dict:
+        return dict(
+            wall_s      = round(time.perf_counter() - self.wall, 4),
+            cpu_s       = round(cpu_seconds() - self.cpu, 4),
+            peak_rss_mb = round(peak_rss_mb(), 1),
+            bytes_in    = self.bytes_in,
+            bytes_out   = self.bytes_out
+        )
+
+class Invocation(Frame):
+    """ a span that collects the spans opened inside it and emits them as one record """
+
+def add_bytes(received: int = 0, sent: int = 0):
+    """ counts bytes transferred against every open span and invocation """
+    with lock:
+        for frame in frames:
+            frame.bytes_in  += received
+            frame.bytes_out += sent
+
+@contextmanager
+def span(name: str, **labels):
+    """ times a stage (download, parse, estimate, render, upload...) within the current invocation """
+    frame = Frame(name, labels)
+    with lock:
+        frames.append(frame)
+    try:
+        yield frame
+    finally:
+        with lock:
+            frames.remove(frame)
+            parents = [_ for _ in frames if isinstance(_, Invocation)]
+        if parents:
+            parents[-1].spans.append(dict(name = frame.name, **frame.labels, **frame.measure()))
+
+@contextmanager
+def invocation(step: str, **labels):
+    """ measures one unit of work (a request, or one state within a batch) and emits its record with all spans opened inside it """
+    frame = Invocation(step, labels)
+    with lock:
+        frames.append(frame)
+    status, error = "ok", None
+    try:
+        yield frame
+    except BaseException as e:
+        status, error = "error", f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        with lock:
+            frames.remove(frame)
+        emit(dict(step = step, **labels, started = frame.started, status = status, error = error, pid = os.getpid(), **frame.measure(), spans = frame.spans))
+
+def emit(record: Dict):
+    """ prints the record as one JSON line (a structured log entry on Cloud Functions and Cloud Run), and appends it to METRICS_PATH if set """
+    metrics_path = os.environ.get("METRICS_PATH")
+    line = json.dumps(dict(type = "pipeline_invocation", **record), default = str)
+    print(line, flush = True)
+    if metrics_path:
+        with open(metrics_path, "a") as dst:
+            fcntl.flock(dst, fcntl.LOCK_EX)
+            dst.write(line + "\n")
+            fcntl.flock(dst, fcntl.LOCK_UN)
+
+def instrumented(step: str, label: Optional[str] = None) -> Callable:
+    """ wraps a function in an invocation named `step`; with `label`, the first argument is recorded under that name (e.g. the state code) """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with invocation(step, **({label: args[0]} if label else {})):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def read_records(filename, step: Optional[str] = None) -> List[Dict]:
+    """ records from a METRICS_PATH file, optionally only those for `step` """
+    with open(filename) as src:
+        records = [json.loads(line) for line in src if line.strip()]
+    return [record for record in records if step is None or record["step"] == step]
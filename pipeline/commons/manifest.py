@@ -0,0 +1,51 @@
+import base64
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from instrumentation import add_bytes
+
+# content hashes of raw artifacts, and of the inputs to each step's last successful run
+manifest_root = "pipeline/manifests"
+
+def content_hash(filename) -> str:
+    """ base64-encoded MD5 of a local file; the same format Cloud Storage reports as the blob's md5_hash """
+    md5 = hashlib.md5()
+    with open(filename, "rb") as src:
+        for chunk in iter(lambda: src.read(1 << 20), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode("utf-8")
+
+def upload_if_changed(bucket, blob_name: str, filename, content_type: str) -> str:
+    """ uploads a file unless the bucket already holds identical content; returns the content hash """
+    digest = content_hash(filename)
+    existing = bucket.get_blob(blob_name)
+    if existing is not None and existing.md5_hash == digest:
+        print(f"{blob_name} unchanged, skipping upload.")
+    else:
+        bucket.blob(blob_name).upload_from_filename(str(filename), content_type = content_type)
+        add_bytes(sent = Path(filename).stat().st_size)
+    return digest
+
+def fingerprint(bucket, blob_names: Iterable[str], sources: Iterable[str] = ()) -> Dict[str, Optional[str]]:
+    """ content hashes of bucket objects (None if missing) and of local source files, so code changes also invalidate runs """
+    hashes = {}
+    for blob_name in blob_names:
+        blob = bucket.get_blob(blob_name)
+        hashes[blob_name] = blob.md5_hash if blob is not None else None
+    for source in sources:
+        hashes[f"source:{Path(source).name}"] = content_hash(source)
+    return hashes
+
+def read_manifest(bucket, name: str) -> Dict[str, Optional[str]]:
+    blob = bucket.get_blob(f"{manifest_root}/{name}.json")
+    return json.loads(blob.download_as_string()) if blob is not None else {}
+
+def write_manifest(bucket, name: str, hashes: Dict[str, Optional[str]]):
+    bucket.blob(f"{manifest_root}/{name}.json")\
+        .upload_from_string(json.dumps(hashes, indent = 2, sort_keys = True), content_type = "application/json")
+
+def unchanged(bucket, name: str, hashes: Dict[str, Optional[str]]) -> bool:
+    """ whether every input is present and identical to the last successful run recorded under `name` """
+    return all(hashes.values()) and read_manifest(bucket, name) == hashes
@@ -0,0 +1,259 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy.stats import gamma as Gamma
+from scipy.stats import nbinom
+from smoothing import notched_smoothing_batch
+
+# model details
+infectious_period = 5 # days, i.e. gamma = 0.2; epimargin's analytical_MPVS default, which the Rt estimates have always used
+smoothing = 10
+CI        = 0.95
+lookback  = 120 # how many days back to start estimation
+cutoff    = 2   # most recent data to use
+horizon   = 7   # days ahead Rt is projected
+reanchor  = 30   # days an incremental run's window may extend past `lookback` before the series is estimated in full again
+tolerance = 1e-6 # relative change in smoothed daily cases below which a date's inputs count as unchanged
+estimate_columns = ["dates", "Rt_pred", "Rt_CI_upper", "Rt_CI_lower", "T_pred", "T_CI_upper", "T_CI_lower", "total_cases", "new_cases_ts"]
+step_columns     = ["Rt_pred", "Rt_CI_upper", "Rt_CI_lower", "T_pred", "T_CI_upper", "T_CI_lower", "new_cases_ts", "alpha", "beta"]
+
+# series not estimated at the district level
+dissolved_states = ["Delhi", "Chandigarh", "Manipur", "Sikkim", "Dadra And Nagar Haveli And Daman And Diu", "Andaman And Nicobar Islands", "Telangana", "Goa", "Assam", "Lakshadweep"]
+excluded = ["Unknown", "Other State", "Other Region", "Airport Quarantine", "Railway Quarantine", "BSF Camp", "Foreign Evacuees", "Italians", "Evacuees"]
+
+def smoothed_total_cases(totals: np.ndarray, smoothing) -> np.ndarray:
+    """ cumulative smoothed daily cases, as computed by analytical_MPVS from a (series × days) array of cumulative cases """
+    daily_cases = np.diff(np.clip(totals, 0, None), axis = 1).clip(0)
+    return np.cumsum(smoothing(daily_cases), axis = 1)
+
+def analytical_MPVS_batch(
+        total_cases: np.ndarray,         # (series × days) array of smoothed cumulative cases
+        alpha = 3.0,                     # shape, shared or per series
+        beta  = 2.0,                     # rate, shared or per series
+        start: int = 2,                  # first day to update on; alpha and beta are the posterior as of the day before
+        CI:    float = 0.95,             # confidence interval
+        infectious_period: int = infectious_period, # inf period = 1/gamma,
+        variance_shift: float = 0.99     # how much to scale variance parameters by when anomaly detected
+    ):
+    """ epimargin.estimators.analytical_MPVS posterior updates, stepping all series forward in time together;
+    series whose anomaly annealing does not converge are flagged in the returned failure mask instead of raising """
+    (n, m) = total_cases.shape
+
+    alpha = np.broadcast_to(np.asarray(alpha, dtype = float), (n,)).copy()
+    beta  = np.broadcast_to(np.asarray(beta,  dtype = float), (n,)).copy()
+    (Rt_pred, Rt_CI_upper, Rt_CI_lower, T_pred, T_CI_upper, T_CI_lower, new_cases_ts, alphas, betas) = np.zeros((9, n, max(0, m - start)))
+    failed = np.zeros(n, dtype = bool)
+
+    for (t, i) in enumerate(range(start, m)):
+        new_cases     = np.maximum(0, total_cases[:, i]   - total_cases[:, i-1])
+        old_new_cases = np.maximum(0, total_cases[:, i-1] - total_cases[:, i-2])
+
+        alpha += new_cases
+        beta  += old_new_cases
+        alphas[:, t] = alpha
+        betas[:, t]  = beta
+
+        Rt_pred[:, t]     = np.maximum(0, 1 + infectious_period*np.log(Gamma.mean(a = alpha, scale = 1/beta)))
+        Rt_CI_upper[:, t] = np.maximum(0, 1 + infectious_period*np.log(Gamma.ppf(CI,   a = alpha, scale = 1/beta)))
+        Rt_CI_lower[:, t] = np.maximum(0, 1 + infectious_period*np.log(Gamma.ppf(1-CI, a = alpha, scale = 1/beta)))
+
+        T_CI_upper[:, t] = 10
+        live = np.flatnonzero((new_cases > 0) & (old_new_cases > 0))
+        if not len(live):
+            continue
+
+        new, old = new_cases[live], old_new_cases[live]
+        new_cases_ts[live, t] = new
+
+        r, p = alpha[live], beta[live]/(old + beta[live])
+        T_pred[live, t] = nbinom.mean(r, p)
+        T_upper = nbinom.ppf(CI,   r, p)
+        T_lower = nbinom.ppf(1-CI, r, p)
+        T_CI_upper[live, t] = T_upper
+        T_CI_lower[live, t] = T_lower
+
+        # anneal the variance of series whose new cases fall outside the predicted CI
+        (_nr, _np) = (r.copy(), p.copy())
+        outside  = ~((T_lower < new) & (new < T_upper))
+        annealed = outside.copy()
+        counter = 0
+        while outside.any():
+            _nr[outside] = variance_shift * _nr[outside] * ((1-_np[outside])/(1-variance_shift*_np[outside]))
+            _np[outside] = variance_shift * _np[outside]
+            (T_lower, T_upper) = (nbinom.ppf(CI, _nr[outside], _np[outside]), nbinom.ppf(1-CI, _nr[outside], _np[outside]))
+            (T_lower, T_upper) = (np.minimum(T_lower, T_upper), np.maximum(T_lower, T_upper))
+            T_upper[(T_lower == 0) & (T_upper == 0)] = 1
+            outside[outside] = ~((T_lower < new[outside]) & (new[outside] < T_upper))
+
+            counter += 1
+            if counter >= 10000:
+                failed[live[outside]] = True
+                annealed &= ~outside
+                break
+
+        if annealed.any():
+            rows = live[annealed]
+            (_nr, _np) = (_nr[annealed], _np[annealed])
+            # update distribution on R with new parameters that enclose the anomaly
+            alpha[rows] = alphas[rows, t] = _nr
+            beta[rows]  = betas[rows, t]  = _np/(1-_np) * old[annealed]
+
+            T_pred[rows, t]     = nbinom.mean(_nr, _np)
+            T_CI_lower[rows, t] = nbinom.ppf(CI,   _nr, _np)
+            T_CI_upper[rows, t] = nbinom.ppf(1-CI, _nr, _np)
+
+            # annealing leaves the RR mean unchanged, but we need to adjust its widened CI
+            Rt_CI_upper[rows, t] = np.maximum(0, 1 + infectious_period * np.log(Gamma.ppf(CI,     a = alpha[rows], scale = 1/beta[rows])))
+            Rt_CI_lower[rows, t] = np.maximum(0, 1 + infectious_period * np.log(Gamma.ppf(1 - CI, a = alpha[rows], scale = 1/beta[rows])))
+
+    return (
+        Rt_pred, Rt_CI_upper, Rt_CI_lower,
+        T_pred, T_CI_upper, T_CI_lower,
+        new_cases_ts, alphas, betas, failed
+    )
+
+def batches(windows: pd.Series):
+    """ groups series observed on exactly the same dates, so each group can be stacked into one (series × days) array """
+    wide  = windows.unstack()
+    valid = wide.notna().values
+    # filtfilt needs more than 3 * (filter order + 1) daily points
+    min_length = 3 * 5 + 2
+
+    patterns = pd.Series([row.tobytes() for row in valid], index = wide.index)
+    for (_, keys) in patterns.groupby(patterns, sort = False).groups.items():
+        rows = wide.index.get_indexer(keys)
+        cols = valid[rows[0]]
+        dates = wide.columns[cols]
+        if len(dates) < min_length:
+            for key in keys:
+                print(f"ERROR when estimating Rt for {key}: insufficient data ({len(dates)} days)")
+            continue
+        yield (keys, dates, wide.values[rows][:, cols])
+
+def posterior_frame(level: str, keys, dates, confirmed: np.ndarray, total_cases: np.ndarray, steps) -> pd.DataFrame:
+    """ one row per series and input date; smoothed totals start on the second date and posterior updates on the fourth """
+    (n, m) = confirmed.shape
+    pad = lambda values, k: np.hstack([np.full((n, k), np.nan), values]).ravel()
+    return pd.DataFrame({
+        level:         np.repeat(keys, m),
+        "dates":       np.tile(dates, n),
+        "confirmed":   confirmed.ravel(),
+        "total_cases": pad(total_cases, 1),
+        **{column: pad(values, 3) for (column, values) in zip(step_columns, steps)}
+    })
+
+def estimate_full(windows: pd.Series, level: str):
+    smooth = notched_smoothing_batch(window = smoothing)
+    for (keys, dates, confirmed) in batches(windows):
+        total_cases = smoothed_total_cases(confirmed, smooth)
+        (*steps, failed) = analytical_MPVS_batch(total_cases, CI = CI)
+        for key in keys[failed]:
+            print(f"ERROR when estimating Rt for {key}: number of iterations exceeded")
+        ok = ~failed
+        yield posterior_frame(level, keys[ok], dates, confirmed[ok], total_cases[ok], [values[ok] for values in steps])
+
+def estimate_incremental(windows: pd.Series, level: str, previous: pd.DataFrame):
+    """ rolls the previous posterior forward from the first date whose inputs differ from the previous run's; yields the
+    rolled-forward posteriors, then the keys that need a full recompute """
+    smooth = notched_smoothing_batch(window = smoothing)
+    previous = previous.set_index([level, "dates"]).unstack()
+    recompute = []
+    for (keys, dates, confirmed) in batches(windows):
+        (n, m) = confirmed.shape
+        total_cases = smoothed_total_cases(confirmed, smooth)
+        prev = {column: previous[column].reindex(index = keys, columns = dates).values for column in ["confirmed", "total_cases"] + step_columns}
+
+        # the previous run must cover a prefix of the current dates
+        known  = ~np.isnan(prev["confirmed"])
+        length = known.sum(axis = 1)
+        prefix = np.where(known.all(axis = 1), m, known.argmin(axis = 1)) == length
+
+        # first date whose reported cases differ, or whose smoothed daily cases moved by more than the tolerance; the
+        # smoothing filter runs backwards from the last date, so a new day moves the last few weeks of smoothed cases by
+        # amounts that shrink geometrically with distance from it
+        daily      = np.diff(total_cases, axis = 1, prepend = 0)
+        prev_daily = np.diff(prev["total_cases"][:, 1:], axis = 1, prepend = 0)
+        revised = known & (prev["confirmed"] != confirmed)
+        changed = known[:, 1:] & ~(np.abs(daily - prev_daily) <= tolerance * np.maximum(1, np.abs(prev_daily)))
+        resume  = np.minimum(
+            np.where(revised.any(axis = 1), revised.argmax(axis = 1), length),
+            np.where(changed.any(axis = 1), 1 + changed.argmax(axis = 1), length)
+        )
+
+        resumable = prefix & (resume > 3)
+        recompute.extend(keys[~resumable])
+        for day in np.unique(resume[resumable]):
+            rows = np.flatnonzero(resumable & (resume == day))
+            # posterior as of the day before the first changed date
+            (*steps, failed) = analytical_MPVS_batch(total_cases[rows], prev["alpha"][rows, day - 1], prev["beta"][rows, day - 1], start = day - 1, CI = CI)
+            steps = [np.hstack([prev[column][rows, 3:day], values]) for (column, values) in zip(step_columns, steps)]
+            recompute.extend(keys[rows[failed]])
+            ok = ~failed
+            yield posterior_frame(level, keys[rows[ok]], dates, confirmed[rows[ok]], total_cases[rows[ok]], [values[ok] for values in steps])
+    yield recompute
+
+def estimate(cases: pd.Series, level: str, previous: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """ posterior for every series in a (series, date)-indexed confirmed case count, estimated in as few batches as possible;
+    if the posterior from a previous run is supplied, each series keeps that posterior's start date for up to `reanchor`
+    days past the usual window and is rolled forward from it, so only its last few weeks are recomputed """
+    windows = window(cases)
+    order = windows.index.get_level_values(0).unique()
+    posteriors = []
+    if previous is not None and not previous.empty:
+        starts  = pd.to_datetime(windows.reset_index(level = 1).groupby(level = 0).date.min())
+        anchors = pd.to_datetime(previous.groupby(level).dates.min())
+        anchors = anchors[anchors.index.isin(starts.index)]
+        offset  = (starts[anchors.index] - anchors).dt.days
+        anchors = anchors[(0 <= offset) & (offset <= reanchor)]
+
+        anchored = window(cases[cases.index.get_level_values(0).isin(anchors.index)], anchors)
+        *posteriors, recompute = estimate_incremental(anchored, level, previous)
+        print(f"Rolled forward {sum(_[level].nunique() for _ in posteriors)} of {len(order)} {level} posteriors.")
+        windows = windows[~windows.index.get_level_values(0).isin(anchors.index.difference(recompute))]
+    posteriors.extend(estimate_full(windows, level))
+
+    if not posteriors:
+        return pd.DataFrame(columns = [level, "dates", "confirmed", "total_cases"] + step_columns)
+    # restore the input series order
+    posterior = pd.concat(posteriors, ignore_index = True)
+    return posterior.iloc[np.argsort(order.get_indexer(posterior[level]), kind = "mergesort")].reset_index(drop = True)
+
+def window(cases: pd.Series, anchors: Optional[pd.Series] = None) -> pd.Series:
+    """ last `lookback` days of each series, less the most recent `cutoff` days (i.e. .iloc[-lookback:-cutoff] per series);
+    series with a date in `anchors` start on that date instead """
+    grouped  = cases.groupby(level = 0, sort = False)
+    position = grouped.cumcount()
+    length   = grouped.transform("size")
+    first    = length - lookback
+    if anchors is not None:
+        dates  = pd.to_datetime(cases.index.get_level_values(1))
+        anchor = anchors.reindex(cases.index.get_level_values(0)).values
+        first  = position.where(dates == anchor).groupby(level = 0, sort = False).transform("min").fillna(first)
+    return cases[((position >= first) & (position < length - cutoff)).values]
+
+def trim(posterior: pd.DataFrame, level: str) -> pd.DataFrame:
+    """ estimates for the last `lookback - cutoff` dates of each posterior, in the layout of the *_Rt.csv files;
+    total cases are rebased onto the first of those dates so rolled-forward and recomputed series line up """
+    grouped  = posterior.groupby(level, sort = False)
+    position = grouped.cumcount()
+    start    = np.maximum(0, grouped.dates.transform("size") - (lookback - cutoff))
+    base     = posterior.total_cases.where(position == start).groupby(posterior[level], sort = False).transform("first").fillna(0)
+    estimates = posterior\
+        .assign(total_cases = posterior.total_cases - base)\
+        [position >= start + 3]\
+        [estimate_columns + [level]]
+    estimates.index = (position - start - 3)[position >= start + 3].values
+    return estimates
+
+def project(estimates: pd.DataFrame, level: str, points: int = smoothing // 2) -> pd.Series:
+    """ Rt `horizon` days past each series' last estimate, extrapolating a least-squares line through its last `points` estimates """
+    recent = estimates[estimates.groupby(level, sort = False).cumcount(ascending = False) < points].reset_index(drop = True)
+    keys   = recent[level]
+    x = recent.groupby(level, sort = False).cumcount().astype(float)
+    y = recent.Rt_pred
+    (x_mean, y_mean) = (x.groupby(keys, sort = False).mean(), y.groupby(keys, sort = False).mean())
+    (dx, dy) = (x - keys.map(x_mean), y - keys.map(y_mean))
+    slope  = ((dx * dy).groupby(keys, sort = False).sum() / (dx ** 2).groupby(keys, sort = False).sum()).fillna(0)
+    x_last = x.groupby(keys, sort = False).max()
+    return (y_mean + slope * (x_last + horizon - x_mean)).clip(lower = 0).rename("Rt_proj")
@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+
+import pandas as pd
+from instrumentation import add_bytes
+
+# reference files (crosswalks, population tables, maps) change rarely, so warm instances keep them parsed in memory
+max_entries = 64
+max_bytes   = 512 * 1024 * 1024
+
+def nbytes(value: Any) -> int:
+    """ approximate in-memory size of a cached value """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep = True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep = True))
+    if isinstance(value, dict):
+        return sum(nbytes(_) for _ in value.values())
+    return sys.getsizeof(value)
+
+class ReferenceCache:
+    """ LRU cache of parsed bucket objects, keyed by blob name, object generation and parser """
+
+    def __init__(self, max_entries: int = max_entries, max_bytes: int = max_bytes, root: str = "/tmp/refs"):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.root        = Path(root)
+        self.entries     = OrderedDict()
+        self.size        = 0
+        self.lock        = threading.Lock()
+
+    def get(self, bucket, blob_name: str, parse: Callable[[str], Any]) -> Any:
+        """ parsed contents of `blob_name`; downloads and parses only if this generation has not been seen """
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(blob_name)
+        key = (blob_name, getattr(blob, "generation", None) or blob.md5_hash, parse)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                print(f"Using cached {blob_name}.")
+                return self.entries[key][0]
+
+        self.root.mkdir(parents = True, exist_ok = True)
+        (fd, filename) = tempfile.mkstemp(dir = str(self.root), suffix = Path(blob_name).suffix)
+        os.close(fd)
+        try:
+            blob.download_to_filename(filename)
+            add_bytes(received = os.path.getsize(filename))
+            value = parse(filename)
+        finally:
+            os.remove(filename)
+        size = nbytes(value)
+
+        with self.lock:
+            # drop older generations of the same object before evicting anything else
+            for stale in [k for k in self.entries if k[0] == blob_name and k[2] == parse and k != key]:
+                self.size -= self.entries.pop(stale)[1]
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                (_, (_, evicted)) = self.entries.popitem(last = False)
+                self.size -= evicted
+        return value
+
+references = ReferenceCache()
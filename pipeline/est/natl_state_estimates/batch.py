@@ -0,0 +1 @@
+../../commons/batch.py
\ No newline at end of file
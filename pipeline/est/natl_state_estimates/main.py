@@ -1,65 +1,125 @@
+import io
+from pathlib import Path
 from warnings import simplefilter
 
-import numpy as np
 import pandas as pd
-from epimargin.estimators import analytical_MPVS
-from epimargin.smoothing import notched_smoothing
-from google.cloud import storage
+from epimargin.etl.covid19india import state_code_lookup
+from batch import get
+from blobs import download_buffers, get_bucket, map_concurrently, upload_buffers
+from instrumentation import instrumented, span
+from manifest import fingerprint, unchanged, upload_if_changed, write_manifest
+import mpvs
+from mpvs import dissolved_states, estimate, estimate_columns, excluded, project, trim
 
 simplefilter("ignore")
 
-# model details 
-gamma     = 0.1 # 10 day infectious period
-smoothing = 7
-CI        = 0.95
-lookback  = 120 # how many days back to start estimation
-cutoff    = 2   # most recent data to use 
+# series keys: "TT" for the country, state codes for states, and "{state code}|{district}" for districts
+national  = "TT"
+separator = "|"
 
-
-# cloud details 
+# cloud details
 bucket_name = "daily_pipeline"
 
+# posterior of every series from the last run, for incremental runs
+posterior_blob = "pipeline/est/posterior/hierarchy_posterior.parquet"
+
+def estimates_blob(state_code: str) -> str:
+    """ a state's estimates and its districts' (with no district for the state's own rows); state_district_estimates publishes them """
+    return f"pipeline/est/hierarchy/{state_code}_Rt.parquet"
+
+def normalize(state: str) -> str:
+    return state.replace(" and ", " And ").replace(" & ", " And ")
+
+state_codes = {normalize(name): code for (code, name) in state_code_lookup.items()}
+
+def hierarchy(districts: pd.DataFrame) -> pd.Series:
+    """ confirmed cases for every district, state and the country, indexed by (series, date); district series are as
+    reported, and state and national series are grouped sums of all districts, each carried forward over dates it did not report """
+    districts = districts.assign(name = districts.state.map(normalize))
+    districts = districts.assign(state = districts.name.map(state_codes)).dropna(subset = ["state"])
+
+    wide   = districts.set_index(["state", "district", "date"]).confirmed.unstack().sort_index(axis = 1).ffill(axis = 1).fillna(0)
+    states = wide.groupby(level = "state", sort = False).sum()
+    country = wide.sum().to_frame(national).T
+
+    estimated = districts[~districts.name.isin(dissolved_states) & ~districts.district.str.strip().isin(excluded)]
+    district_cases = estimated\
+        .assign(series = estimated.state + separator + estimated.district)\
+        .set_index(["series", "date"])\
+        .confirmed\
+        .sort_index()
+
+    return pd.concat([country.stack(), states.stack(), district_cases])\
+        .rename_axis(["series", "date"])\
+        .rename("confirmed")
+
+def timeseries(estimates: pd.DataFrame) -> pd.DataFrame:
+    return estimates\
+        .rename(columns = {"series": "state", "dates": "date", "Rt_pred": "Rt", "Rt_CI_upper": "Rt_upper", "Rt_CI_lower": "Rt_lower"})\
+        [["state", "date", "Rt", "Rt_upper", "Rt_lower"]]
+
+@instrumented("natl_state_estimates")
+def run_estimates(request):
+    incremental = str(get(request, 'incremental')).lower() == "true"
+    force       = str(get(request, 'force')).lower() == "true"
+
+    bucket = get_bucket(bucket_name)
+    inputs = fingerprint(bucket, ["pipeline/raw/districts.csv"], sources = [__file__, mpvs.__file__])
+    if not force and unchanged(bucket, "est/hierarchy", inputs):
+        print("District case time series unchanged since last successful run; skipping estimation.")
+        return "OK!"
+
+    # one load of the district time series; state and national series are aggregated from it
+    with span("download"):
+        raw = download_buffers(bucket, ["pipeline/raw/districts.csv"])["pipeline/raw/districts.csv"]
+        previous = download_buffers(bucket, [posterior_blob], missing_ok = True)[posterior_blob] if incremental else None
+    with span("parse"):
+        cases = hierarchy(pd.read_csv(raw, usecols = ["Date", "State", "District", "Confirmed"]).rename(columns = str.lower))
+        if incremental and previous is None:
+            print("No previous posterior; estimating every series in full.")
+        previous = pd.read_parquet(previous) if previous is not None else None
+    print(f"Estimating Rt for {cases.index.get_level_values(0).nunique()} national, state and district series" + (" (incremental)" if incremental else ""))
+
+    # every level is estimated together, in batches of series observed on the same dates
+    with span("estimate"):
+        posterior = estimate(cases, level = "series", previous = previous)
+        estimates = trim(posterior, level = "series").reset_index(drop = True)
+    is_district = estimates.series.str.contains(separator, regex = False)
+    (top_level, district_level) = (estimates[~is_district], estimates[is_district])
+
+    latest = top_level.groupby("series", sort = False).last()
+    posterior_buffer = io.BytesIO()
+    posterior.to_parquet(posterior_buffer, index = False)
+    outputs = {
+        "estimates/Rt_estimates.csv": (
+            pd.DataFrame({
+                "Rt":          latest.Rt_pred,
+                "Rt_CI_lower": latest.Rt_CI_lower,
+                "Rt_CI_upper": latest.Rt_CI_upper,
+                "Rt_proj":     project(top_level, level = "series")
+            }).rename_axis("state").to_csv(),
+            "text/csv"
+        ),
+        "estimates/Rt_timeseries_india.csv": (timeseries(top_level).to_csv(index = False), "text/csv"),
+        posterior_blob: (posterior_buffer, "application/octet-stream")
+    }
+
+    # per-state files hold the state's series and its districts'; a state whose estimates did not change keeps its
+    # content hash, so its publishing step is skipped
+    keys = district_level.series.str.split(separator, n = 1)
+    per_state = pd.concat([
+        top_level[top_level.series != national].assign(state = lambda _: _.series, district = None),
+        district_level.assign(state = keys.str[0], district = keys.str[1])
+    ])[["state", "district"] + estimate_columns]
+    data = Path("/tmp")
+    with span("write"):
+        for (state_code, state_estimates) in per_state.groupby("state", sort = False):
+            state_estimates.to_parquet(data/f"{state_code}_hierarchy_Rt.parquet", index = False)
+
+    print(f"Uploading {len(outputs)} files and {per_state.state.nunique()} state estimates")
+    with span("upload"):
+        upload_buffers(bucket, outputs)
+        map_concurrently(lambda state_code: upload_if_changed(bucket, estimates_blob(state_code), data/f"{state_code}_hierarchy_Rt.parquet", content_type = "application/octet-stream"), per_state.state.unique())
 
-def run_estimates(_):
-    storage.Client()\
-        .bucket(bucket_name)\
-        .blob("pipeline/raw/india_case_timeseries.csv")\
-        .download_to_filename("/tmp/india_case_timeseries.csv")
-
-    india_ts = pd.read_csv("/tmp/india_case_timeseries.csv")
-
-    # country level
-    (dates, RR_pred, RR_CI_upper, RR_CI_lower, *_) =\
-        analytical_MPVS(india_ts["Hospitalized"].iloc[-(lookback+cutoff):-cutoff], CI = CI, smoothing = notched_smoothing(window = smoothing)) 
-
-
-    # state level rt estimates
-    state_time_series = get_time_series(state_df, 'state')
-    states = list(state_time_series.index.get_level_values(level=0).unique())
-    for state in states:
-        state_code = state_name_lookup[state]
-        try: 
-            (dates, RR_pred, RR_CI_upper, RR_CI_lower, *_) = gamma_prior(state_time_series.loc[state]['Hospitalized'], CI = CI, smoothing = notched_smoothing(window = smoothing))
-            for row in zip(dates, RR_pred, RR_CI_upper, RR_CI_lower):
-                timeseries.append((state_code, *row))
-            estimates.append((state_code, RR_pred[-1], RR_CI_lower[-1], RR_CI_upper[-1], project(dates, RR_pred, smoothing)))
-            print(f"{state_code}: success")
-        except (IndexError, ValueError): 
-            estimates.append((state, np.nan, np.nan, np.nan, np.nan))
-            print(f"{state_code}: error")
-
-    # save out estimates 
-    estimates = pd.DataFrame(estimates)
-    estimates.columns = ["state", "Rt", "Rt_CI_lower", "Rt_CI_upper", "Rt_proj"]
-    estimates.set_index("state", inplace=True)
-    estimates.to_csv(data/"Rt_estimates.csv")
-
-    timeseries = pd.DataFrame(timeseries)
-    timeseries.columns = ["state", "date", "Rt", "Rt_upper", "Rt_lower"]
-    timeseries.set_index("state", inplace=True)
-    timeseries.to_csv(data/"Rt_timeseries_india.csv")
-
-    # upload to cloud 
-    
-    bucket.blob("estimates/Rt_estimates.csv")       .upload_from_filename(str(data/"Rt_estimates.csv"),        content_type = "text/csv")
-    bucket.blob("estimates/Rt_timeseries_india.csv").upload_from_filename(str(data/"Rt_timeseries_india.csv"), content_type = "text/csv")
+    write_manifest(bucket, "est/hierarchy", inputs)
+    return "OK!"
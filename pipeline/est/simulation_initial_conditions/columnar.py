@@ -0,0 +1 @@
+../../commons/columnar.py
\ No newline at end of file
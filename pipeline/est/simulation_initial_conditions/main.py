@@ -1,9 +1,13 @@
-from pathlib import Path
-
+import numpy as np
 import pandas as pd
-from epimargin.etl.covid19india import state_code_lookup, state_name_lookup
-from epimargin.smoothing import notched_smoothing
-from google.cloud import storage
+from batch import get, get_state_codes, run_batch, shared
+from blobs import download_buffers, get_bucket, upload_buffers
+from columnar import read_estimates
+from epimargin.etl.covid19india import state_code_lookup
+from instrumentation import instrumented, span
+from manifest import fingerprint, unchanged, write_manifest
+from references import references
+from smoothing import notched_smoothing_batch
 
 # model details 
 gamma     = 0.1 # 10 day infectious period
@@ -14,84 +18,178 @@ cutoff    = 2   # most recent data to use
 excluded = ["Unknown", "Other State", "Airport Quarantine", "Railway Quarantine"]
 coalesce_states = ["Delhi", "Manipur", "Dadra And Nagar Haveli And Daman And Diu", "Andaman And Nicobar Islands"]
 survey_date = "October 23, 2020"
+min_filter_length = 16 # filtfilt pads 15 days onto each end of a series
 columns  = ["state_code", "state", "district", "sero_0", "N_0", "sero_1", "N_1", "sero_2", "N_2", "sero_3", "N_3", "sero_4", "N_4", "sero_5", "N_5", "sero_6", "N_6", "N_tot", "Rt", "S0", "I0", "R0", "D0", "dT0", "dD0", "V0", "pandemic_start"]
 # cloud details 
 bucket_name = "daily_pipeline"
 
-def get(request, key):
-    request_json = request.get_json()
-    if request.args and key in request.args:
-        return request.args.get(key)
-    elif request_json and key in request_json:
-        return request_json[key]
-    else:
-        return None
-
+def gather_positions(dates: pd.DatetimeIndex, first: np.ndarray, last: np.ndarray, date) -> np.ndarray:
+    """ column of `date` for each district, or of the district's last date if `date` falls outside its series """
+    position = dates.get_indexer([date])[0]
+    return np.where((position >= 0) & (first <= position) & (position <= last), position, last)
+
+def seroprevalence_scaling(ts: pd.DataFrame, districts: pd.DataFrame, simulation_start: pd.Timestamp) -> pd.DataFrame:
+    """ scales smoothed confirmed recoveries, deaths and cases to the serosurvey, for all districts at once """
+    if districts.empty:
+        return pd.DataFrame(columns = ["S0", "I0", "R0", "D0", "dT0", "dD0", "pandemic_start"], index = districts.index)
+    counts = ts[["dR", "dD", "dT"]].loc[districts.index]
+    observed = pd.Series(counts.index.get_level_values(1), index = counts.index.get_level_values(0))\
+        .groupby(level = 0)\
+        .agg(["min", "max"])\
+        .reindex(districts.index)
+    dates = pd.date_range(observed["min"].min(), observed["max"].max())
+    first = dates.get_indexer(observed["min"])
+    last  = dates.get_indexer(observed["max"])
+
+    # (dR, dD, dT) × district × date; days before a district's first report have no cases
+    daily = np.stack([
+        counts[column].unstack(level = 1).reindex(index = districts.index, columns = dates).fillna(0).values
+        for column in ["dR", "dD", "dT"]
+    ]).astype(int)
+
+    # each district is smoothed over its own dates, as the smoother pads both ends of a series; districts are smoothed
+    # together only if their data starts and ends on the same days
+    smooth = notched_smoothing_batch(window = window)
+    for (start, end) in sorted(set(zip(first, last))):
+        rows   = np.flatnonzero((first == start) & (last == end))
+        length = end - start + 1
+        if length < min_filter_length:
+            for district in districts.index[rows]:
+                print(f"Too few days ({length}) to smooth cases for {district}; using reported counts.")
+            continue
+        block = daily[:, rows, start:end + 1].reshape(3 * len(rows), length)
+        daily[:, rows, start:end + 1] = smooth(block).clip(0).astype(int).reshape(3, len(rows), length)
+    cumulative = daily.cumsum(axis = 2)
+
+    index     = np.arange(len(districts))
+    at_survey = gather_positions(dates, first, last, pd.Timestamp(survey_date))
+    at_start  = gather_positions(dates, first, last, simulation_start)
+    (dR_start, dD_start, dT_start) = daily[:, index, at_start]
+    (R_start,  D_start,  T_start)  = cumulative[:, index, at_start]
+    (R_conf,   _,        T_conf)   = cumulative[:, index, at_survey]
+
+    R_sero  = (districts[[f"sero_{i}" for i in range(7)]].values * districts[[f"N_{i}" for i in range(7)]].values).sum(axis = 1)
+    R_ratio = np.divide(R_sero, R_conf, out = np.ones(len(districts)), where = R_conf != 0)
+    R0 = R_start * R_ratio
+    D0 = D_start
+    T_sero  = R_sero + D0
+    T_ratio = np.divide(T_sero, T_conf, out = np.ones(len(districts)), where = T_conf != 0)
+    T0 = T_start * T_ratio
+    print("Scaled recoveries, deaths, and cases.")
+
+    return pd.DataFrame({
+        "S0"            : np.maximum(0, districts.N_tot.values - T0),
+        "I0"            : np.maximum(0, T0 - R0 - D0),
+        "R0"            : R0,
+        "D0"            : D0,
+        "dT0"           : dT_start * T_ratio,
+        "dD0"           : dD_start,
+        "pandemic_start": dates[first]
+    }, index = districts.index)
+
+def read_sero_pop(filename: str) -> pd.DataFrame:
+    return pd.read_csv(filename).set_index(["state", "district"])
+
+@instrumented("simulation_initial_conditions")
 def assemble_data(request):
-    state_code = get(request, 'state_code')
+    state_codes = get_state_codes(request)
+    force       = str(get(request, 'force')).lower() == "true"
+
+    bucket = get_bucket(bucket_name)
+
+    jobs = {}
+    for state_code in state_codes:
+        inputs = fingerprint(bucket, [
+            "pipeline/commons/refs/all_india_sero_pop.csv",
+            "pipeline/raw/state_case_timeseries.csv",
+            "pipeline/raw/district_case_timeseries.csv",
+            "pipeline/raw/vaccine_doses_statewise.csv",
+            f"pipeline/est/{state_code}_district_Rt.parquet",
+            f"pipeline/est/{state_code}_state_Rt.parquet"
+        ], sources = [__file__])
+        if not force and unchanged(bucket, f"sim/{state_code}", inputs):
+            print(f"Inputs for {state_code} ({state_code_lookup[state_code]}) unchanged since last successful run; skipping.")
+        else:
+            jobs[state_code] = (inputs,)
+    if not jobs:
+        return "OK!"
+
+    # national inputs are the same for every state, so download and parse them once per batch
+    with span("download"):
+        raw = download_buffers(bucket, [
+            "pipeline/raw/state_case_timeseries.csv",
+            "pipeline/raw/district_case_timeseries.csv",
+            "pipeline/raw/vaccine_doses_statewise.csv"
+        ])
+        district_age_pop = references.get(bucket, "pipeline/commons/refs/all_india_sero_pop.csv", read_sero_pop)
+    
+    with span("parse"):
+        state_ts = pd.read_csv(raw["pipeline/raw/state_case_timeseries.csv"], parse_dates = ["status_change_date"])\
+            .set_index(["detected_state", "status_change_date"])\
+            .drop(columns = ["date", "time", "delta", "logdelta"])\
+            .rename(columns = {
+                "Deceased":     "dD",
+                "Hospitalized": "dT",
+                "Recovered":    "dR"
+            })
+        district_ts = pd.read_csv(raw["pipeline/raw/district_case_timeseries.csv"], parse_dates = ["status_change_date"])\
+            .set_index(["detected_state", "detected_district", "status_change_date"])\
+            .drop(columns = ["date", "time", "delta", "logdelta"])\
+            .rename(columns = {
+                "Deceased":     "dD",
+                "Hospitalized": "dT",
+                "Recovered":    "dR"
+            })
+
+        vax = pd.read_csv(raw["pipeline/raw/vaccine_doses_statewise.csv"]).set_index("State").T.dropna()
+        vax.columns = vax.columns.str.title()
+        vax.set_index(pd.to_datetime(vax.index), inplace = True)
+
+    print(f"Downloaded shared simulation input data for {', '.join(jobs)}.")
+
+    failed = run_batch(assemble_state, jobs, {
+        "district_age_pop": district_age_pop,
+        "state_ts":         state_ts,
+        "district_ts":      district_ts,
+        "vax":              vax
+    })
+    if failed:
+        raise RuntimeError(f"assembling initial conditions failed for {', '.join(failed)}")
+    return "OK!"
+
+@instrumented("simulation_initial_conditions", label = "state_code")
+def assemble_state(state_code: str, inputs: dict):
     state = state_code_lookup[state_code]
 
     print(f"Assembling initial conditions for {state_code} ({state}).")
     
-    bucket = storage.Client().bucket(bucket_name)
-    data = Path("/tmp")
+    bucket = get_bucket(bucket_name)
 
-    bucket.blob("pipeline/commons/refs/all_india_sero_pop.csv")\
-        .download_to_filename(data / "all_india_sero_pop.csv")
-
-    bucket.blob("pipeline/raw/state_case_timeseries.csv")\
-        .download_to_filename(data / "state_case_timeseries.csv")
-
-    bucket.blob("pipeline/raw/district_case_timeseries.csv")\
-        .download_to_filename(data / "district_case_timeseries.csv")
-
-    bucket.blob("pipeline/raw/vaccine_doses_statewise.csv")\
-        .download_to_filename(data / "vaccine_doses_statewise.csv")
-
-    bucket.blob(f"pipeline/est/{state_code}_district_Rt.csv")\
-        .download_to_filename(data / f"{state_code}_district_Rt.csv")
-
-    bucket.blob(f"pipeline/est/{state_code}_state_Rt.csv")\
-        .download_to_filename(data / f"{state_code}_state_Rt.csv")
+    with span("download"):
+        estimates = download_buffers(bucket, [
+            f"pipeline/est/{state_code}_district_Rt.parquet",
+            f"pipeline/est/{state_code}_state_Rt.parquet"
+        ])
     
     print(f"Downloaded simulation input data for {state_code} ({state}).")
 
-    district_age_pop = pd.read_csv(data / "all_india_sero_pop.csv").set_index(["state", "district"])
-    
-    state_ts = pd.read_csv(data / "state_case_timeseries.csv")\
-        .set_index(["detected_state", "status_change_date"])\
-        .drop(columns = ["date", "time", "delta", "logdelta"])\
-        .rename(columns = {
-            "Deceased":     "dD",
-            "Hospitalized": "dT",
-            "Recovered":    "dR"
-        })
-    district_ts = pd.read_csv(data / "district_case_timeseries.csv")\
-        .set_index(["detected_state", "detected_district", "status_change_date"]).loc[state]\
-        .drop(columns = ["date", "time", "delta", "logdelta"])\
-        .rename(columns = {
-            "Deceased":     "dD",
-            "Hospitalized": "dT",
-            "Recovered":    "dR"
-        })
-    
-    state_Rt = pd.read_csv(data / f"{state_code}_state_Rt.csv",    index_col = 0, parse_dates = ["dates"])\
-        [["dates", "Rt_pred"]]\
-        .assign(district = state)\
-        .drop_duplicates(subset = "district", keep = "last")\
-        [["district", "Rt_pred"]]\
-        .set_index("district")
-    district_Rt = pd.read_csv(data / f"{state_code}_district_Rt.csv", index_col = 0, parse_dates = ["dates"])\
-        [["district", "dates", "Rt_pred"]]\
-        .drop_duplicates(subset = "district", keep = "last")\
-        [["district", "Rt_pred"]]\
-        .set_index("district")
-    
-    vax = pd.read_csv(data / "vaccine_doses_statewise.csv").set_index("State").T.dropna()
-    vax.columns = vax.columns.str.title()
-    vax.set_index(pd.to_datetime(vax.index), inplace = True)
+    district_age_pop = shared["district_age_pop"]
+    state_ts         = shared["state_ts"]
+    district_ts      = shared["district_ts"].loc[state]
+    vax              = shared["vax"]
 
-    smooth = notched_smoothing(window = window)
+    # each district's latest estimate; the Parquet files are sorted by date, so the last row per district is its latest
+    with span("parse"):
+        state_Rt = read_estimates(estimates[f"pipeline/est/{state_code}_state_Rt.parquet"], columns = ["dates", "Rt_pred"])\
+            .assign(district = state)\
+            .drop_duplicates(subset = "district", keep = "last")\
+            [["district", "Rt_pred"]]\
+            .set_index("district")
+        district_Rt = read_estimates(estimates[f"pipeline/est/{state_code}_district_Rt.parquet"], columns = ["district", "dates", "Rt_pred"])\
+            .drop_duplicates(subset = "district", keep = "last")\
+            [["district", "Rt_pred"]]\
+            .set_index("district")
+    
     simulation_start = pd.Timestamp.today() - pd.Timedelta(days = cutoff)
 
     districts_to_run = district_age_pop.loc[state]
@@ -116,64 +214,25 @@ def assemble_data(request):
     print(f"Done reading input data for {state_code} ({state}).")
     print(f"Running seroprevalence scaling for districts.")
 
-    rows = []
-    for _ in districts_to_run.dropna().itertuples():
-        district, sero_0, sero_1, sero_2, sero_3, sero_4, sero_5, sero_6, N_0, N_1, N_2, N_3, N_4, N_5, N_6, N_tot, Rt = _
-        print(f"Scaling for {state_code}/{district}.")
-
-        dR_conf = ts.loc[district].dR
-        dR_conf = dR_conf.reindex(pd.date_range(dR_conf.index.min(), dR_conf.index.max()), fill_value = 0)
-        if len(dR_conf) >= window + 1:
-            dR_conf_smooth = pd.Series(smooth(dR_conf), index = dR_conf.index).clip(0).astype(int)
-        else: 
-            dR_conf_smooth = dR_conf
-
-        R_conf_smooth  = dR_conf_smooth.cumsum().astype(int)
-        R_conf = R_conf_smooth[survey_date if survey_date in R_conf_smooth.index else -1]
-        R_sero = (sero_0*N_0 + sero_1*N_1 + sero_2*N_2 + sero_3*N_3 + sero_4*N_4 + sero_5*N_5 + sero_6*N_6)
-        R_ratio = R_sero/R_conf if R_conf != 0 else 1 
-        R0 = R_conf_smooth[simulation_start if simulation_start in R_conf_smooth.index else -1] * R_ratio
-        print("Scaled recoveries.")
-        
-        dD_conf = ts.loc[district].dD
-        dD_conf = dD_conf.reindex(pd.date_range(dD_conf.index.min(), dD_conf.index.max()), fill_value = 0)
-        if len(dD_conf) >= window + 1:
-            dD_conf_smooth = pd.Series(smooth(dD_conf), index = dD_conf.index).clip(0).astype(int)
-        else:
-            dD_conf_smooth = dD_conf
-        D_conf_smooth  = dD_conf_smooth.cumsum().astype(int)
-        D0 = D_conf_smooth[simulation_start if simulation_start in D_conf_smooth.index else -1]
-        print("Scaled deaths.")
-        
-        dT_conf = ts.loc[district].dT
-        pandemic_start = dT_conf.index.min()
-        dT_conf = dT_conf.reindex(pd.date_range(dT_conf.index.min(), dT_conf.index.max()), fill_value = 0)
-        if len(dT_conf) >= window + 1:
-            dT_conf_smooth = pd.Series(smooth(dT_conf), index = dT_conf.index).clip(0).astype(int)
-        else:
-            dT_conf_smooth = dT_conf
-        T_conf_smooth  = dT_conf_smooth.cumsum().astype(int)
-        T_conf = T_conf_smooth[survey_date if survey_date in T_conf_smooth.index else -1]
-        T_sero = R_sero + D0 
-        T_ratio = T_sero/T_conf if T_conf != 0 else 1 
-        T0 = T_conf_smooth[simulation_start if simulation_start in T_conf_smooth.index else -1] * T_ratio
-        print("Scaled cases.")
-
-        S0 = max(0, N_tot - T0)
-        dD0 = dD_conf_smooth[simulation_start if simulation_start in dD_conf_smooth.index else -1]
-        dT0 = dT_conf_smooth[simulation_start if simulation_start in dT_conf_smooth.index else -1] * T_ratio
-        I0 = max(0, (T0 - R0 - D0))
-
-        V0 = vax[state][simulation_start if simulation_start in vax.index else -1] * N_tot / districts_to_run.N_tot.sum()
-        print("Resolved vaccination data.")
-
-        rows.append((state_code, state, district, 
-            sero_0, N_0, sero_1, N_1, sero_2, N_2, sero_3, N_3, sero_4, N_4, sero_5, N_5, sero_6, N_6, N_tot, 
-            Rt, S0, I0, R0, D0, dT0, dD0, V0, pandemic_start
-        ))
-    
-    pd.DataFrame(rows, columns = columns).to_csv(data / f"{state_code}_simulation_initial_conditions.csv")
-    bucket.blob(f"pipeline/sim/input/{state_code}_simulation_initial_conditions.csv")\
-        .upload_from_filename(str(data / f"{state_code}_simulation_initial_conditions.csv"), content_type = "text/csv")
-
-    return "OK!"
+    scaled = districts_to_run.dropna()
+    missing = scaled.index.difference(ts.index.get_level_values(0))
+    if len(missing):
+        print(f"No case time series for {state_code}/{', '.join(missing)}; skipping.")
+        scaled = scaled.drop(missing)
+    with span("smooth"):
+        scaled = scaled.join(seroprevalence_scaling(ts, scaled, simulation_start))
+
+    scaled["V0"] = vax[state][simulation_start if simulation_start in vax.index else -1] * scaled.N_tot / districts_to_run.N_tot.sum()
+    print("Resolved vaccination data.")
+
+    initial_conditions = scaled\
+        .rename(columns = {"Rt_pred": "Rt"})\
+        .assign(state_code = state_code, state = state)\
+        .rename_axis("district")\
+        .reset_index()\
+        [columns]\
+        .to_csv()
+    with span("upload"):
+        upload_buffers(bucket, {f"pipeline/sim/input/{state_code}_simulation_initial_conditions.csv": (initial_conditions, "text/csv")})
+
+    write_manifest(bucket, f"sim/{state_code}", inputs)
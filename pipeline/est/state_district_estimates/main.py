@@ -1,134 +1,122 @@
-import traceback
+from typing import List
 
+import numpy as np
 import pandas as pd
-from epimargin.estimators import analytical_MPVS
 from epimargin.etl.covid19india import state_code_lookup
-from epimargin.smoothing import notched_smoothing
-from google.cloud import storage
-
-# model details 
-gamma     = 0.1 # 10 day infectious period
-smoothing = 10
-CI        = 0.95
-lookback  = 120 # how many days back to start estimation
-cutoff    = 2   # most recent data to use 
-dissolved_states = ["Delhi", "Chandigarh", "Manipur", "Sikkim", "Dadra And Nagar Haveli And Daman And Diu", "Andaman And Nicobar Islands", "Telangana", "Goa", "Assam", "Lakshadweep"]
-excluded = ["Unknown", "Other State", "Other Region" "Airport Quarantine", "Railway Quarantine", "BSF Camp", "Foreign Evacuees", "Italians", "Evacuees"]
+from batch import get, get_state_codes, run_batch, shared
+from blobs import download_buffers, get_bucket
+from columnar import write_estimates
+from instrumentation import instrumented, span
+from manifest import fingerprint, unchanged, upload_if_changed, write_manifest
+from mpvs import dissolved_states, estimate_columns
+from references import references
 
 # cloud details 
 bucket_name = "daily_pipeline"
 
+# estimates are made for every state and district at once by natl_state_estimates; this step publishes each state's
+# share of them with the LGD names and ids used downstream
+def estimates_blob(state_code: str) -> str:
+    return f"pipeline/est/hierarchy/{state_code}_Rt.parquet"
 
+def input_blobs(state_code: str) -> List[str]:
+    return [
+        "pipeline/commons/refs/all_crosswalk.dta",
+        estimates_blob(state_code)
+    ]
 
-def get(request, key):
-    request_json = request.get_json()
-    if request.args and key in request.args:
-        return request.args.get(key)
-    elif request_json and key in request_json:
-        return request_json[key]
-    else:
-        return None
+def read_crosswalk(filename: str) -> dict:
+    """ LGD names and ids, indexed by API state name and by (API state name, API district name); first match wins """
+    crosswalk = pd.read_stata(filename)
+    states    = crosswalk.set_index("state_api").filter(like = "lgd_state")
+    districts = crosswalk.set_index(["state_api", "district_api"]).filter(like = "lgd_district")
+    return {
+        "states":    states[~states.index.duplicated()],
+        "districts": districts[~districts.index.duplicated()]
+    }
 
+@instrumented("state_district_estimates")
 def run_estimates(request):
-    state_code = get(request, 'state_code')
+    state_codes = get_state_codes(request)
+    force       = str(get(request, 'force')).lower() == "true"
+
+    bucket = get_bucket(bucket_name)
+    jobs = {}
+    for state_code in state_codes:
+        inputs = fingerprint(bucket, input_blobs(state_code), sources = [__file__])
+        if not force and unchanged(bucket, f"est/{state_code}", inputs):
+            print(f"Inputs for {state_code} unchanged since last successful run; skipping.")
+        else:
+            jobs[state_code] = (inputs,)
+    if not jobs:
+        return "OK!"
+
+    # the crosswalk is the same for every state, so load it once per batch (or not at all on a warm instance)
+    with span("download", blob = "crosswalk"):
+        crosswalk = references.get(bucket, "pipeline/commons/refs/all_crosswalk.dta", read_crosswalk)
+
+    failed = run_batch(publish_state, jobs, {"crosswalk": crosswalk})
+    if failed:
+        raise RuntimeError(f"Publishing Rt estimates failed for {', '.join(failed)}")
+    return "OK!"
+
+@instrumented("state_district_estimates", label = "state_code")
+def publish_state(state_code: str, inputs: dict):
     state = state_code_lookup[state_code]
+    crosswalk = shared["crosswalk"]
+
+    print(f"Publishing Rt estimates for {state} ({state_code})")
+
+    bucket = get_bucket(bucket_name)
 
-    print(f"Rt estimation for {state} ({state_code}) started")
-    
-    bucket = storage.Client().bucket(bucket_name)
-    bucket.blob("pipeline/commons/refs/all_crosswalk.dta")\
-        .download_to_filename("/tmp/all_crosswalk.dta")
-
-    bucket.blob("pipeline/raw/states.csv")\
-        .download_to_filename("/tmp/states.csv")
-
-    bucket.blob("pipeline/raw/districts.csv")\
-        .download_to_filename("/tmp/districts.csv")
-
-    crosswalk   = pd.read_stata("/tmp/all_crosswalk.dta")
-    district_cases = pd.read_csv("/tmp/districts.csv")\
-        .rename(columns = str.lower)\
-        .set_index(["state", "district", "date"])\
-        .sort_index()\
-        .rename(index = lambda s: s.replace(" and ", " & "), level = 0)\
-        .loc[state]
-    state_cases = pd.read_csv("/tmp/states.csv")\
-        .rename(columns = str.lower)\
-        .set_index(["state", "date"])\
-        .sort_index()\
-        .rename(index = lambda s: s.replace(" and ", " & "), level = 0)\
-        .loc[state]
-    print(f"Estimating state-level Rt for {state_code}") 
+    with span("download"):
+        blob = download_buffers(bucket, [estimates_blob(state_code)], missing_ok = True)[estimates_blob(state_code)]
+    if blob is None:
+        raise ValueError(f"no estimates for {state_code}; has natl_state_estimates run?")
+    with span("parse"):
+        estimates = pd.read_parquet(blob)
     normalized_state = state.replace(" and ", " And ").replace(" & ", " And ")
-    lgd_state_name, lgd_state_id = crosswalk.query("state_api == @normalized_state").filter(like = "lgd_state").drop_duplicates().iloc[0]
-    try:
-        (
-            dates,
-            Rt_pred, Rt_CI_upper, Rt_CI_lower,
-            T_pred, T_CI_upper, T_CI_lower,
-            total_cases, new_cases_ts, *_
-        ) = analytical_MPVS(
-            state_cases.iloc[-lookback:-cutoff].confirmed, 
-            CI = CI, smoothing = notched_smoothing(window = smoothing), totals = True
-        )
-
-        pd.DataFrame(data = {
-            "dates": dates[1:],
-            "Rt_pred": Rt_pred,
-            "Rt_CI_upper": Rt_CI_upper,
-            "Rt_CI_lower": Rt_CI_lower,
-            "T_pred": T_pred,
-            "T_CI_upper": T_CI_upper,
-            "T_CI_lower": T_CI_lower,
-            "total_cases": total_cases[2:],
-            "new_cases_ts": new_cases_ts,
-        })\
-            .assign(state = state, lgd_state_name = lgd_state_name, lgd_state_id = lgd_state_id)\
-            .to_csv("/tmp/state_Rt.csv")
+    lgd_state_name, lgd_state_id = crosswalk["states"].loc[normalized_state]
+
+    is_state = estimates.district.isna()
+    state_Rt = estimates[is_state][estimate_columns].reset_index(drop = True)
+    if state_Rt.empty:
+        raise ValueError("no estimates produced")
+    state_Rt = state_Rt.assign(state = state, lgd_state_name = lgd_state_name, lgd_state_id = lgd_state_id)
+    with span("write", level = "state"):
+        state_Rt.to_csv(f"/tmp/{state_code}_state_Rt.csv")
+        write_estimates(state_Rt, f"/tmp/{state_code}_state_Rt.parquet")
+
+    # upload to cloud
+    with span("upload", level = "state"):
+        upload_if_changed(bucket, f"pipeline/est/{state_code}_state_Rt.csv",     f"/tmp/{state_code}_state_Rt.csv",     content_type = "text/csv")
+        upload_if_changed(bucket, f"pipeline/est/{state_code}_state_Rt.parquet", f"/tmp/{state_code}_state_Rt.parquet", content_type = "application/octet-stream")
 
-        # upload to cloud
-        bucket.blob(f"pipeline/est/{state_code}_state_Rt.csv").upload_from_filename("/tmp/state_Rt.csv",    content_type = "text/csv")
-    except Exception as e:
-        print(f"ERROR when estimating Rt for {state_code}", e)
-        print(traceback.print_exc())
-    
     if normalized_state in dissolved_states:
         print(f"Skipping district-level Rt for {state_code}")
     else:
-        print(f"Estimating district-level Rt for {state} ({state_code})")
-        estimates = []
-        for district in filter(lambda _: _.strip() not in excluded, district_cases.index.get_level_values(0).unique()):
-            print(f"running estimation for [{district}]")
-            lgd_district_data = crosswalk.query("state_api == @normalized_state & district_api == @district").filter(like = "lgd_district").drop_duplicates()
-            if not lgd_district_data.empty:
-                lgd_district_name, lgd_district_id = lgd_district_data.iloc[0]
-            else:
-                lgd_district_name, lgd_district_id = lgd_state_name, lgd_state_id
-            try:
-                (
-                    dates,
-                    Rt_pred, Rt_CI_upper, Rt_CI_lower,
-                    T_pred, T_CI_upper, T_CI_lower,
-                    total_cases, new_cases_ts, *_
-                ) = analytical_MPVS(district_cases.loc[district].iloc[-lookback:-cutoff].confirmed, CI = CI, smoothing = notched_smoothing(window = smoothing), totals = True)
-                estimates.append(pd.DataFrame(data = {
-                    "dates": dates[1:],
-                    "Rt_pred": Rt_pred,
-                    "Rt_CI_upper": Rt_CI_upper,
-                    "Rt_CI_lower": Rt_CI_lower,
-                    "T_pred": T_pred,
-                    "T_CI_upper": T_CI_upper,
-                    "T_CI_lower": T_CI_lower,
-                    "total_cases": total_cases[2:],
-                    "new_cases_ts": new_cases_ts,
-                }).assign(state = state, lgd_state_name = lgd_state_name, lgd_state_id = lgd_state_id, district = district, lgd_district_name = lgd_district_name, lgd_district_id = lgd_district_id))
-            except Exception as e:
-                print(f"ERROR when estimating Rt for {district}, {state_code}", e)
-                print(traceback.print_exc())
-
-        pd.concat(estimates).to_csv("/tmp/district_Rt.csv")
-    
+        # each district's rows are numbered from its first estimate, as in the estimator's output
+        district_Rt = estimates[~is_state]
+        district_Rt.index = district_Rt.groupby("district", sort = False).cumcount().values
+
+        # districts missing from the crosswalk fall back to the state's LGD name and id
+        keys  = pd.MultiIndex.from_arrays([[normalized_state] * len(district_Rt), district_Rt.district.values])
+        found = keys.isin(crosswalk["districts"].index)
+        lgd   = crosswalk["districts"].reindex(keys)
+        lgd_district_name = np.where(found, lgd.iloc[:, 0].values, lgd_state_name)
+        lgd_district_id   = np.where(found, lgd.iloc[:, 1].values, lgd_state_id)
+
+        district_Rt = district_Rt[estimate_columns]\
+            .assign(
+                state = state, lgd_state_name = lgd_state_name, lgd_state_id = lgd_state_id,
+                district = district_Rt.district.values, lgd_district_name = lgd_district_name, lgd_district_id = lgd_district_id)
+        with span("write", level = "district"):
+            district_Rt.to_csv(f"/tmp/{state_code}_district_Rt.csv")
+            write_estimates(district_Rt, f"/tmp/{state_code}_district_Rt.parquet")
+
         # upload to cloud
-        bucket.blob(f"pipeline/est/{state_code}_district_Rt.csv").upload_from_filename("/tmp/district_Rt.csv", content_type = "text/csv")
-    
-    return "OK!"
+        with span("upload", level = "district"):
+            upload_if_changed(bucket, f"pipeline/est/{state_code}_district_Rt.csv",     f"/tmp/{state_code}_district_Rt.csv",     content_type = "text/csv")
+            upload_if_changed(bucket, f"pipeline/est/{state_code}_district_Rt.parquet", f"/tmp/{state_code}_district_Rt.parquet", content_type = "application/octet-stream")
+
+    write_manifest(bucket, f"est/{state_code}", inputs)
@@ -0,0 +1 @@
+../../commons/references.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../commons/blobs.py
\ No newline at end of file
@@ -1,13 +1,31 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
 from datetime import date
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List
 
-import tweepy
-from google.cloud import secretmanager, storage
+from batch import get_state_codes
+from blobs import get_bucket, map_concurrently
+from instrumentation import add_bytes, instrumented, span
 
 # cloud details
 project_id = "adaptive-control"
 bucket_name = "daily_pipeline"
-bucket = storage.Client().bucket(bucket_name)
-secrets = secretmanager.SecretManagerServiceClient()
+
+# with TWITTER_BACKEND=local, nothing is posted: secrets come from the environment and tweets are written under TWITTER_ROOT
+twitter_backend = os.environ.get("TWITTER_BACKEND", "api")
+twitter_root    = os.environ.get("TWITTER_ROOT", os.path.join(tempfile.gettempdir(), "tweets"))
+
+# warm instances reuse the authenticated client, re-reading the secrets once it is this old
+client_ttl = 3600
+# seconds between consecutive tweets in a batch, well inside the limits on posting statuses
+tweet_interval = 15
 
 tag_states       = ["MH", "BR", "PB", "TN", "KL"]
 dissolved_states = ["Delhi", "Chandigarh", "Manipur", "Sikkim", "Dadra And Nagar Haveli And Daman And Diu", "Andaman And Nicobar Islands", "Telangana", "Goa", "Assam", "Lakshadweep"]
@@ -58,39 +76,93 @@ state_code_lookup = {
 #  secret names
 secret_names = ["API_key", "secret_key", "access_token", "access_secret"]
 
-def get(request, key):
-    request_json = request.get_json()
-    if request.args and key in request.args:
-        return request.args.get(key)
-    elif request_json and key in request_json:
-        return request_json[key]
-    else:
-        return None
+class SecretManagerStore:
+    """ secrets by name from Secret Manager; the client is only created on first use """
 
-def get_twitter_client(env = "PROD"):
-    credentials = { 
-        secret_name: secrets.access_secret_version({
-            "name": f"projects/{project_id}/secrets/{env}_twitter_{secret_name}/versions/latest"}
-        ).payload.data.decode("UTF-8")
-        for secret_name in secret_names
-    }
+    def __init__(self, project_id: str):
+        self.project_id = project_id
+        self.client     = None
+
+    def get(self, name: str) -> str:
+        if self.client is None:
+            from google.cloud import secretmanager
+            self.client = secretmanager.SecretManagerServiceClient()
+        return self.client.access_secret_version({"name": f"projects/{self.project_id}/secrets/{name}/versions/latest"}).payload.data.decode("UTF-8")
+
+def connect(credentials: Dict[str, str]):
+    import tweepy
     auth = tweepy.OAuthHandler(credentials["API_key"], credentials["secret_key"])
     auth.set_access_token(credentials["access_token"], credentials["access_secret"])
     api = tweepy.API(auth, wait_on_rate_limit = True, wait_on_rate_limit_notify = True)
     api.verify_credentials()
     return api
 
-def tweet_report(request):
-    state_code = get(request, "state_code")
+class TwitterClients:
+    """ authenticated Twitter clients by environment, kept across warm invocations until `ttl` seconds old;
+    the secret store and the function connecting to the API can be replaced, e.g. with local stubs """
+
+    def __init__(self, secret_store, connect: Callable = connect, ttl: float = client_ttl):
+        self.secret_store = secret_store
+        self.connect      = connect
+        self.ttl          = ttl
+        self.clients      = {}
+        self.lock         = threading.Lock()
+
+    def get(self, env: str = "PROD"):
+        with self.lock:
+            (client, expiry) = self.clients.get(env, (None, 0))
+            if time.time() < expiry:
+                return client
+            print(f"Authenticating {env} Twitter client.")
+            credentials = dict(zip(secret_names, map_concurrently(lambda name: self.secret_store.get(f"{env}_twitter_{name}"), secret_names)))
+            client = self.connect(credentials)
+            self.clients[env] = (client, time.time() + self.ttl)
+            return client
+
+    def invalidate(self, env: str = "PROD"):
+        with self.lock:
+            self.clients.pop(env, None)
+
+class EnvironmentSecretStore:
+    """ secrets from environment variables of the same name, empty if unset """
+
+    def get(self, name: str) -> str:
+        return os.environ.get(name, "")
+
+class LocalTwitter:
+    """ the parts of tweepy.API used here, writing media and statuses under `root` instead of posting them """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.lock = threading.Lock()
+        (self.root/"media").mkdir(parents = True, exist_ok = True)
+
+    def media_upload(self, filename):
+        with self.lock:
+            media_id = len(list((self.root/"media").iterdir()))
+            shutil.copy(filename, self.root/"media"/f"{media_id}{Path(filename).suffix}")
+        return SimpleNamespace(media_id = media_id)
+
+    def update_status(self, status: str, media_ids: List[int]):
+        with self.lock, open(self.root/"statuses.jsonl", "a") as dst:
+            dst.write(json.dumps({"status": status, "media_ids": media_ids}) + "\n")
+
+if twitter_backend == "local":
+    clients = TwitterClients(EnvironmentSecretStore(), connect = lambda _: LocalTwitter(twitter_root))
+else:
+    clients = TwitterClients(SecretManagerStore(project_id))
+
+def get_twitter_client(env = "PROD"):
+    return clients.get(env)
+
+def report_blobs(state_code: str):
+    """ the report images to attach for a state, and caveats for those left out """
     state = state_code_lookup[state_code]
     normalized_state = state.replace(" and ", " And ").replace(" & ", " And ")
-    print(f"Tweeting report for {state_code} ({state}).")
-
     blobs = []
     caveats = []
 
-    bucket.blob(f"pipeline/rpt/{state_code}_Rt_timeseries.png").download_to_filename(f"/tmp/{state_code}_Rt_timeseries.png")
-    blobs.append(f"/tmp/{state_code}_Rt_timeseries.png")
+    blobs.append(f"{state_code}_Rt_timeseries.png")
     
     if normalized_state in (dissolved_states + island_states):
         if normalized_state in dissolved_states:
@@ -98,22 +170,62 @@ def tweet_report(request):
         else: 
             caveats.append("map generation skipped")
     else:
-        bucket.blob(f"pipeline/rpt/{state_code}_Rt_choropleth.png").download_to_filename(f"/tmp/{state_code}_Rt_choropleth.png")
-        blobs.append(f"/tmp/{state_code}_Rt_choropleth.png")
+        blobs.append(f"{state_code}_Rt_choropleth.png")
     
     if normalized_state not in dissolved_states:
-        bucket.blob(f"pipeline/rpt/{state_code}_Rt_top10.png").download_to_filename(f"/tmp/{state_code}_Rt_top10.png")
-        blobs.append(f"/tmp/{state_code}_Rt_top10.png")
-    
+        blobs.append(f"{state_code}_Rt_top10.png")
+    return (blobs, caveats)
+
+@instrumented("tweet_reports", label = "state_code")
+def tweet_state(state_code: str, twitter):
+    state = state_code_lookup[state_code]
+    print(f"Tweeting report for {state_code} ({state}).")
+    (blobs, caveats) = report_blobs(state_code)
+    bucket = get_bucket(bucket_name)
+
+    # each image is uploaded to Twitter as soon as it is downloaded, all images at once
+    def attach(blob: str) -> int:
+        bucket.blob(f"pipeline/rpt/{blob}").download_to_filename(f"/tmp/{blob}")
+        size = os.path.getsize(f"/tmp/{blob}")
+        add_bytes(received = size)
+        media_id = twitter.media_upload(f"/tmp/{blob}").media_id
+        add_bytes(sent = size)
+        return media_id
+    with span("upload"):
+        media_ids = map_concurrently(attach, blobs)
+
     hashtag = f"#COVIDmetrics{state_code}"
     tag     = "@anup_malani" if state_code in tag_states else ""
     caveat_text = " (" + ", ".join(caveats) + ") " if caveats else " "
-
-    twitter = get_twitter_client()
-    media_ids = [twitter.media_upload(blob).media_id for blob in blobs]
     today = date.today().strftime("%d %b %Y")
-    twitter.update_status(
-        status    = f"Rt report for {state}, {today}{caveat_text}#covid #Rt #india {hashtag} {tag}", 
-        media_ids = media_ids
-    )
+    with span("tweet"):
+        twitter.update_status(
+            status    = f"Rt report for {state}, {today}{caveat_text}#covid #Rt #india {hashtag} {tag}", 
+            media_ids = media_ids
+        )
+
+@instrumented("tweet_reports")
+def tweet_report(request):
+    state_codes = get_state_codes(request)
+
+    with span("authenticate"):
+        twitter = clients.get()
+
+    # tweets in a batch are spaced out; a state that fails does not hold up the rest
+    failed = []
+    last_tweet = None
+    for state_code in state_codes:
+        if last_tweet is not None:
+            time.sleep(max(0, last_tweet + tweet_interval - time.monotonic()))
+        try:
+            tweet_state(state_code, twitter)
+        except Exception as e:
+            print(f"ERROR when tweeting report for {state_code}", e)
+            traceback.print_exc()
+            failed.append(state_code)
+            # re-authenticate on the next invocation, in case the credentials were rotated
+            clients.invalidate()
+        last_tweet = time.monotonic()
+    if failed:
+        raise RuntimeError(f"Tweeting failed for {', '.join(failed)}")
     return "OK!"
@@ -1,33 +1,37 @@
+import datetime
 from pathlib import Path
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup as bs
-from epimargin.etl.commons import download_data
-from epimargin.etl.covid19india import (data_path, get_time_series,
-                                        load_all_data)
-from epimargin.utils import mkdir
-from google.cloud import storage
+from blobs import get_bucket, map_concurrently
+from instrumentation import add_bytes, instrumented, span
+from manifest import upload_if_changed, write_manifest
 
 # cloud details 
 bucket_name = "daily_pipeline"
 
+@instrumented("get_state_timeseries")
 def run_download(_):
-    run_date = pd.Timestamp.now().strftime("%d-%m-%Y") 
+    from epimargin.etl.commons import download_data
+
+    run_date = datetime.datetime.now().strftime("%d-%m-%Y")
     print(f"Starting download of API files on {run_date}")
     # set up
     root = Path("/tmp")
-    data = mkdir(root/"data")
+    data = root/"data"
+    data.mkdir(exist_ok = True)
 
     # download aggregated CSVs as well
-    download_data(data, "states.csv")
-    download_data(data, "districts.csv")
+    with span("download"):
+        for filename in ("states.csv", "districts.csv"):
+            download_data(data, filename)
+            add_bytes(received = (data/filename).stat().st_size)
 
     print("Uploading time series to storage bucket.")
-    bucket = storage.Client().bucket(bucket_name)
-    bucket.blob("pipeline/raw/districts.csv")\
-        .upload_from_filename(str(data/"districts.csv"), content_type = "text/csv")
-    bucket.blob("pipeline/raw/states.csv")\
-        .upload_from_filename(str(data/"states.csv"), content_type = "text/csv")
+    bucket = get_bucket(bucket_name)
+    blob_names = ["pipeline/raw/districts.csv", "pipeline/raw/states.csv"]
+    with span("upload"):
+        write_manifest(bucket, "raw/get_timeseries", dict(zip(blob_names, map_concurrently(
+            lambda blob_name: upload_if_changed(bucket, blob_name, data/Path(blob_name).name, content_type = "text/csv"),
+            blob_names
+        ))))
 
     return 'OK!'
@@ -1,32 +1,36 @@
+import datetime
 from pathlib import Path
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup as bs
-from epimargin.etl.commons import download_data
-from epimargin.etl.covid19india import (data_path, get_time_series,
-                                        load_all_data)
-from epimargin.utils import mkdir
-from google.cloud import storage
+from blobs import get_bucket
+from instrumentation import add_bytes, instrumented, span
+from manifest import upload_if_changed, write_manifest
 
 # cloud details 
 bucket_name = "daily_pipeline"
 
+@instrumented("get_vax_data")
 def run_download(_):
+    from epimargin.etl.commons import download_data
+
     # set up
     root = Path("/tmp")
-    data = mkdir(root/"data")
-    run_date = pd.Timestamp.now().strftime("%d-%m-%Y") 
+    data = root/"data"
+    data.mkdir(exist_ok = True)
+    run_date = datetime.datetime.now().strftime("%d-%m-%Y")
     print(f"Starting download of vaccination data files on {run_date}")
 
-    download_data(data, "vaccine_doses_statewise.csv")
+    with span("download"):
+        download_data(data, "vaccine_doses_statewise.csv")
+        add_bytes(received = (data/"vaccine_doses_statewise.csv").stat().st_size)
 
     print("Uploading vaccination data to storage bucket.")
-    storage.Client()\
-        .bucket(bucket_name)\
-        .blob("pipeline/raw/vaccine_doses_statewise.csv")\
-        .upload_from_filename(
-            str(data/"vaccine_doses_statewise.csv"), 
-            content_type = "text/csv")
+    bucket = get_bucket(bucket_name)
+    with span("upload"):
+        write_manifest(bucket, "raw/get_vax_data", {
+            "pipeline/raw/vaccine_doses_statewise.csv": upload_if_changed(bucket, 
+                "pipeline/raw/vaccine_doses_statewise.csv", 
+                data/"vaccine_doses_statewise.csv", 
+                content_type = "text/csv")
+        })
 
     return 'OK!'
@@ -0,0 +1 @@
+../../commons/geometries.py
\ No newline at end of file
@@ -1,12 +1,25 @@
+import io
+import multiprocessing
 import os
-import time 
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 import epimargin.plots as plt
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import theme
+from blobs import download_many, get_bucket, upload_many
+from columnar import read_estimates
 from epimargin.etl.covid19india import state_code_lookup
-from flask import Flask
-from google.cloud import storage
+from flask import Flask, request
+from geometries import read_geometries, read_map, simplified_root
+from instrumentation import instrumented, span
+from manifest import fingerprint, unchanged, write_manifest
+from references import references
+from shapely.geometry import box
 
 dissolved_states = ["Delhi", "Chandigarh", "Manipur", "Sikkim", "Dadra And Nagar Haveli And Daman And Diu", "Andaman And Nicobar Islands", "Telangana", "Goa", "Assam"]
 island_states    = ["Lakshadweep", "Puducherry"]
@@ -15,108 +28,229 @@ app = Flask(__name__)
 CI        = 0.95
 smoothing = 10
 
+# rendering happens in a long-lived pool of worker processes, so each worker's figures and parsed maps stay warm across requests
+render_workers = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+pool      = None
+pool_lock = threading.Lock()
+warmed    = None # released by each of the pool's workers once it has warmed up
+warm_workers = 0 # how many of them the readiness probe has seen do so
+
+# one figure per artifact, cleared and redrawn for every state a worker renders
+templates = {}
+
+# set once every render worker has warmed up; until then the readiness probe keeps traffic away
+ready      = False
+ready_lock = threading.Lock()
+
 print("Container starting.")
-plt.rebuild_font_cache()
-plt.set_theme("twitter")
+theme.load()
 
 bucket_name = "daily_pipeline"
-bucket = storage.Client().bucket(bucket_name)
+bucket = get_bucket(bucket_name)
+
+def get_pool() -> ProcessPoolExecutor:
+    """ the shared render pool; workers are spawned rather than forked, since the server itself is multithreaded, and
+    each one warms up before taking its first job """
+    global pool, warmed, warm_workers
+    with pool_lock:
+        if pool is None:
+            context = multiprocessing.get_context("spawn")
+            (warmed, warm_workers) = (context.Semaphore(0), 0)
+            pool = ProcessPoolExecutor(max_workers = render_workers, mp_context = context, initializer = warm, initargs = (warmed,))
+        return pool
+
+def reset_pool():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown(wait = False)
+        pool = None
+
+def template(name: str, size = (3840/300, 1986/300)):
+    """ cleared figure for artifact `name`, made current so pyplot-style calls draw on it """
+    if name not in templates:
+        templates[name] = plt.figure()
+    fig = templates[name]
+    fig.clf()
+    if size:
+        fig.set_size_inches(*size)
+    plt.figure(fig.number)
+    return fig
+
+def render(state_codes, force: bool):
+    """ renders each state on the pool; returns the states that failed """
+    futures = {get_pool().submit(render_state, state_code, force): state_code for state_code in state_codes}
+    failed = []
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except BrokenProcessPool as e:
+            print(f"ERROR when rendering {futures[future]}: render pool broke", e)
+            reset_pool()
+            failed.append(futures[future])
+        except Exception as e:
+            print(f"ERROR when rendering {futures[future]}", e)
+            traceback.print_exc()
+            failed.append(futures[future])
+    return failed
+
+def warm(warmed = None):
+    """ render pool initializer: draws and saves a throwaway chart and map, so fonts, the renderer and geopandas are
+    loaded before the worker's first report, then releases `warmed` """
+    fig = template("timeseries")
+    plt.PlotDevice(fig).title("warm-up", ha = "center", x = 0.5)
+    gpd.GeoDataFrame({"Rt": [1.0]}, geometry = [box(0, 0, 1, 1)], crs = "EPSG:4326").plot(column = "Rt", ax = fig.add_subplot(1, 1, 1))
+    fig.savefig(io.BytesIO(), format = "png")
+    if warmed is not None:
+        warmed.release()
+
+@app.route("/ready")
+def readiness():
+    """ startup probe: starts every render worker and waits until each has warmed up, then reports ready """
+    global ready, warm_workers
+    with ready_lock:
+        if not ready:
+            # workers are started as jobs arrive, so one job per worker starts them all; a worker can finish its
+            # job before another has warmed up, so wait on the workers themselves
+            pool = get_pool()
+            for future in [pool.submit(os.getpid) for _ in range(render_workers)]:
+                future.result()
+            while warm_workers < render_workers:
+                if not warmed.acquire(timeout = 600):
+                    return "render workers still starting", 503
+                warm_workers += 1
+            print(f"Warmed {render_workers} render workers.")
+            ready = True
+    return "OK!"
 
 @app.route("/state/<state_code>")
 def generate_report(state_code: str):
     print(f"Received request for {state_code}.")
+    if render([state_code], request.args.get("force", "").lower() == "true"):
+        raise RuntimeError(f"report failed for {state_code}")
+    return "OK!"
+
+@app.route("/batch")
+def generate_reports():
+    """ renders every state in the comma-separated `state_codes` in one request """
+    state_codes = [_ for _ in request.args.get("state_codes", "").split(",") if _]
+    if not state_codes:
+        return "state_codes required", 400
+    print(f"Received batch request for {', '.join(state_codes)}.")
+    failed = render(state_codes, request.args.get("force", "").lower() == "true")
+    if failed:
+        raise RuntimeError(f"reports failed for {', '.join(sorted(failed))}")
+    return "OK!"
+
+@instrumented("get_twitter_images", label = "state_code")
+def render_state(state_code: str, force: bool):
     state = state_code_lookup[state_code]
     normalized_state = state.replace(" and ", " And ").replace(" & ", " And ")
-    blobs = { 
-        f"pipeline/est/{state_code}_state_Rt.csv"   : f"/tmp/state_Rt_{state_code}.csv",
-        f"pipeline/est/{state_code}_district_Rt.csv": f"/tmp/district_Rt_{state_code}.csv",
-        f"pipeline/commons/maps/{state_code}.json"  : f"/tmp/state_{state_code}.geojson"
+    blobs = {
+        f"pipeline/est/{state_code}_state_Rt.parquet"   : f"/tmp/state_Rt_{state_code}.parquet",
+        f"pipeline/est/{state_code}_district_Rt.parquet": f"/tmp/district_Rt_{state_code}.parquet",
     } if normalized_state not in dissolved_states else {
-        f"pipeline/est/{state_code}_state_Rt.csv"   : f"/tmp/state_Rt_{state_code}.csv",
+        f"pipeline/est/{state_code}_state_Rt.parquet"   : f"/tmp/state_Rt_{state_code}.parquet",
     }
-    for (blob_name, filename) in blobs.items():
-        bucket.blob(blob_name).download_to_filename(filename)
+    # maps are parsed through the reference cache rather than downloaded with the estimates;
+    # the simplified copy from misc/simplify_maps is used when present
+    (map_blob, read_map_blob) = (f"{simplified_root}/{state_code}.parquet", read_geometries)
+    if bucket.get_blob(map_blob) is None:
+        (map_blob, read_map_blob) = (f"pipeline/commons/maps/{state_code}.json", read_map)
+    inputs = fingerprint(bucket, list(blobs) + ([map_blob] if normalized_state not in dissolved_states else []), sources = [__file__])
+    if not force and unchanged(bucket, f"rpt/{state_code}", inputs):
+        print(f"Inputs for {state_code} unchanged since last successful run; skipping report.")
+        return
+    with span("download"):
+        download_many(bucket, blobs)
     print(f"Downloaded estimates for {state_code}.")
-    
-    state_Rt    = pd.read_csv(f"/tmp/state_Rt_{state_code}.csv",    parse_dates = ["dates"], index_col = 0)
-
-    plt.close("all")
-    dates = [pd.Timestamp(date).to_pydatetime() for date in state_Rt.dates]
-    plt.Rt(dates, state_Rt.Rt_pred, state_Rt.Rt_CI_lower, state_Rt.Rt_CI_upper, CI)\
-        .axis_labels("date", "$R_t$")\
-        .title(f"{state}: $R_t$ over time", ha = "center", x = 0.5)\
-        .adjust(left = 0.11, bottom = 0.16)
-    plt.gcf().set_size_inches(3840/300, 1986/300)
-    plt.savefig(f"/tmp/{state_code}_Rt_timeseries.png")
-    plt.close()
+    artifacts = {}
+
+    state_Rt    = read_estimates(f"/tmp/state_Rt_{state_code}.parquet", columns = ["dates", "Rt_pred", "Rt_CI_lower", "Rt_CI_upper"])
+
+    with span("render", artifact = "timeseries"):
+        fig = template("timeseries")
+        dates = [pd.Timestamp(date).to_pydatetime() for date in state_Rt.dates]
+        plt.Rt(dates, state_Rt.Rt_pred, state_Rt.Rt_CI_lower, state_Rt.Rt_CI_upper, CI)\
+            .axis_labels("date", "$R_t$")\
+            .title(f"{state}: $R_t$ over time", ha = "center", x = 0.5)\
+            .adjust(left = 0.11, bottom = 0.16)
+        fig.savefig(f"/tmp/{state_code}_Rt_timeseries.png")
     print(f"Generated timeseries plot for {state_code}.")
 
     # check output is at least 50 KB
     timeseries_size_kb = os.stat(f"/tmp/{state_code}_Rt_timeseries.png").st_size / 1000
     print(f"Timeseries artifact size: {timeseries_size_kb} kb")
     assert timeseries_size_kb > 50
-    bucket.blob(f"pipeline/rpt/{state_code}_Rt_timeseries.png").upload_from_filename(f"/tmp/{state_code}_Rt_timeseries.png", content_type = "image/png")
+    artifacts[f"pipeline/rpt/{state_code}_Rt_timeseries.png"] = (f"/tmp/{state_code}_Rt_timeseries.png", "image/png")
 
     if normalized_state not in (island_states + dissolved_states):
-        district_Rt = pd.read_csv(f"/tmp/district_Rt_{state_code}.csv", parse_dates = ["dates"], index_col = 0)
-        latest_Rt = district_Rt[district_Rt.dates == district_Rt.dates.max()].set_index("district")["Rt_pred"].to_dict()
-        top10 = [(k, "> 3.0" if v > 3 else f"{v:.2f}") for (k, v) in sorted(latest_Rt.items(), key = lambda t:t[1], reverse = True)[:10]]
-        
-        gdf = gpd.read_file(f"/tmp/state_{state_code}.geojson")
-        gdf["Rt"] = gdf.district.map(latest_Rt)
-        fig, ax = plt.subplots()
-        fig.set_size_inches(3840/300, 1986/300)
-        plt.choropleth(gdf, title = None, mappable = plt.get_cmap(0.75, 2.5), fig = fig, ax = ax)\
-            .adjust(left = 0)
-        plt.sca(fig.get_axes()[0])
-        plt.PlotDevice(fig).title(f"{state}: $R_t$ by district", ha = "center", x = 0.5)
-        plt.axis('off')
-        plt.savefig(f"/tmp/{state_code}_Rt_choropleth.png", dpi = 300)
-        plt.close() 
+        latest_Rt = read_estimates(f"/tmp/district_Rt_{state_code}.parquet", columns = ["district", "Rt_pred"], latest = True)
+        top10 = [(k, "> 3.0" if v > 3 else f"{v:.2f}") for (k, v) in latest_Rt.sort_values("Rt_pred", ascending = False, kind = "mergesort")[["district", "Rt_pred"]].values[:10]]
+
+        # parsed geometries stay cached in this worker between requests
+        with span("parse", artifact = "map"):
+            gdf = references.get(bucket, map_blob, read_map_blob).copy()
+        # maps are indexed by district, so estimates land in place by position rather than through a join
+        Rt = np.full(len(gdf), np.nan)
+        positions = gdf.index.get_indexer(latest_Rt.district)
+        Rt[positions[positions >= 0]] = latest_Rt.Rt_pred.values[positions >= 0]
+        gdf["Rt"] = Rt
+        with span("render", artifact = "choropleth"):
+            fig = template("choropleth")
+            ax  = fig.add_subplot(1, 1, 1)
+            plt.choropleth(gdf, title = None, mappable = plt.get_cmap(0.75, 2.5), fig = fig, ax = ax)\
+                .adjust(left = 0)
+            plt.sca(fig.get_axes()[0])
+            plt.PlotDevice(fig).title(f"{state}: $R_t$ by district", ha = "center", x = 0.5)
+            plt.axis('off')
+            fig.savefig(f"/tmp/{state_code}_Rt_choropleth.png", dpi = 300)
         print(f"Generated choropleth for {state_code}.")
 
         # check output is at least 100 KB
         choropleth_size_kb = os.stat(f"/tmp/{state_code}_Rt_choropleth.png").st_size / 1000
         print(f"Choropleth artifact size: {choropleth_size_kb} kb")
         assert choropleth_size_kb > 100
-        bucket.blob(f"pipeline/rpt/{state_code}_Rt_choropleth.png").upload_from_filename(f"/tmp/{state_code}_Rt_choropleth.png", content_type = "image/png")
+        artifacts[f"pipeline/rpt/{state_code}_Rt_choropleth.png"] = (f"/tmp/{state_code}_Rt_choropleth.png", "image/png")
     else:
         print(f"Skipped choropleth for {state_code}.")
 
 
     if normalized_state not in dissolved_states:
-        fig, ax = plt.subplots(1,1)
-        ax.axis('tight')
-        ax.axis('off')
-        table = ax.table(cellText = top10, colLabels = ["district", "$R_t$"], loc = 'center', cellLoc = "center")
-        table.scale(1, 2)
-        for (row, col), cell in table.get_celld().items():
-            if (row == 0):
-                cell.set_text_props(fontfamily = plt.theme.label["family"], fontsize = plt.theme.label["size"], fontweight = "semibold")
-            else:
-                cell.set_text_props(fontfamily = plt.theme.label["family"], fontsize = plt.theme.label["size"], fontweight = "light")
-        plt.PlotDevice().title(f"{state}: top districts by $R_t$", ha = "center", x = 0.5)
-        plt.savefig(f"/tmp/{state_code}_Rt_top10.png", dpi = 600)
-        plt.close()
+        with span("render", artifact = "top10"):
+            fig = template("top10", size = None)
+            ax  = fig.add_subplot(1, 1, 1)
+            ax.axis('tight')
+            ax.axis('off')
+            table = ax.table(cellText = top10, colLabels = ["district", "$R_t$"], loc = 'center', cellLoc = "center")
+            table.scale(1, 2)
+            for (row, col), cell in table.get_celld().items():
+                if (row == 0):
+                    cell.set_text_props(fontfamily = plt.theme.label["family"], fontsize = plt.theme.label["size"], fontweight = "semibold")
+                else:
+                    cell.set_text_props(fontfamily = plt.theme.label["family"], fontsize = plt.theme.label["size"], fontweight = "light")
+            plt.PlotDevice(fig).title(f"{state}: top districts by $R_t$", ha = "center", x = 0.5)
+            fig.savefig(f"/tmp/{state_code}_Rt_top10.png", dpi = 600)
         print(f"Generated top 10 district listing for {state_code}.")
 
         # check output is at least 50 KB
         top10_size_kb      = os.stat(f"/tmp/{state_code}_Rt_top10.png")     .st_size / 1000
         print(f"Top 10 listing artifact size: {top10_size_kb} kb")
         assert top10_size_kb      > 50
-        bucket.blob(f"pipeline/rpt/{state_code}_Rt_top10.png").upload_from_filename(f"/tmp/{state_code}_Rt_top10.png", content_type = "image/png")
+        artifacts[f"pipeline/rpt/{state_code}_Rt_top10.png"] = (f"/tmp/{state_code}_Rt_top10.png", "image/png")
     else:
         print(f"Skipped top 10 district listing for {state_code}.")
 
-    # sleep for 15 seconds to ensure the images finish saving
-    time.sleep(15)
+    # confirm each image landed intact rather than waiting and hoping
+    with span("upload"):
+        upload_many(bucket, artifacts, verify = True)
 
     print(f"Uploaded artifacts for {state_code}.")
-    return "OK!"
+    write_manifest(bucket, f"rpt/{state_code}", inputs)
 
 if __name__ == "__main__":
     app.run(
-        debug = True, 
-        host  = "0.0.0.0", 
+        debug = True,
+        host  = "0.0.0.0",
         port  = int(os.environ.get("PORT", 8080))
     )
@@ -0,0 +1 @@
+../../commons/manifest.py
\ No newline at end of file
@@ -0,0 +1,36 @@
+import os
+import pickle
+
+import epimargin.plots as plt
+import matplotlib as mpl
+
+# the report theme is applied once, when the image is built (`python3 theme.py`, after the fonts are installed and with
+# MPLCONFIGDIR pointing inside the image, so matplotlib's font cache is built there too); starting containers load the
+# snapshot instead of rescanning the system fonts and reapplying the theme
+snapshot_path = os.environ.get("THEME_SNAPSHOT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "twitter_theme.pkl"))
+
+def themed_params() -> dict:
+    """ rc parameters that differ from matplotlib's defaults; the backend is left to each process """
+    return {key: value for (key, value) in mpl.rcParams.items() if key != "backend" and mpl.rcParamsDefault.get(key) != value}
+
+def snapshot(path: str = snapshot_path):
+    """ rebuilds the font cache and saves the twitter theme's rc parameters """
+    plt.rebuild_font_cache()
+    plt.set_theme("twitter")
+    with open(path, "wb") as f:
+        pickle.dump(themed_params(), f)
+    print(f"Saved theme snapshot to {path}.")
+
+def load(path: str = snapshot_path):
+    """ applies the twitter theme from the snapshot, or from scratch if the image was built without one (e.g. when running locally) """
+    if not os.path.exists(path):
+        print(f"No theme snapshot at {path}; rebuilding font cache.")
+        plt.rebuild_font_cache()
+        return plt.set_theme("twitter")
+    with open(path, "rb") as f:
+        mpl.rcParams.update(pickle.load(f))
+    plt.theme = plt.twitter_settings
+    return plt.theme
+
+if __name__ == "__main__":
+    snapshot()
@@ -0,0 +1 @@
+../../commons/instrumentation.py
\ No newline at end of file
@@ -1,42 +1,315 @@
-from pathlib import Path
+from typing import List
 
+import numpy as np
 import pandas as pd
-from epimargin.etl.covid19india import state_code_lookup, state_name_lookup
-from epimargin.smoothing import notched_smoothing
-from google.cloud import storage
+from batch import get, get_state_codes, run_batch, shared
+from blobs import download_buffers, get_bucket, upload_buffers
+from epimargin.etl.covid19india import state_code_lookup
+from instrumentation import instrumented, span
+from manifest import fingerprint, unchanged, write_manifest
+from mpvs import infectious_period
 
-# model details 
-gamma     = 0.1 # 10 day infectious period
+# model details
+gamma     = 1 / infectious_period # the recovery rate the Rt estimates assume, so Rt means the same thing in both
+mortality = 0.02 # infection fatality rate
+ve        = 0.7  # share of doses that confer immunity
+phi       = 0.25 # share of the population vaccinated per year
 window    = 10
 CI        = 0.95
 lookback  = 120 # how many days back to start estimation
-cutoff    = 2   # most recent data to use 
+cutoff    = 2   # most recent data to use
 excluded = ["Unknown", "Other State", "Airport Quarantine", "Railway Quarantine"]
 coalesce_states = ["Delhi", "Manipur", "Dadra And Nagar Haveli And Daman And Diu", "Andaman And Nicobar Islands"]
 survey_date = "October 23, 2020"
 columns  = ["state_code", "state", "district", "sero_0", "N_0", "sero_1", "N_1", "sero_2", "N_2", "sero_3", "N_3", "sero_4", "N_4", "sero_5", "N_5", "sero_6", "N_6", "N_tot", "Rt", "S0", "I0", "R0", "D0", "dT0", "dD0", "V0", "pandemic_start"]
-# cloud details 
+# simulation details
+num_draws   = 5000
+horizon     = 60 # days to project
+random_seed = 0
+metrics     = ["dT", "dD", "I", "D", "V"]
+quantiles   = [(1 - CI)/2, 0.5, (1 + CI)/2]
+# scenario sweep details
+Rt_scalings     = [0.8, 0.9, 1.0, 1.1, 1.25] # interventions, as multiples of the current Rt
+vax_rates       = [0.0, 0.1, 0.25, 0.5, 1.0] # share of the population vaccinated per year
+num_bins        = 256
+max_chunk_bytes = 64 * 1024 * 1024 # simulation state per chunk of draws
+arrays_per_draw = 32 # compartments, rates and temporaries held per draw and district during a step
+# cloud details
 bucket_name = "daily_pipeline"
 
-def get(request, key):
-    request_json = request.get_json()
-    if request.args and key in request.args:
-        return request.args.get(key)
-    elif request_json and key in request_json:
-        return request_json[key]
-    else:
-        return None
+def compartments(initial_conditions: pd.DataFrame, draws: int, days: int, rng: np.random.Generator, Rt_scale: float = 1.0, phi: float = phi):
+    """ stochastic SIRV projection of every district at once, with compartments held as (draw × district) arrays;
+    yields each day's compartments and new cases and deaths by name (the arrays are updated in place on the next day) """
+    tile = lambda column: np.tile(initial_conditions[column].values.astype(float), (draws, 1))
 
+    (N, Rt0) = (tile("N_tot"), Rt_scale * tile("Rt"))
+    (S, I, R, D, dT) = (tile("S0"), tile("I0"), tile("R0"), tile("D0"), tile("dT0"))
+
+    # doses given so far landed on susceptibles in proportion to S/N, and a share `ve` of those conferred immunity
+    V = np.minimum(S, ve * tile("V0") * np.divide(S, N, out = np.zeros_like(S), where = N > 0))
+    S -= V
+    daily_doses = phi * N / 365
+
+    # the Rt estimate already reflects current immunity, so transmission scales with susceptibles relative to today
+    S_start = S.copy()
+    b = np.exp(gamma * (Rt0 - 1))
+
+    for _ in range(days):
+        # new infections from the previous day's, capped by the susceptible pool
+        dT = np.minimum(S, rng.poisson(np.minimum(b * dT, S)))
+        S -= dT
+        I += dT
+
+        dD = np.minimum(I, rng.poisson(mortality * gamma * I))
+        dR = np.minimum(I - dD, rng.poisson((1 - mortality) * gamma * I))
+        I -= dD + dR
+        R += dR
+        D += dD
+
+        living = S + V + I + R
+        dV = np.minimum(S, ve * daily_doses * np.divide(S, living, out = np.zeros_like(S), where = living > 0))
+        S -= dV
+        V += dV
+
+        Rt = Rt0 * np.divide(S, S_start, out = np.zeros_like(S), where = S_start > 0)
+        b  = np.exp(gamma * (Rt - 1))
+
+        yield dict(S = S, I = I, R = R, D = D, V = V, dT = dT, dD = dD)
+
+def trajectories(initial_conditions: pd.DataFrame, draws: int, days: int, rng: np.random.Generator, Rt_scale: float = 1.0, phi: float = phi):
+    """ each day's (draw × metric × district) values, with the state total as the last district """
+    for day in compartments(initial_conditions, draws, days, rng, Rt_scale, phi):
+        daily = np.stack([day[metric] for metric in metrics], axis = 1)
+        yield np.concatenate([daily, daily.sum(axis = 2, keepdims = True)], axis = 2)
+
+def simulate(initial_conditions: pd.DataFrame, draws: int = num_draws, days: int = horizon, seed: int = random_seed) -> np.ndarray:
+    """ quantiles across draws of a projection, as a (day × quantile × metric × district) array """
+    projections = np.empty((days, len(quantiles), len(metrics), initial_conditions.shape[0] + 1))
+    for (t, daily) in enumerate(trajectories(initial_conditions, draws, days, np.random.default_rng(seed))):
+        projections[t] = np.quantile(daily, quantiles, axis = 0)
+    return projections
+
+class StreamingQuantiles:
+    """ fixed histograms of each (day, metric, district) value across draws, so quantiles can be reduced over chunks of draws without keeping them;
+    each histogram starts out spanning three times the range of the first chunk, and is widened when later draws fall outside it """
+
+    def __init__(self, days: int, bins: int = num_bins):
+        self.bins    = bins
+        self.days    = days
+        self.lower   = None
+        self.width   = None
+        self.counts  = None
+        self.widened = 0 # histograms widened to fit later chunks
+
+    def add(self, t: int, values: np.ndarray):
+        """ counts a (draw × metric × district) array of values for day `t` """
+        if self.counts is None:
+            self.lower  = np.empty((self.days,) + values.shape[1:])
+            self.width  = np.empty((self.days,) + values.shape[1:])
+            self.counts = np.zeros((self.days,) + values.shape[1:] + (self.bins,), dtype = np.int32)
+            self.offset = np.arange(np.prod(values.shape[1:])).reshape(values.shape[1:]) * self.bins
+            self.seen   = np.zeros(self.days, dtype = bool)
+        (low, high) = (values.min(axis = 0), values.max(axis = 0))
+        if not self.seen[t]:
+            spread = np.maximum(high - low, np.maximum(0.01 * np.abs(high), 1))
+            self.lower[t] = low - spread
+            self.width[t] = 3 * spread / self.bins
+            self.seen[t]  = True
+        else:
+            self.widen(t, low, high)
+        index = ((values - self.lower[t]) / self.width[t]).astype(int).clip(0, self.bins - 1)
+        self.counts[t] += np.bincount((index + self.offset).ravel(), minlength = self.offset.size * self.bins)\
+            .reshape(self.counts.shape[1:])
+
+    def widen(self, t: int, low: np.ndarray, high: np.ndarray):
+        """ doubles the bin width of day `t`'s histograms that do not cover [low, high] until they do, moving the lower edge
+        down by whole new bins; each old bin then falls inside one new bin, so the counts already added carry over exactly """
+        (lower, width) = (self.lower[t], self.width[t])
+        outside = (low < lower) | (high >= lower + self.bins * width)
+        if not outside.any():
+            return
+        factor = np.ones(lower.shape, dtype = np.int64)
+        shift  = np.zeros(lower.shape, dtype = np.int64)
+        pending = outside.copy()
+        while pending.any():
+            factor[pending] *= 2
+            shift[pending] = np.ceil(np.maximum(lower - low, 0) / (width * factor))[pending]
+            fits = (shift + -(-self.bins // factor) <= self.bins) & (lower + (self.bins - shift) * width * factor > high)
+            pending &= ~fits
+
+        cells  = np.flatnonzero(outside)
+        counts = self.counts[t].reshape(-1, self.bins)
+        target = shift.ravel()[cells, None] + np.arange(self.bins)[None, :] // factor.ravel()[cells, None]
+        merged = np.zeros((len(cells), self.bins), dtype = counts.dtype)
+        np.add.at(merged, (np.repeat(np.arange(len(cells)), self.bins), target.ravel()), counts[cells].ravel())
+        counts[cells] = merged
+        self.lower[t] = np.where(outside, lower - shift * width * factor, lower)
+        self.width[t] = np.where(outside, width * factor, width)
+        self.widened += len(cells)
+
+    def quantiles(self, qs) -> np.ndarray:
+        """ (day × quantile × metric × district) array, interpolating linearly within bins """
+        cumulative = self.counts.cumsum(axis = -1)
+        total = cumulative[..., -1]
+        estimates = []
+        for q in qs:
+            target = q * total
+            bin_   = np.minimum((cumulative < target[..., None]).sum(axis = -1), self.bins - 1)
+            below  = np.where(bin_ > 0, np.take_along_axis(cumulative, np.maximum(bin_ - 1, 0)[..., None], axis = -1)[..., 0], 0)
+            within = np.take_along_axis(self.counts, bin_[..., None], axis = -1)[..., 0]
+            frac   = np.divide(target - below, within, out = np.zeros(target.shape), where = within > 0)
+            estimates.append(self.lower + (bin_ + frac.clip(0, 1)) * self.width)
+        return np.stack(estimates, axis = 1)
+
+def tabulate(projections: np.ndarray, districts: List[str], dates: pd.DatetimeIndex) -> pd.DataFrame:
+    """ long table of projections, one row per district and date, with lower/median/upper columns per metric """
+    (days, _, _, num_districts) = projections.shape
+    return pd.DataFrame(
+        projections.transpose(3, 0, 2, 1).reshape(num_districts * days, len(metrics) * len(quantiles)),
+        columns = [f"{metric}_{bound}" for metric in metrics for bound in ["lower", "median", "upper"]]
+    ).assign(
+        district = np.repeat(districts, days),
+        dates    = np.tile(dates, num_districts)
+    ).set_index(["district", "dates"])
+
+def get_grid(request, key: str, default: List[float]) -> List[float]:
+    values = get(request, key) or default
+    if isinstance(values, str):
+        values = values.split(",")
+    return [float(value) for value in values]
+
+def chunk_size(num_districts: int) -> int:
+    """ draws per chunk, so that a chunk's simulation state stays within `max_chunk_bytes` """
+    return max(1, max_chunk_bytes // (arrays_per_draw * 8 * (num_districts + 1)))
+
+@instrumented("forward_simulation")
 def run(request):
-    state_code = get(request, 'state_code')
+    if str(get(request, 'sweep')).lower() == "true":
+        return run_sweep(request)
+    state_codes = get_state_codes(request)
+    draws = int(get(request, 'draws') or num_draws)
+    days  = int(get(request, 'days')  or horizon)
+    seed  = int(get(request, 'seed')  or random_seed)
+    force = str(get(request, 'force')).lower() == "true"
+
+    bucket = get_bucket(bucket_name)
+
+    jobs = {}
+    for state_code in state_codes:
+        inputs = fingerprint(bucket, [f"pipeline/sim/input/{state_code}_simulation_initial_conditions.csv"], sources = [__file__])
+        inputs["parameters"] = f"draws={draws},days={days},seed={seed},gamma={gamma}"
+        if not force and unchanged(bucket, f"sim/forward/{state_code}", inputs):
+            print(f"Initial conditions for {state_code} ({state_code_lookup[state_code]}) unchanged since last successful run; skipping.")
+        else:
+            jobs[state_code] = (draws, days, seed, inputs)
+    if not jobs:
+        return "OK!"
+
+    failed = run_batch(simulate_state, jobs, {})
+    if failed:
+        raise RuntimeError(f"forward simulation failed for {', '.join(failed)}")
+    return "OK!"
+
+@instrumented("forward_simulation", label = "state_code")
+def simulate_state(state_code: str, draws: int, days: int, seed: int, inputs: dict):
     state = state_code_lookup[state_code]
 
     print(f"Downloading initial conditions for {state_code} ({state}).")
-    
-    bucket = storage.Client().bucket(bucket_name)
-    data = Path("/tmp")
 
-    bucket.blob(f"pipeline/sim/input/{state_code}_simulation_initial_conditions.csv")\
-        .download_to_filename(data / f"{state_code}_simulation_initial_conditions.csv")
+    bucket = get_bucket(bucket_name)
+    blob_name = f"pipeline/sim/input/{state_code}_simulation_initial_conditions.csv"
+    with span("download"):
+        buffer = download_buffers(bucket, [blob_name])[blob_name]
+    with span("parse"):
+        initial_conditions = pd.read_csv(buffer, index_col = 0)
+
+    print(f"Simulating {len(initial_conditions)} districts in {state_code} ({state}) over {draws} draws and {days} days.")
+    simulation_start = (pd.Timestamp.today() - pd.Timedelta(days = cutoff)).normalize()
+    with span("simulate", districts = len(initial_conditions), draws = draws):
+        projections = simulate(initial_conditions, draws, days, seed)
+
+    districts = list(initial_conditions.district) + [state]
+    if districts[:-1] == [state]:
+        # coalesced states are simulated as a single district, which is already the state total
+        (projections, districts) = (projections[..., :1], districts[:1])
+    dates = pd.date_range(simulation_start + pd.Timedelta(days = 1), periods = days)
+    output = tabulate(projections, districts, dates)\
+        .assign(state_code = state_code, state = state)\
+        .to_csv()
+    with span("upload"):
+        upload_buffers(bucket, {f"pipeline/sim/output/{state_code}_projections.csv": (output, "text/csv")})
+
+    write_manifest(bucket, f"sim/forward/{state_code}", inputs)
 
+def run_sweep(request):
+    """ projects every state under a grid of interventions (Rt scalings) and vaccination rates, sharding (state, scenario) pairs across a process pool """
+    state_codes = get_state_codes(request)
+    draws = int(get(request, 'draws') or num_draws)
+    days  = int(get(request, 'days')  or horizon)
+    seed  = int(get(request, 'seed')  or random_seed)
+    force = str(get(request, 'force')).lower() == "true"
+    grid  = [(Rt_scale, phi) for Rt_scale in get_grid(request, 'Rt_scalings', Rt_scalings) for phi in get_grid(request, 'vax_rates', vax_rates)]
+
+    bucket = get_bucket(bucket_name)
+
+    manifests = {}
+    for state_code in state_codes:
+        inputs = fingerprint(bucket, [f"pipeline/sim/input/{state_code}_simulation_initial_conditions.csv"], sources = [__file__])
+        inputs["parameters"] = f"draws={draws},days={days},seed={seed},gamma={gamma},grid={grid}"
+        if not force and unchanged(bucket, f"sim/sweep/{state_code}", inputs):
+            print(f"Initial conditions for {state_code} ({state_code_lookup[state_code]}) unchanged since last successful sweep; skipping.")
+        else:
+            manifests[state_code] = inputs
+    if not manifests:
+        return "OK!"
+
+    # initial conditions are small, so download them once and share them with every worker
+    blob_names = {state_code: f"pipeline/sim/input/{state_code}_simulation_initial_conditions.csv" for state_code in manifests}
+    with span("download"):
+        buffers = download_buffers(bucket, blob_names.values())
+    with span("parse"):
+        initial_conditions = {state_code: pd.read_csv(buffers[blob_name], index_col = 0) for (state_code, blob_name) in blob_names.items()}
+
+    jobs = {
+        f"{state_code}/{scenario:03d}": (state_code, scenario, Rt_scale, phi, draws, days, seed)
+        for state_code in manifests
+        for (scenario, (Rt_scale, phi)) in enumerate(grid)
+    }
+    failed = run_batch(sweep_scenario, jobs, {"initial_conditions": initial_conditions})
+
+    for (state_code, inputs) in manifests.items():
+        if not any(shard.startswith(f"{state_code}/") for shard in failed):
+            grid_csv = pd.DataFrame(grid, columns = ["Rt_scale", "phi"]).rename_axis("scenario").to_csv()
+            upload_buffers(bucket, {f"pipeline/sim/output/scenarios/{state_code}/grid.csv": (grid_csv, "text/csv")})
+            write_manifest(bucket, f"sim/sweep/{state_code}", inputs)
+    if failed:
+        raise RuntimeError(f"scenario sweep failed for {', '.join(sorted(failed))}")
     return "OK!"
+
+@instrumented("forward_simulation_sweep", label = "shard")
+def sweep_scenario(shard: str, state_code: str, scenario: int, Rt_scale: float, phi: float, draws: int, days: int, seed: int):
+    state = state_code_lookup[state_code]
+    initial_conditions = shared["initial_conditions"][state_code]
+
+    # chunks are seeded by (seed, state, scenario, chunk) rather than by worker, so results do not depend on how shards are scheduled
+    chunk = chunk_size(len(initial_conditions))
+    histograms = StreamingQuantiles(days)
+    with span("simulate", districts = len(initial_conditions), draws = draws):
+        for (i, start) in enumerate(range(0, draws, chunk)):
+            rng = np.random.default_rng(np.random.SeedSequence([seed, int.from_bytes(state_code.encode("utf-8"), "big"), scenario, i]))
+            for (t, daily) in enumerate(trajectories(initial_conditions, min(chunk, draws - start), days, rng, Rt_scale, phi)):
+                histograms.add(t, daily)
+        projections = histograms.quantiles(quantiles)
+    print(f"Simulated scenario {scenario} (Rt x {Rt_scale}, {phi} vaccinated/year) for {state_code} ({state}) over {draws} draws"
+        + (f"; widened {histograms.widened} histograms to fit later chunks." if histograms.widened else "."))
+
+    districts = list(initial_conditions.district) + [state]
+    if districts[:-1] == [state]:
+        (projections, districts) = (projections[..., :1], districts[:1])
+    simulation_start = (pd.Timestamp.today() - pd.Timedelta(days = cutoff)).normalize()
+    dates = pd.date_range(simulation_start + pd.Timedelta(days = 1), periods = days)
+    output = tabulate(projections, districts, dates)\
+        .assign(state_code = state_code, state = state, scenario = scenario, Rt_scale = Rt_scale, phi = phi)\
+        .to_csv()
+    with span("upload"):
+        upload_buffers(get_bucket(bucket_name), {f"pipeline/sim/output/scenarios/{state_code}/{scenario:03d}.csv": (output, "text/csv")})
@@ -0,0 +1 @@
+../../commons/mpvs.py
\ No newline at end of file
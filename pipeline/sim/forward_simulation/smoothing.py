@@ -0,0 +1 @@
+../../commons/smoothing.py
\ No newline at end of file
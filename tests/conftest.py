@@ -0,0 +1,19 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+# shared modules resolve to pipeline/commons, as they do through each function's symlinks
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root/"pipeline"/"commons"))
+
+def load(directory: str, name: str = "main"):
+    """ imports `name`.py from a function's source directory as a module of its own, since every function has a main.py """
+    path = root/directory
+    sys.path.insert(0, str(path))
+    try:
+        spec = importlib.util.spec_from_file_location(f"{path.name.replace('-', '_')}_{name}", path/f"{name}.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(path))
+    return module
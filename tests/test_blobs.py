@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+import blobs
+from blobs import LocalBucket, download_buffers, md5_hash, upload_buffers, upload_many
+
+def test_round_trip_and_metadata(tmp_path):
+    bucket = LocalBucket(tmp_path/"daily_pipeline")
+    bucket.blob("pipeline/raw/states.csv").upload_from_string("state,date\nKA,2021-05-01\n", content_type = "text/csv")
+
+    blob = bucket.get_blob("pipeline/raw/states.csv")
+    data = b"state,date\nKA,2021-05-01\n"
+    assert blob.download_as_string() == data
+    assert (blob.size, blob.md5_hash) == (len(data), md5_hash(data))
+    assert bucket.get_blob("pipeline/raw/missing.csv") is None
+    with pytest.raises(FileNotFoundError):
+        bucket.blob("pipeline/raw/missing.csv").download_as_string()
+
+def test_generation_increases_on_every_write(tmp_path):
+    blob = LocalBucket(tmp_path/"daily_pipeline").blob("pipeline/est/KA_state_Rt.csv")
+    generations = []
+    for i in range(20):
+        blob.upload_from_string(f"version {i}")
+        generations.append(blob.generation)
+    assert all(later > earlier for (earlier, later) in zip(generations, generations[1:]))
+    assert blob.reload().generation == generations[-1]
+
+def test_writes_are_atomic(tmp_path):
+    bucket = LocalBucket(tmp_path/"daily_pipeline")
+    versions = [bytes([ord("a") + i]) * (1 << 20) for i in range(4)]
+    bucket.blob("pipeline/raw/districts.csv").upload_from_string(versions[0])
+
+    seen, stop = set(), threading.Event()
+    def read():
+        while not stop.is_set():
+            seen.add(md5_hash(bucket.blob("pipeline/raw/districts.csv").download_as_string()))
+    def write(version):
+        for _ in range(20):
+            bucket.blob("pipeline/raw/districts.csv").upload_from_string(version)
+    readers = [threading.Thread(target = read) for _ in range(4)]
+    writers = [threading.Thread(target = write, args = (version,)) for version in versions]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    # readers only ever see whole versions, and no staging files are left behind or listed
+    assert seen <= {md5_hash(version) for version in versions}
+    assert [blob.name for blob in bucket.list_blobs()] == ["pipeline/raw/districts.csv"]
+    assert [path.name for path in (tmp_path/"daily_pipeline"/"pipeline"/"raw").iterdir()] == ["districts.csv"]
+
+def test_concurrent_transfers(tmp_path):
+    bucket = LocalBucket(tmp_path/"daily_pipeline")
+    upload_buffers(bucket, {f"pipeline/est/{code}_state_Rt.csv": (f"{code}\n", "text/csv") for code in ["KA", "MH", "TN"]})
+    (tmp_path/"report.png").write_bytes(b"\x89PNG" * 1000)
+    upload_many(bucket, {"pipeline/rpt/KA_Rt_timeseries.png": (tmp_path/"report.png", "image/png")}, verify = True)
+
+    buffers = download_buffers(bucket, ["pipeline/est/KA_state_Rt.csv", "pipeline/est/XX_state_Rt.csv"], missing_ok = True)
+    assert buffers["pipeline/est/KA_state_Rt.csv"].getvalue() == b"KA\n"
+    assert buffers["pipeline/est/XX_state_Rt.csv"] is None
+    assert bucket.get_blob("pipeline/rpt/KA_Rt_timeseries.png").md5_hash == md5_hash(b"\x89PNG" * 1000)
+
+def test_local_backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, "storage_backend", "local")
+    monkeypatch.setattr(blobs, "storage_root", str(tmp_path))
+    bucket = blobs.get_bucket("daily_pipeline")
+    assert isinstance(bucket, LocalBucket)
+    assert (bucket.root, bucket.name) == (tmp_path/"daily_pipeline", "daily_pipeline")
@@ -0,0 +1,102 @@
+import io
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import blobs
+from blobs import LocalBucket, download_buffers
+from conftest import load
+
+natl_estimates  = load("pipeline/est/natl_state_estimates")
+state_estimates = load("pipeline/est/state_district_estimates")
+
+districts = {"Karnataka": ["Bengaluru Urban", "Mysuru", "Udupi", "Unknown"], "Delhi": ["Delhi"]}
+
+def request(**body):
+    return SimpleNamespace(args = {}, get_json = lambda: body)
+
+def districts_csv(days: int = 90, seed: int = 0) -> str:
+    """ cumulative confirmed cases per district, in the layout of pipeline/raw/districts.csv """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2021-03-01", periods = days).strftime("%Y-%m-%d")
+    rows = []
+    for (state, names) in districts.items():
+        for district in names:
+            confirmed = rng.poisson(rng.uniform(20, 200) * np.exp(np.cumsum(rng.normal(0, 0.03, days)))).cumsum()
+            rows.append(pd.DataFrame({"Date": dates, "State": state, "District": district, "Confirmed": confirmed, "Recovered": 0, "Deceased": 0, "Other": 0, "Tested": 0}))
+    return pd.concat(rows).to_csv(index = False)
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, "storage_backend", "local")
+    monkeypatch.setattr(blobs, "storage_root", str(tmp_path))
+    bucket = LocalBucket(tmp_path/natl_estimates.bucket_name, natl_estimates.bucket_name)
+    bucket.blob("pipeline/raw/districts.csv").upload_from_string(districts_csv())
+    # Udupi is missing from the crosswalk, so takes the state's LGD name and id
+    pd.DataFrame({
+        "state_api":         ["Karnataka", "Karnataka", "Delhi"],
+        "district_api":      ["Bengaluru Urban", "Mysuru", "Delhi"],
+        "lgd_state_name":    ["karnataka", "karnataka", "delhi"],
+        "lgd_state_id":      [29, 29, 7],
+        "lgd_district_name": ["bengaluru urban", "mysore", "new delhi"],
+        "lgd_district_id":   [572, 577, 77]
+    }).to_stata(tmp_path/"crosswalk.dta", write_index = False)
+    bucket.blob("pipeline/commons/refs/all_crosswalk.dta").upload_from_filename(tmp_path/"crosswalk.dta")
+    return bucket
+
+def read(bucket, blob_name: str) -> pd.DataFrame:
+    return pd.read_csv(download_buffers(bucket, [blob_name])[blob_name], index_col = 0 if blob_name.startswith("pipeline/est/") else None)
+
+def test_published_estimates_come_from_the_hierarchical_run(bucket):
+    natl_estimates.run_estimates(request())
+    for state_code in ("KA", "DL"):
+        state_estimates.run_estimates(request(state_code = state_code))
+
+    # the state series published per state is the one in the national time series
+    timeseries = read(bucket, "estimates/Rt_timeseries_india.csv")
+    assert set(timeseries.state) == {"TT", "KA", "DL"}
+    for state_code in ("KA", "DL"):
+        state_Rt = read(bucket, f"pipeline/est/{state_code}_state_Rt.csv")
+        assert list(state_Rt.columns) == natl_estimates.estimate_columns + ["state", "lgd_state_name", "lgd_state_id"]
+        assert list(state_Rt.index) == list(range(len(state_Rt)))
+        np.testing.assert_allclose(state_Rt.Rt_pred.values, timeseries[timeseries.state == state_code].Rt.values)
+
+    # districts are published with their LGD names, excluded districts are left out, and dissolved states have none
+    district_Rt = read(bucket, "pipeline/est/KA_district_Rt.csv")
+    assert list(district_Rt.columns) == natl_estimates.estimate_columns + ["state", "lgd_state_name", "lgd_state_id", "district", "lgd_district_name", "lgd_district_id"]
+    lgd = district_Rt.groupby("district").first()
+    assert list(lgd.index) == ["Bengaluru Urban", "Mysuru", "Udupi"]
+    assert list(lgd.lgd_district_name) == ["bengaluru urban", "mysore", "karnataka"]
+    assert all(list(group.index) == list(range(len(group))) for (_, group) in district_Rt.groupby("district"))
+    assert bucket.get_blob("pipeline/est/DL_district_Rt.csv") is None
+    assert bucket.get_blob("pipeline/est/KA_district_Rt.parquet") is not None
+
+def test_unchanged_estimates_are_not_republished(bucket, capsys):
+    natl_estimates.run_estimates(request())
+    state_estimates.run_estimates(request(state_code = "KA"))
+    capsys.readouterr()
+
+    natl_estimates.run_estimates(request())
+    assert "unchanged since last successful run" in capsys.readouterr().out
+
+    # a forced rerun on the same data writes identical estimates, so the state is still skipped
+    natl_estimates.run_estimates(request(force = "true"))
+    state_estimates.run_estimates(request(state_code = "KA"))
+    assert "Inputs for KA unchanged" in capsys.readouterr().out
+
+def test_new_day_is_rolled_forward(bucket, capsys):
+    latest = pd.read_csv(io.StringIO(districts_csv(days = 91)))
+    bucket.blob("pipeline/raw/districts.csv").upload_from_string(latest[latest.Date < latest.Date.max()].to_csv(index = False))
+    natl_estimates.run_estimates(request(incremental = True))
+    assert "No previous posterior" in capsys.readouterr().out
+
+    bucket.blob("pipeline/raw/districts.csv").upload_from_string(latest.to_csv(index = False))
+    natl_estimates.run_estimates(request(incremental = True))
+    assert "Rolled forward 6 of 6 series posteriors." in capsys.readouterr().out
+    assert read(bucket, "estimates/Rt_timeseries_india.csv").date.max() == sorted(latest.Date.unique())[-1 - natl_estimates.mpvs.cutoff]
+
+def test_missing_hierarchical_estimates_fail_the_state(bucket):
+    with pytest.raises(RuntimeError, match = "KA"):
+        state_estimates.run_estimates(request(state_code = "KA"))
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from conftest import load
+
+forward_simulation = load("pipeline/sim/forward_simulation")
+
+def initial_conditions() -> pd.DataFrame:
+    return pd.DataFrame({
+        "district": ["District 0", "District 1", "District 2"],
+        "N_tot":    [2000000, 500000, 80000],
+        "Rt":       [1.2, 0.9, 1.6],
+        "S0":       [1500000, 300000, 60000],
+        "I0":       [4000, 800, 150],
+        "R0":       [490000, 198000, 19700],
+        "D0":       [6000, 1200, 150],
+        "dT0":      [600, 90, 30],
+        "V0":       [200000, 40000, 5000]
+    })
+
+def test_shapes():
+    conditions = initial_conditions()
+    daily = list(forward_simulation.trajectories(conditions, draws = 40, days = 12, rng = np.random.default_rng(0)))
+    assert len(daily) == 12
+    assert {values.shape for values in daily} == {(40, len(forward_simulation.metrics), len(conditions) + 1)}
+    # the last district is the state total
+    assert np.allclose(daily[-1][..., -1], daily[-1][..., :-1].sum(axis = -1))
+
+    projections = forward_simulation.simulate(conditions, draws = 40, days = 12, seed = 0)
+    assert projections.shape == (12, len(forward_simulation.quantiles), len(forward_simulation.metrics), len(conditions) + 1)
+    assert np.array_equal(projections, forward_simulation.simulate(conditions, draws = 40, days = 12, seed = 0))
+
+def test_population_is_conserved():
+    conditions = initial_conditions()
+    population = (conditions.S0 + conditions.I0 + conditions.R0 + conditions.D0).values.astype(float)
+    for day in forward_simulation.compartments(conditions, draws = 40, days = 60, rng = np.random.default_rng(1), phi = 1.0):
+        assert min(day[compartment].min() for compartment in ["S", "I", "R", "D", "V", "dT", "dD"]) >= 0
+        assert np.allclose(day["S"] + day["I"] + day["R"] + day["D"] + day["V"], population)
+
+def streamed(chunks, days: int = 1) -> "forward_simulation.StreamingQuantiles":
+    histograms = forward_simulation.StreamingQuantiles(days)
+    for chunk in chunks:
+        for t in range(days):
+            histograms.add(t, chunk[t])
+    return histograms
+
+def test_streaming_quantiles_widen_for_later_chunks():
+    rng = np.random.default_rng(2)
+    # later chunks land far above and below the first one's range
+    chunks = [rng.uniform(0, 1, (1, 200, 2, 3)), rng.uniform(50, 400, (1, 200, 2, 3)), rng.uniform(-90, -10, (1, 200, 2, 3))]
+    histograms = streamed(chunks)
+    assert histograms.widened > 0
+    assert histograms.counts.sum(axis = -1).min() == 600
+    exact = np.quantile(np.concatenate([chunk[0] for chunk in chunks]), forward_simulation.quantiles, axis = 0)
+    assert (np.abs(histograms.quantiles(forward_simulation.quantiles)[0] - exact) <= 2 * histograms.width[0]).all()
+
+def test_streaming_quantiles_match_exact_quantiles():
+    conditions = initial_conditions()
+    (draws, days, chunk) = (600, 20, 100)
+    histograms = forward_simulation.StreamingQuantiles(days)
+    everything = np.zeros((days, draws, len(forward_simulation.metrics), len(conditions) + 1))
+    for (i, start) in enumerate(range(0, draws, chunk)):
+        for (t, daily) in enumerate(forward_simulation.trajectories(conditions, chunk, days, np.random.default_rng(i), Rt_scale = 1.25, phi = 0.0)):
+            histograms.add(t, daily)
+            everything[t, start:start + chunk] = daily
+    exact = np.stack([np.quantile(everything[t], forward_simulation.quantiles, axis = 0) for t in range(days)])
+    assert (np.abs(histograms.quantiles(forward_simulation.quantiles) - exact) <= 2 * histograms.width[:, None]).all()
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from epimargin.smoothing import notched_smoothing
+
+from conftest import load
+
+initial_conditions = load("pipeline/est/simulation_initial_conditions")
+
+def reference_scaling(ts: pd.DataFrame, districts: pd.DataFrame, simulation_start: pd.Timestamp) -> pd.DataFrame:
+    """ the per-district loop seroprevalence_scaling replaced """
+    (smooth, survey_date) = (notched_smoothing(window = initial_conditions.window), initial_conditions.survey_date)
+    rows = {}
+    for (district, row) in districts.iterrows():
+        smoothed = {}
+        for column in ["dR", "dD", "dT"]:
+            counts = ts.loc[district][column]
+            counts = counts.reindex(pd.date_range(counts.index.min(), counts.index.max()), fill_value = 0)
+            smoothed[column] = pd.Series(smooth(counts), index = counts.index).clip(0).astype(int) if len(counts) >= initial_conditions.window + 1 else counts
+        at = lambda series, date: series[date if date in series.index else series.index[-1]]
+        R_conf_smooth = smoothed["dR"].cumsum().astype(int)
+        D_conf_smooth = smoothed["dD"].cumsum().astype(int)
+        T_conf_smooth = smoothed["dT"].cumsum().astype(int)
+
+        R_sero  = sum(row[f"sero_{i}"] * row[f"N_{i}"] for i in range(7))
+        R_conf  = at(R_conf_smooth, pd.Timestamp(survey_date))
+        R_ratio = R_sero/R_conf if R_conf != 0 else 1
+        R0 = at(R_conf_smooth, simulation_start) * R_ratio
+        D0 = at(D_conf_smooth, simulation_start)
+        T_conf  = at(T_conf_smooth, pd.Timestamp(survey_date))
+        T_ratio = (R_sero + D0)/T_conf if T_conf != 0 else 1
+        T0 = at(T_conf_smooth, simulation_start) * T_ratio
+        rows[district] = {
+            "S0": max(0, row.N_tot - T0), "I0": max(0, T0 - R0 - D0), "R0": R0, "D0": D0,
+            "dT0": at(smoothed["dT"], simulation_start) * T_ratio, "dD0": at(smoothed["dD"], simulation_start),
+            "pandemic_start": ts.loc[district].index.min()
+        }
+    return pd.DataFrame.from_dict(rows, orient = "index")
+
+def inputs(spans, seed: int = 0):
+    """ daily case time series for districts reporting over the given (first, last) dates, and their serosurvey populations """
+    rng = np.random.default_rng(seed)
+    ts = pd.concat([
+        pd.DataFrame({
+            "dR": rng.poisson(30, len(dates)), "dD": rng.poisson(2, len(dates)), "dT": rng.poisson(40, len(dates))
+        }, index = pd.MultiIndex.from_product([[f"District {i}"], dates], names = ["district", "status_change_date"]))
+        for (i, dates) in enumerate(pd.date_range(first, last) for (first, last) in spans)
+    ])
+    districts = pd.DataFrame({
+        **{f"sero_{i}": rng.uniform(0.15, 0.35, len(spans)) for i in range(7)},
+        **{f"N_{i}":    np.full(len(spans), 100000) for i in range(7)},
+        "N_tot": np.full(len(spans), 700000)
+    }, index = pd.Index([f"District {i}" for i in range(len(spans))], name = "district"))
+    return (ts, districts)
+
+def test_matches_per_district_loop():
+    # districts starting late, ending early, and sharing a first or last day with others
+    (ts, districts) = inputs([
+        ("2020-04-01", "2021-03-01"),
+        ("2020-07-15", "2021-03-01"),
+        ("2020-11-01", "2021-03-01"),
+        ("2020-04-01", "2021-01-20"),
+        ("2020-07-15", "2020-12-31"),
+        ("2021-02-01", "2021-02-25"),
+    ])
+    simulation_start = pd.Timestamp("2021-02-20")
+    scaled = initial_conditions.seroprevalence_scaling(ts, districts, simulation_start)
+    expected = reference_scaling(ts, districts, simulation_start)
+    pd.testing.assert_frame_equal(scaled, expected[scaled.columns].rename_axis("district"), check_dtype = False)
+
+def test_short_series_use_reported_counts(capsys):
+    (ts, districts) = inputs([("2020-04-01", "2021-03-01"), ("2021-02-20", "2021-03-01")])
+    simulation_start = pd.Timestamp("2021-02-25")
+    scaled = initial_conditions.seroprevalence_scaling(ts, districts, simulation_start)
+    assert "Too few days (10) to smooth cases for District 1; using reported counts." in capsys.readouterr().out
+    assert scaled.loc["District 1", "dD0"] == ts.loc[("District 1", simulation_start), "dD"]
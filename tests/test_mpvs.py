@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mpvs import estimate, estimate_full, reanchor, trim, window
+
+def cumulative_cases(days: int, districts: int = 6, seed: int = 0) -> pd.Series:
+    """ confirmed cases for a handful of districts, indexed by (district, date) """
+    rng = np.random.default_rng(seed)
+    intensity = rng.uniform(20, 200, (districts, 1)) * np.exp(np.cumsum(rng.normal(0, 0.03, (districts, days)), axis = 1))
+    index = pd.MultiIndex.from_product(
+        [[f"District {i}" for i in range(districts)], pd.date_range("2021-01-01", periods = days).strftime("%Y-%m-%d")],
+        names = ["district", "date"])
+    return pd.Series(rng.poisson(intensity).cumsum(axis = 1).ravel(), index = index, name = "confirmed")
+
+def published(posterior: pd.DataFrame) -> pd.DataFrame:
+    return trim(posterior, level = "district").reset_index(drop = True)
+
+def drop_last_days(cases: pd.Series, days: int = 1) -> pd.Series:
+    return cases[cases.index.get_level_values("date") < sorted(set(cases.index.get_level_values("date")))[-days]]
+
+def full_run_from(cases: pd.Series, previous: pd.DataFrame) -> pd.DataFrame:
+    """ a full run over windows that start where the previous posterior did """
+    anchors = pd.to_datetime(previous.groupby("district").dates.min())
+    return pd.concat(estimate_full(window(cases, anchors), level = "district"), ignore_index = True)
+
+def assert_close(incremental: pd.DataFrame, full: pd.DataFrame):
+    pd.testing.assert_frame_equal(published(incremental), published(full), check_exact = False, rtol = 1e-5)
+
+def test_rerun_rolls_forward_whole_posterior(capsys):
+    cases = cumulative_cases(150)
+    full  = estimate(cases, level = "district")
+    rerun = estimate(cases, level = "district", previous = full)
+    assert "Rolled forward 6 of 6 district posteriors." in capsys.readouterr().out
+    pd.testing.assert_frame_equal(published(rerun), published(full))
+
+@pytest.mark.parametrize("days", [60, 150]) # windows that start on the first report, and sliding windows
+def test_new_day_is_rolled_forward(days, capsys):
+    cases = cumulative_cases(days)
+    previous = estimate(drop_last_days(cases), level = "district")
+    capsys.readouterr()
+    incremental = estimate(cases, level = "district", previous = previous)
+    assert "Rolled forward 6 of 6 district posteriors." in capsys.readouterr().out
+    assert_close(incremental, full_run_from(cases, previous))
+    if days == 60:
+        assert_close(incremental, estimate(cases, level = "district"))
+
+def test_daily_runs_stay_close_to_a_full_run(capsys):
+    cases = cumulative_cases(160)
+    first = posterior = estimate(drop_last_days(cases, 10), level = "district")
+    for days in range(9, -1, -1):
+        posterior = estimate(drop_last_days(cases, days) if days else cases, level = "district", previous = posterior)
+    assert capsys.readouterr().out.count("Rolled forward 6 of 6 district posteriors.") == 10
+    assert_close(posterior, full_run_from(cases, first))
+
+def test_window_is_reanchored_after_a_while(capsys):
+    cases = cumulative_cases(200)
+    previous = estimate(drop_last_days(cases, reanchor + 1), level = "district")
+    capsys.readouterr()
+    posterior = estimate(cases, level = "district", previous = previous)
+    assert "Rolled forward 0 of 6 district posteriors." in capsys.readouterr().out
+    pd.testing.assert_frame_equal(published(posterior), published(estimate(cases, level = "district")))
+
+def test_revision_is_rolled_forward_from_the_revised_date():
+    cases = cumulative_cases(150)
+    previous = estimate(cases, level = "district")
+    dates = cases.index.get_level_values("date")
+    revised = cases + 50 * ((cases.index.get_level_values("district") == "District 2") & (dates >= sorted(set(dates))[-30]))
+    posterior = estimate(revised, level = "district", previous = previous)
+    assert_close(posterior, estimate(revised, level = "district"))
+    # dates before the revision keep their previous estimates
+    unrevised = published(posterior).dates < sorted(set(dates))[-60]
+    pd.testing.assert_frame_equal(published(posterior)[unrevised], published(previous)[unrevised])
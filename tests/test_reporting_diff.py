@@ -0,0 +1,134 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+import requests
+from epimargin.etl.covid19india import columns_v3, columns_v4, data_path
+
+from blobs import LocalBucket
+from conftest import load
+
+reporting_diff = load("misc/reporting-diff")
+
+def raw_file(columns, patients: range, date: str = "01/05/2020") -> bytes:
+    """ a raw line-list file in the given layout, one case per patient """
+    values = {
+        "Patient Number":     list(patients),
+        "Date Announced":     date,
+        "Status Change Date": date,
+        "Detected District":  "Bengaluru Urban",
+        "Detected State":     "Karnataka",
+        "Current Status":     "Hospitalized",
+        "Num Cases":          1
+    }
+    return pd.DataFrame({column: values.get(column, "") for column in columns}).to_csv(index = False).encode()
+
+class RawFileHandler(BaseHTTPRequestHandler):
+    """ the covid19india API's raw files, with ETags; answers 304 when If-None-Match matches and 404 for files that do not exist """
+    def do_GET(self):
+        filename = self.path.lstrip("/")
+        content  = self.server.files.get(filename)
+        etag     = f'"{hashlib.md5(content).hexdigest()}"' if content is not None else None
+        if content is None:
+            status = 404
+        elif self.headers.get("If-None-Match") == etag:
+            status = 304
+        else:
+            status = 200
+        with self.server.lock:
+            self.server.requests.append((filename, status))
+        self.send_response(status)
+        if status == 200:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", "Fri, 01 May 2020 00:00:00 GMT")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RawFileHandler)
+    (server.requests, server.lock) = ([], threading.Lock())
+    server.files = {data_path(1): raw_file(columns_v3, range(1, 4)), data_path(3): raw_file(columns_v4, range(4, 9))}
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    monkeypatch.setattr(reporting_diff, "base_url", f"http://127.0.0.1:{server.server_address[1]}/")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    bucket = LocalBucket(tmp_path/reporting_diff.bucket_name, reporting_diff.bucket_name)
+    monkeypatch.setattr(reporting_diff, "get_bucket", lambda name: bucket)
+    return bucket
+
+def statuses(server, filename: str):
+    return [status for (requested, status) in server.requests if requested == filename]
+
+def test_fetch_sends_validators_and_returns_304_without_a_body(server):
+    (status, content, validator) = reporting_diff.fetch(data_path(1), {})
+    assert (status, content) == (200, server.files[data_path(1)])
+    assert validator["etag"] and validator["last_modified"]
+
+    assert reporting_diff.fetch(data_path(1), validator) == (304, None, validator)
+    assert reporting_diff.fetch(data_path(2), {}) == (404, None, {})
+    assert statuses(server, data_path(1)) == [200, 304]
+
+def test_unchanged_file_is_read_from_the_cache(server, bucket, monkeypatch):
+    (frame, validator) = reporting_diff.load(bucket, data_path(3), {})
+    assert len(frame) == 5
+    assert bucket.get_blob(reporting_diff.cache_blob(data_path(3))) is not None
+
+    def parse(filename, content):
+        raise AssertionError(f"{filename} parsed again")
+    monkeypatch.setattr(reporting_diff, "parse", parse)
+    (cached, revalidated) = reporting_diff.load(bucket, data_path(3), validator)
+    assert statuses(server, data_path(3)) == [200, 304]
+    assert revalidated == validator
+    pd.testing.assert_frame_equal(cached, frame)
+
+def test_changed_file_is_downloaded_and_parsed_again(server, bucket):
+    (_, validator) = reporting_diff.load(bucket, data_path(3), {})
+    server.files[data_path(3)] = raw_file(columns_v4, range(4, 12))
+    (frame, updated) = reporting_diff.load(bucket, data_path(3), validator)
+    assert statuses(server, data_path(3)) == [200, 200]
+    assert len(frame) == 8
+    assert updated["etag"] != validator["etag"]
+
+def test_validators_are_ignored_without_a_cached_copy(server, bucket):
+    (_, validator) = reporting_diff.load(bucket, data_path(3), {})
+    bucket.blob(reporting_diff.cache_blob(data_path(3))).delete()
+    (frame, _) = reporting_diff.load(bucket, data_path(3), validator)
+    assert statuses(server, data_path(3)) == [200, 200]
+    assert len(frame) == 5
+
+def test_failed_download_falls_back_to_the_cached_copy(server, bucket, monkeypatch):
+    (frame, validator) = reporting_diff.load(bucket, data_path(3), {})
+    def fetch(filename, validator):
+        raise requests.ConnectionError("unreachable")
+    monkeypatch.setattr(reporting_diff, "fetch", fetch)
+    (cached, kept) = reporting_diff.load(bucket, data_path(3), validator)
+    assert kept == validator
+    pd.testing.assert_frame_equal(cached, frame)
+    with pytest.raises(requests.ConnectionError):
+        reporting_diff.load(bucket, data_path(1), {})
+
+def test_rerun_against_unchanged_files_only_revalidates(server, bucket):
+    reporting_diff.reporting_diff(None)
+    first = dict(server.requests)
+    server.requests.clear()
+    index = bucket.blob(reporting_diff.index_blob).download_as_string()
+
+    reporting_diff.reporting_diff(None)
+    assert {filename: 200 for filename in server.files} == {filename: status for (filename, status) in first.items() if status == 200}
+    assert all(status == (304 if filename in server.files else 404) for (filename, status) in server.requests)
+    assert len(server.requests) == len(reporting_diff.raw_files)
+    assert bucket.blob(reporting_diff.index_blob).download_as_string() == index
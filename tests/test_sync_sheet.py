@@ -0,0 +1,197 @@
+import re
+
+import pandas as pd
+import pytest
+
+from blobs import LocalBucket, download_buffers
+from conftest import load
+
+sync_sheet = load("misc/sync_sheet")
+
+class Request:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+class FakeSheets:
+    """ the Sheets API's spreadsheets and values collections over an in-memory sheet (row number -> values), recording every call """
+    grid_id = 123
+
+    def __init__(self):
+        (self.rows, self.calls, self.fail_writes) = ({}, [], False)
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def write(self, cells: str, values):
+        (top, bottom) = map(int, re.fullmatch(rf"{sync_sheet.sheet_name}!A(\d+):E(\d+)", cells).groups())
+        assert bottom - top + 1 == len(values)
+        self.rows.update(zip(range(top, bottom + 1), values))
+
+    def get(self, spreadsheetId, fields):
+        self.calls.append(("get", fields))
+        return Request({"sheets": [{"properties": {"sheetId": 0, "title": "Sheet1"}}, {"properties": {"sheetId": self.grid_id, "title": sync_sheet.sheet_name}}]})
+
+    def delete(self, request):
+        assert (request["sheetId"], request["dimension"]) == (self.grid_id, "ROWS")
+        (start, end) = (request["startIndex"] + 1, request["endIndex"] + 1)
+        rows = [values for (row, values) in sorted(self.rows.items()) if not start <= row < end]
+        self.rows = dict(zip(range(min(self.rows), min(self.rows) + len(rows)), rows))
+
+    def batchUpdate(self, spreadsheetId, body):
+        if "requests" in body:
+            # spreadsheets().batchUpdate
+            self.calls.append(("deleteDimension", body))
+            for request in body["requests"]:
+                self.delete(request["deleteDimension"]["range"])
+            return Request({"replies": [{} for _ in body["requests"]]})
+        self.calls.append(("batchUpdate", body))
+        if self.fail_writes:
+            raise ConnectionError("sheets unavailable")
+        for data in body["data"]:
+            self.write(data["range"], data["values"])
+        return Request({"totalUpdatedRows": sum(len(data["values"]) for data in body["data"])})
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        self.calls.append(("update", range))
+        self.write(range, body["values"])
+        return Request({"updatedRange": range})
+
+    def clear(self, spreadsheetId, range):
+        self.calls.append(("clear", range))
+        self.rows = {row: values for (row, values) in self.rows.items() if row < sync_sheet.first_row}
+        return Request({})
+
+    def frame(self) -> pd.DataFrame:
+        assert sorted(self.rows) == list(range(sync_sheet.first_row, sync_sheet.first_row + len(self.rows)))
+        return pd.DataFrame([self.rows[row] for row in sorted(self.rows)], columns = sync_sheet.columns)
+
+def timeseries(states = ("KA", "MH"), days: int = 4, Rt: float = 1.1, start: str = "2021-05-01") -> pd.DataFrame:
+    dates = pd.date_range(start, periods = days).strftime("%Y-%m-%d")
+    return pd.DataFrame([(state, date, f"{Rt:.2f}", f"{Rt + 0.1:.2f}", f"{Rt - 0.1:.2f}") for state in states for date in dates], columns = sync_sheet.columns)
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    bucket = LocalBucket(tmp_path/sync_sheet.bucket_name, sync_sheet.bucket_name)
+    monkeypatch.setattr(sync_sheet, "get_bucket", lambda name: bucket)
+    return bucket
+
+def publish(bucket, latest: pd.DataFrame):
+    bucket.blob(sync_sheet.blob_name).upload_from_string(latest.to_csv(index = False))
+
+def snapshot(bucket) -> pd.DataFrame:
+    return sync_sheet.read_rows(download_buffers(bucket, [sync_sheet.snapshot_blob])[sync_sheet.snapshot_blob])
+
+def test_contiguous_ranges():
+    rows = timeseries(states = ("KA",), days = 6)
+    rows.index = [0, 1, 2, 5, 7, 8]
+    ranges = list(sync_sheet.contiguous_ranges(rows))
+    assert [r["range"] for r in ranges] == [f"{sync_sheet.sheet_name}!A2:E4", f"{sync_sheet.sheet_name}!A7:E7", f"{sync_sheet.sheet_name}!A9:E10"]
+    assert [r["values"] for r in ranges] == [rows.iloc[0:3].values.tolist(), rows.iloc[3:4].values.tolist(), rows.iloc[4:6].values.tolist()]
+
+def test_push_changes_batches_rows(monkeypatch):
+    monkeypatch.setattr(sync_sheet, "batch_rows", 3)
+    rows = timeseries(days = 4)
+    rows.index = [0, 1, 2, 3, 4, 6, 7, 9]
+    service = FakeSheets()
+    sync_sheet.push_changes(service, rows)
+    payloads = [body for (call, body) in service.calls if call == "batchUpdate"]
+    assert [sum(len(data["values"]) for data in body["data"]) for body in payloads] == [3, 3, 2]
+    assert [[data["range"] for data in body["data"]] for body in payloads] == [
+        [f"{sync_sheet.sheet_name}!A2:E4"],
+        [f"{sync_sheet.sheet_name}!A5:E6", f"{sync_sheet.sheet_name}!A8:E8"],
+        [f"{sync_sheet.sheet_name}!A9:E9", f"{sync_sheet.sheet_name}!A11:E11"]
+    ]
+    assert all(body["valueInputOption"] == "USER_ENTERED" for body in payloads)
+
+def test_sync_writes_only_changed_and_new_rows(bucket):
+    service = FakeSheets()
+    latest = timeseries()
+    publish(bucket, latest)
+    sync_sheet.sync_sheet(None, service = service)
+    assert [call for (call, _) in service.calls] == ["clear", "update"]
+    pd.testing.assert_frame_equal(service.frame(), latest)
+    pd.testing.assert_frame_equal(snapshot(bucket), latest)
+
+    # one state's latest estimate revised, and a day added for both states
+    service.calls.clear()
+    revised = timeseries(days = 5)
+    revised.loc[3, "Rt"] = "1.30"
+    publish(bucket, revised)
+    sync_sheet.sync_sheet(None, service = service)
+    assert [call for (call, _) in service.calls] == ["batchUpdate"]
+    (_, body) = service.calls[0]
+    assert [data["values"] for data in body["data"]] == [[revised.loc[3].tolist()], revised[revised.date == "2021-05-05"].values.tolist()]
+    expected = pd.concat([latest.assign(Rt = lambda df: df.Rt.where(df.index != 3, "1.30")), revised[revised.date == "2021-05-05"]], ignore_index = True)
+    pd.testing.assert_frame_equal(service.frame(), expected)
+    pd.testing.assert_frame_equal(snapshot(bucket), expected)
+
+    # a rerun with nothing new makes no calls
+    service.calls.clear()
+    sync_sheet.sync_sheet(None, service = service)
+    assert service.calls == []
+
+def test_sliding_window_deletes_the_oldest_rows(bucket):
+    service = FakeSheets()
+    publish(bucket, timeseries())
+    sync_sheet.sync_sheet(None, service = service)
+
+    # the window moves on by a day: each state's first date drops off and a new one is added
+    service.calls.clear()
+    latest = timeseries(start = "2021-05-02")
+    publish(bucket, latest)
+    sync_sheet.sync_sheet(None, service = service)
+    assert [call for (call, _) in service.calls] == ["get", "deleteDimension", "batchUpdate"]
+    (_, deletes) = service.calls[1]
+    assert [(request["deleteDimension"]["range"]["startIndex"], request["deleteDimension"]["range"]["endIndex"]) for request in deletes["requests"]] == [(5, 6), (1, 2)]
+    (_, writes) = service.calls[2]
+    assert [data["range"] for data in writes["data"]] == [f"{sync_sheet.sheet_name}!A8:E9"]
+    expected = pd.concat([latest[latest.date != "2021-05-05"], latest[latest.date == "2021-05-05"]], ignore_index = True)
+    pd.testing.assert_frame_equal(service.frame(), expected)
+    pd.testing.assert_frame_equal(snapshot(bucket), expected)
+
+def test_failed_write_after_deleting_is_resumed(bucket):
+    service = FakeSheets()
+    publish(bucket, timeseries())
+    sync_sheet.sync_sheet(None, service = service)
+
+    latest = timeseries(start = "2021-05-02")
+    publish(bucket, latest)
+    service.fail_writes = True
+    with pytest.raises(ConnectionError):
+        sync_sheet.sync_sheet(None, service = service)
+
+    # the deletions were recorded, so the next sync only writes the new rows
+    service.calls.clear()
+    service.fail_writes = False
+    sync_sheet.sync_sheet(None, service = service)
+    assert [call for (call, _) in service.calls] == ["batchUpdate"]
+    assert sorted(service.frame().values.tolist()) == sorted(latest.values.tolist())
+
+def test_removed_state_is_deleted(bucket):
+    service = FakeSheets()
+    publish(bucket, timeseries(states = ("KA", "MH", "TN")))
+    sync_sheet.sync_sheet(None, service = service)
+
+    service.calls.clear()
+    latest = timeseries(states = ("KA", "TN"))
+    publish(bucket, latest)
+    sync_sheet.sync_sheet(None, service = service)
+    assert [call for (call, _) in service.calls] == ["get", "deleteDimension"]
+    pd.testing.assert_frame_equal(service.frame(), latest)
+
+def test_duplicate_keys_rewrite_the_sheet(bucket):
+    service = FakeSheets()
+    publish(bucket, timeseries())
+    sync_sheet.sync_sheet(None, service = service)
+
+    service.calls.clear()
+    latest = timeseries(days = 5)
+    publish(bucket, pd.concat([latest, latest.iloc[:1]], ignore_index = True))
+    sync_sheet.sync_sheet(None, service = service)
+    assert [call for (call, _) in service.calls] == ["clear", "update"]
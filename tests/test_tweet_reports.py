@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from blobs import LocalBucket
+from conftest import load
+
+tweet_reports = load("pipeline/exp/tweet_reports")
+
+class StubSecretStore:
+    """ secrets named after their version, which `rotate` bumps; counts reads """
+    def __init__(self):
+        (self.version, self.reads, self.lock) = (1, [], threading.Lock())
+
+    def get(self, name: str) -> str:
+        with self.lock:
+            self.reads.append(name)
+        return f"{name}-v{self.version}"
+
+    def rotate(self):
+        self.version += 1
+
+class StubConnect:
+    """ stands in for `connect`, recording the credentials it was called with; the client is `client()` if given, else the credentials """
+    def __init__(self, delay: float = 0, client = None):
+        (self.delay, self.client, self.calls) = (delay, client, [])
+
+    def __call__(self, credentials):
+        self.calls.append(credentials)
+        time.sleep(self.delay)
+        return self.client() if self.client else SimpleNamespace(credentials = credentials)
+
+def request(**body):
+    return SimpleNamespace(args = {}, get_json = lambda: body)
+
+def test_client_is_reused_until_it_expires():
+    (store, connect) = (StubSecretStore(), StubConnect())
+    clients = tweet_reports.TwitterClients(store, connect = connect, ttl = 0.5)
+
+    client = clients.get()
+    assert clients.get() is client
+    assert sorted(store.reads) == sorted(f"PROD_twitter_{name}" for name in tweet_reports.secret_names)
+    assert client.credentials == {name: f"PROD_twitter_{name}-v1" for name in tweet_reports.secret_names}
+
+    store.rotate()
+    time.sleep(0.6)
+    refreshed = clients.get()
+    assert refreshed is not client
+    assert len(connect.calls) == 2
+    assert refreshed.credentials == {name: f"PROD_twitter_{name}-v2" for name in tweet_reports.secret_names}
+
+def test_clients_are_kept_per_environment_and_invalidated():
+    (store, connect) = (StubSecretStore(), StubConnect())
+    clients = tweet_reports.TwitterClients(store, connect = connect)
+
+    (prod, test) = (clients.get("PROD"), clients.get("TEST"))
+    assert (clients.get("PROD"), clients.get("TEST")) == (prod, test)
+    assert len(connect.calls) == 2
+    assert test.credentials["API_key"] == "TEST_twitter_API_key-v1"
+
+    clients.invalidate("PROD")
+    assert clients.get("PROD") is not prod
+    assert clients.get("TEST") is test
+    assert len(connect.calls) == 3
+
+def test_concurrent_gets_connect_once():
+    (store, connect) = (StubSecretStore(), StubConnect(delay = 0.2))
+    clients = tweet_reports.TwitterClients(store, connect = connect)
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(clients.get())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(connect.calls) == 1
+    assert all(result is results[0] for result in results)
+
+def test_environment_secret_store(monkeypatch):
+    monkeypatch.setenv("PROD_twitter_API_key", "key")
+    monkeypatch.delenv("PROD_twitter_secret_key", raising = False)
+    store = tweet_reports.EnvironmentSecretStore()
+    assert (store.get("PROD_twitter_API_key"), store.get("PROD_twitter_secret_key")) == ("key", "")
+
+def test_local_twitter_writes_media_and_statuses(tmp_path):
+    twitter = tweet_reports.LocalTwitter(tmp_path/"tweets")
+    (tmp_path/"KA_Rt_timeseries.png").write_bytes(b"timeseries")
+    (tmp_path/"KA_Rt_top10.png").write_bytes(b"top10")
+
+    media_ids = [twitter.media_upload(str(tmp_path/name)).media_id for name in ("KA_Rt_timeseries.png", "KA_Rt_top10.png")]
+    twitter.update_status(status = "Rt report for Karnataka", media_ids = media_ids)
+    assert media_ids == [0, 1]
+    assert (tmp_path/"tweets"/"media"/"1.png").read_bytes() == b"top10"
+    assert [json.loads(line) for line in (tmp_path/"tweets"/"statuses.jsonl").read_text().splitlines()] == [{"status": "Rt report for Karnataka", "media_ids": [0, 1]}]
+
+@pytest.fixture
+def local_backend(tmp_path, monkeypatch):
+    bucket = LocalBucket(tmp_path/tweet_reports.bucket_name, tweet_reports.bucket_name)
+    for state_code in ("KA", "DL"):
+        for blob in tweet_reports.report_blobs(state_code)[0]:
+            bucket.blob(f"pipeline/rpt/{blob}").upload_from_string(blob)
+    connect = StubConnect(client = lambda: tweet_reports.LocalTwitter(tmp_path/"tweets"))
+    monkeypatch.setattr(tweet_reports, "get_bucket", lambda name: bucket)
+    monkeypatch.setattr(tweet_reports, "clients", tweet_reports.TwitterClients(tweet_reports.EnvironmentSecretStore(), connect = connect))
+    monkeypatch.setattr(tweet_reports, "tweet_interval", 0)
+    return (bucket, connect, tmp_path/"tweets"/"statuses.jsonl")
+
+def test_tweet_report_posts_each_state(local_backend):
+    (_, connect, statuses) = local_backend
+    assert tweet_reports.tweet_report(request(state_codes = ["KA", "DL"])) == "OK!"
+    tweets = [json.loads(line) for line in statuses.read_text().splitlines()]
+    assert [len(tweet["media_ids"]) for tweet in tweets] == [3, 1]
+    assert "(calculations run at state-level)" in tweets[1]["status"]
+    assert len(connect.calls) == 1
+
+def test_failed_state_does_not_stop_the_batch(local_backend):
+    (bucket, connect, statuses) = local_backend
+    bucket.blob("pipeline/rpt/KA_Rt_top10.png").delete()
+    with pytest.raises(RuntimeError, match = "KA"):
+        tweet_reports.tweet_report(request(state_codes = "KA,DL"))
+    assert [json.loads(line)["status"].startswith("Rt report for Delhi") for line in statuses.read_text().splitlines()] == [True]
+
+    # the client is re-authenticated after a failure
+    tweet_reports.tweet_report(request(state_code = "DL"))
+    assert len(connect.calls) == 2